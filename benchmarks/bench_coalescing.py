@@ -0,0 +1,136 @@
+"""Counts the LLM calls and slack posts made by the slack bot writer for
+bursts of messages in slack threads and in the channels outside of
+threads, with and without coalescing. The reader and
+writer run against moto's DynamoDB and SQS, with the chain and the slack
+client replaced by counters.
+
+    pip install "moto[dynamodb,sqs]>=5"
+    python benchmarks/bench_coalescing.py --bursts 6 --burst-size 5
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "slack_bot"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import history  # noqa: E402
+import message_reader  # noqa: E402
+import message_writer  # noqa: E402
+import models  # noqa: E402
+from config import config  # noqa: E402
+
+calls = {"llm": 0, "slack": 0}
+
+
+async def fake_run(api_key, history, prompt):
+    calls["llm"] += 1
+    return "reply", lambda: None
+
+
+async def fake_post_message(channel, text, secrets, thread=""):
+    calls["slack"] += 1
+
+
+def create_resources() -> str:
+    history._tables.clear()
+    boto3.resource("dynamodb").create_table(
+        TableName=config.DYNAMODB_MESSAGES_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "SessionId", "KeyType": "HASH"},
+            {"AttributeName": "MessageId", "KeyType": "RANGE"}
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "SessionId", "AttributeType": "S"},
+            {"AttributeName": "MessageId", "AttributeType": "S"}
+        ],
+        BillingMode="PAY_PER_REQUEST"
+    )
+    boto3.resource("dynamodb").create_table(
+        TableName=config.IDEMPOTENCY_TABLE_NAME,
+        KeySchema=[{"AttributeName": "IdempotencyKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "IdempotencyKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST"
+    )
+    return boto3.client("sqs").create_queue(
+        QueueName=config.MESSAGE_QUEUE_NAME,
+        Attributes={"FifoQueue": "true"}
+    )["QueueUrl"]
+
+
+def slack_event(channel: str, thread: str, event_id: str, user: str, text: str) -> dict:
+    """Event of a message mentioning the bot, outside of threads when `thread` is empty"""
+
+    event = {"channel": channel, "user": user, "text": f"<@UBOT> {text}", "ts": event_id}
+    if thread:
+        event["thread_ts"] = thread
+    return {"body": json.dumps({"event_id": event_id, "authorizations": [{"user_id": "UBOT"}], "event": event})}
+
+
+def group_id(body: dict) -> str:
+    if "first_at" in body:
+        return models.session_id(body["channel"], body["thread"])
+    return models.SlackMessage(body).session_id
+
+
+def drain(queue_url: str):
+    sqs = boto3.client("sqs")
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+        if not messages:
+            return
+        records = [{
+            "messageId": m["MessageId"],
+            "body": m["Body"],
+            "receiptHandle": m["ReceiptHandle"],
+            "attributes": {"MessageGroupId": group_id(json.loads(m["Body"]))}
+        } for m in messages]
+        message_writer.handler({"Records": records}, None)
+        for m in messages:
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=m["ReceiptHandle"])
+
+
+def run(bursts: int, burst_size: int, window: int, threaded: bool = True):
+    object.__setattr__(config, "COALESCE_WINDOW_SECONDS", window)
+    calls.update(llm=0, slack=0)
+    with mock_aws():
+        queue_url = create_resources()
+        for burst in range(bursts):
+            for i in range(burst_size):
+                thread = f"T{burst}" if threaded else ""
+                event = slack_event(f"C{burst % 3}", thread, f"E{burst}-{i}", f"U{i % 2}", f"question {i}")
+                message_reader.handler(event, None)
+            drain(queue_url)
+    return dict(calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bursts", type=int, default=6)
+    parser.add_argument("--burst-size", type=int, default=5)
+    args = parser.parse_args()
+
+    message_writer.chain.run = fake_run
+    message_writer.chain.load_history = lambda channel, thread="": None
+    message_writer.post_message = fake_post_message
+    # counts the coalesced replies, without the rate limit of the channels
+    message_reader.limiter = None
+    message_writer.utils.get_secrets = lambda force_refresh=False: {"openai-api-key": "", "slack-bot-token": ""}
+
+    messages = args.bursts * args.burst_size
+    for traffic, threaded in (("threads", True), ("channel", False)):
+        for name, window in (("per message", 0), ("coalesced", config.COALESCE_WINDOW_SECONDS)):
+            result = run(args.bursts, args.burst_size, window, threaded)
+            print(f"{traffic:>8} {name}: {messages} messages, {result['llm']} LLM calls, "
+                  f"{result['slack']} slack posts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compares the per-call overhead of the outbound http calls before and
+after the pooled sessions of `http_client` and the webapp.
+
+Before, each call to the secrets extension and each message of the
+webapp opened a new connection, and the webapp resolved the AWS
+credentials again to sign every message. With `--throttle-every` the
+fake API Gateway throttles every nth message, which the webapp now
+retries with a jittered backoff.
+
+    python benchmarks/bench_http.py --calls 200 --throttle-every 10
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service", "webapp"))
+
+import requests  # noqa: E402
+from boto3 import Session  # noqa: E402
+from botocore.auth import SigV4Auth  # noqa: E402
+from botocore.awsrequest import AWSRequest  # noqa: E402
+
+import api  # noqa: E402
+import http_client  # noqa: E402
+import secrets_provider  # noqa: E402
+from config import config  # noqa: E402
+from fake_services import FakeApiGateway, FakeSecretsExtension  # noqa: E402
+
+
+def fetch_secrets_unpooled():
+    """`secrets_provider.fetch_secrets` before the pooled session"""
+
+    headers = {"X-Aws-Parameters-Secrets-Token": os.environ.get("AWS_SESSION_TOKEN")}
+    r = requests.get(config.SECRETS_EXTENSION_ENDPOINT + "/secretsmanager/get?secretId=" +
+                     config.API_KEYS_SECRET_NAME, headers=headers)
+    r.raise_for_status()
+    return json.loads(r.json()["SecretString"])
+
+
+def call_unpooled(prompt: str, session_id: str):
+    """`api.call` before the pooled session and the cached credentials"""
+
+    body = json.dumps({"prompt": prompt, "session_id": session_id})
+    request = AWSRequest(method="POST", url=api.API_URL, data=body)
+    SigV4Auth(Session().get_credentials(), "execute-api", "us-east-1").add_auth(request)
+    r = requests.post(api.API_URL, headers=dict(request.headers.items()), data=body)
+    return json.loads(r.text)
+
+
+def measure(calls: int, fn):
+    timings, failures = [], 0
+    for i in range(calls):
+        start = time.perf_counter()
+        result = fn(i)
+        timings.append(time.perf_counter() - start)
+        if isinstance(result, dict) and "message" in result:
+            failures += 1
+    return timings, failures
+
+
+def report(name: str, timings, connections: int, failures: int = 0):
+    timings = sorted(timings)
+    p99 = timings[max(int(len(timings) * 0.99) - 1, 0)]
+    print(f"{name:>18}: mean {statistics.mean(timings) * 1e3:7.2f}ms  "
+          f"p50 {statistics.median(timings) * 1e3:7.2f}ms  p99 {p99 * 1e3:7.2f}ms  "
+          f"connections {connections:4d}  failed {failures}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated latency of the fake services in seconds")
+    parser.add_argument("--throttle-every", type=int, default=0,
+                        help="the fake api throttles every nth message")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_SESSION_TOKEN", "fake-session-token")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake-access-key")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake-secret-key")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    secrets = {config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-fake", "slack-bot-token": "xoxb-fake"}}
+
+    print("secrets extension")
+    with FakeSecretsExtension(secrets, latency=args.latency, port=0) as extension:
+        object.__setattr__(config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+        timings, failures = measure(args.calls, lambda i: fetch_secrets_unpooled())
+        report("before", timings, extension.connections, failures)
+        opened = extension.connections
+        timings, failures = measure(args.calls, lambda i: secrets_provider.fetch_secrets())
+        report("pooled", timings, extension.connections - opened, failures)
+
+    print("webapp api")
+    with FakeApiGateway(latency=args.latency, throttle_every=args.throttle_every) as gateway:
+        api.API_URL = gateway.endpoint + "/"
+        timings, failures = measure(args.calls, lambda i: call_unpooled(f"hello {i}", "session"))
+        report("before", timings, gateway.connections, failures)
+        opened, throttled = gateway.connections, gateway.throttled
+        timings, failures = measure(args.calls, lambda i: api.call(f"hello {i}", "session"))
+        report("pooled", timings, gateway.connections - opened, failures)
+        print(f"throttled responses: before {throttled}, pooled {gateway.throttled - throttled}")
+
+    stats = http_client.connection_stats()
+    print(f"secrets extension retries: {stats['retries']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Measures the search latency and the recall of the long-term memory
+index of the slack bot against the size of the index, with synthetic
+clustered embeddings. The recall is the share of the true top k, by the
+cosine similarity of the float32 embeddings, that a search returns.
+Candidates 0 compares the int8 embeddings of the whole index.
+
+    python benchmarks/bench_long_term_memory.py --sizes 1000 10000 100000 --candidates 0 64 256
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "slack_bot"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import numpy as np  # noqa: E402
+
+import long_term_memory  # noqa: E402
+from config import config  # noqa: E402
+from long_term_memory import ChannelIndex, Shard  # noqa: E402
+
+
+def embeddings(rng: np.random.Generator, size: int, dimensions: int, topics: int) -> np.ndarray:
+    """Normalized embeddings around `topics` random directions"""
+
+    centers = rng.standard_normal((topics, dimensions))
+    vectors = centers[rng.integers(topics, size=size)] + rng.standard_normal((size, dimensions)) * 0.8
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def shards(vectors: np.ndarray):
+    """Shards of the embeddings, as read from the table"""
+
+    shard_size = config.LONG_TERM_MEMORY_SHARD_SIZE
+    quantized = long_term_memory.quantize(vectors)
+    return [
+        Shard(number=i // shard_size,
+              refs=[f"C0#thread/MSG#{j:020d}" for j in range(i, min(i + shard_size, len(vectors)))],
+              vectors=quantized[i:i + shard_size])
+        for i in range(0, len(vectors), shard_size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--candidates", type=int, nargs="+", default=[0, 64, 256])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=config.LONG_TERM_MEMORY_TOP_K)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    dimensions = config.LONG_TERM_MEMORY_DIMENSIONS
+    print(f"{'size':>7} {'shards':>6} {'index MB':>8} {'build ms':>8} {'candidates':>10} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'recall':>6}")
+    for size in args.sizes:
+        vectors = embeddings(rng, size, dimensions, topics=max(size // 50, 1))
+        read = shards(vectors)
+        start = time.perf_counter()
+        index = ChannelIndex(read)
+        build_ms = (time.perf_counter() - start) * 1e3
+        megabytes = (index.vectors.nbytes + index.bits.nbytes + index.norms.nbytes) / 1e6
+
+        # queries close to messages of the index, like a follow up on an earlier topic
+        queries = vectors[rng.integers(size, size=args.queries)] + \
+            rng.standard_normal((args.queries, dimensions)).astype(np.float32) * 0.05
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        truth = [set(np.argsort(-(vectors @ query))[:args.k]) for query in queries]
+
+        for candidates in args.candidates:
+            object.__setattr__(config, "LONG_TERM_MEMORY_CANDIDATES", candidates)
+            timings, found = [], 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                hits = index.search(query, args.k)
+                timings.append(time.perf_counter() - start)
+                found += len(expected & {int(ref.rsplit("#", 1)[1]) for _, ref in hits})
+            timings.sort()
+            print(f"{size:>7} {len(index.shards):>6} {megabytes:>8.1f} {build_ms:>8.1f} {candidates:>10} "
+                  f"{statistics.median(timings) * 1e3:>7.2f} {timings[int(len(timings) * 0.95) - 1] * 1e3:>7.2f} "
+                  f"{found / (len(queries) * args.k):>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
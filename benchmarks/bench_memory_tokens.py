@@ -0,0 +1,84 @@
+"""Counts the prompt tokens sent per turn over synthetic conversations,
+with the full buffer memory and with the token budgeted memory of the
+service chain. The summarizer is a fake LLM, so no API key is needed.
+
+    pip install "moto[dynamodb]>=5"
+    python benchmarks/bench_memory_tokens.py --turns 50 --budget 1000
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+from langchain.llms.fake import FakeListLLM  # noqa: E402
+from langchain.memory import ConversationBufferMemory  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import chain  # noqa: E402
+from bench_session_storage import create_table  # noqa: E402
+from config import config  # noqa: E402
+from memory import DynamoDBMessageHistory, TokenBudgetMemory, count_tokens  # noqa: E402
+from sessions import SessionStore  # noqa: E402
+
+WORDS = ("lambda dynamodb token prompt budget latency cold start cache stream "
+         "session history summary model reply question answer cost").split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def prompt_tokens(history, prompt: str) -> int:
+    tokens = count_tokens(chain.SYSTEM_PROMPT, config.MODEL_NAME) + count_tokens(prompt, config.MODEL_NAME)
+    return tokens + sum(count_tokens(m.content, config.MODEL_NAME) for m in history)
+
+
+def run_conversation(turns: int, budget, seed: int):
+    rng = random.Random(seed)
+    summarizer = FakeListLLM(responses=[sentence(rng, 60) for _ in range(turns)])
+    session = SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, "first")
+    counts = []
+    for _ in range(turns):
+        if session.exists():
+            session = session.fork()
+        chat_memory = DynamoDBMessageHistory(store=session, window=config.HISTORY_READ_LIMIT)
+        if budget:
+            memory = TokenBudgetMemory(chat_memory=chat_memory, llm=summarizer, max_token_limit=budget)
+        else:
+            memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)
+
+        prompt = sentence(rng, rng.randint(8, 40))
+        history = memory.load_memory_variables({"input": prompt})["history"]
+        counts.append(prompt_tokens(history, prompt))
+        memory.save_context({"input": prompt}, {"response": sentence(rng, rng.randint(40, 160))})
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--budget", type=int, default=config.MEMORY_MAX_TOKENS)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    results = {}
+    for name, budget in (("buffer", None), ("token budget", args.budget)):
+        with mock_aws():
+            create_table()
+            results[name] = run_conversation(args.turns, budget, args.seed)
+
+    print(f"{'turn':>5}{'buffer':>10}{'token budget':>14}")
+    for turn in range(0, args.turns, max(args.turns // 10, 1)):
+        print(f"{turn + 1:>5}{results['buffer'][turn]:>10}{results['token budget'][turn]:>14}")
+    for name, counts in results.items():
+        print(f"{name}: {sum(counts)} prompt tokens in total, {max(counts)} max per turn")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Replays a workload of repeated and near-identical first-turn prompts
+through the service handler, with and without the response cache, and
+counts the LLM calls and the latency. Runs offline against a fake LLM
+and moto's DynamoDB.
+
+    pip install "moto[dynamodb]>=5"
+    python benchmarks/bench_response_cache.py --requests 60 --threshold 0.9
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_SESSION_TOKEN", "testing")
+
+from fake_services import FakeOpenAI, FakeSecretsExtension  # noqa: E402
+
+PROMPTS = [
+    ["What can you do?", "what can you do", "What can you do for me?"],
+    ["Hi", "hi!", "Hello"],
+    ["How do I reset my password?", "how do i reset my password", "How can I reset my password?"],
+    ["Explain code: print('Hello world')", "explain code print hello world"],
+    ["What are your opening hours?", "what are your opening hours?"],
+]
+
+
+def workload(requests: int, seed: int):
+    rng = random.Random(seed)
+    return [rng.choice(rng.choice(PROMPTS)) for _ in range(requests)]
+
+
+def create_cache_table():
+    import boto3
+    from config import config
+
+    boto3.resource("dynamodb").create_table(
+        TableName=config.RESPONSE_CACHE_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "ContextHash", "KeyType": "HASH"},
+            {"AttributeName": "PromptHash", "KeyType": "RANGE"}
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "ContextHash", "AttributeType": "S"},
+            {"AttributeName": "PromptHash", "AttributeType": "S"}
+        ],
+        BillingMode="PAY_PER_REQUEST"
+    )
+
+
+def run(main, llm, prompts, use_cache: bool):
+    import cache
+
+    cache._cache = None
+    cache._stats.update(hits=0, misses=0, saved_ms=0.0)
+    llm.completion_requests = 0
+    latencies = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        main.handler({"body": json.dumps({"prompt": prompt, "session_id": "", "cache": use_cache})}, None)
+        latencies.append(time.perf_counter() - start)
+    return llm.completion_requests, latencies, cache.cache_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    llm = FakeOpenAI(first_token_latency=0.3, token_delay=0.01).start()
+    os.environ["OPENAI_API_BASE"] = llm.endpoint + "/v1"
+
+    from moto import mock_aws
+
+    from bench_session_storage import create_table
+    from config import config
+
+    import main as service_main
+
+    # measures the requests of one client, without its rate limit
+    service_main.limiter = None
+
+    secrets = {config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-fake"}}
+    extension = FakeSecretsExtension(secrets, port=0).start()
+    object.__setattr__(config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+    # the token budget needs the tokenizer files, which may not be cached offline
+    object.__setattr__(config, "MEMORY_MAX_TOKENS", None)
+    object.__setattr__(config, "RESPONSE_CACHE_SIMILARITY_THRESHOLD", args.threshold)
+
+    prompts = workload(args.requests, args.seed)
+    for name, use_cache in (("no cache", False), ("cache", True)):
+        with mock_aws():
+            create_table()
+            create_cache_table()
+            calls, latencies, stats = run(service_main, llm, prompts, use_cache)
+        print(f"{name}: {calls} LLM calls for {len(prompts)} requests, "
+              f"latency p50 {statistics.median(latencies) * 1000:.0f}ms, "
+              f"mean {statistics.mean(latencies) * 1000:.0f}ms, hit rate {stats['hit_rate']:.0%}")
+
+    llm.stop()
+    extension.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compares the per-invocation overhead of reading secrets with and
+without the warm-container cache in `secrets_provider`.
+
+    python benchmarks/bench_secrets.py --invocations 200 --latency 0.002
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+import secrets_provider  # noqa: E402
+from config import config  # noqa: E402
+from fake_services import FakeSecretsExtension  # noqa: E402
+
+
+def measure(invocations: int, cached: bool):
+    secrets_provider.invalidate()
+    timings = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        secrets_provider.get_secrets(force_refresh=not cached)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:>9}: mean {statistics.mean(timings) * 1e6:9.1f}us  "
+          f"p50 {statistics.median(timings) * 1e6:9.1f}us  p99 {p99 * 1e6:9.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invocations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated extension latency in seconds")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_SESSION_TOKEN", "fake-session-token")
+    secrets = {config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-fake", "slack-bot-token": "xoxb-fake"}}
+
+    with FakeSecretsExtension(secrets, latency=args.latency) as extension:
+        object.__setattr__(config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+        uncached = measure(args.invocations, cached=False)
+        uncached_requests = extension.requests
+        cached = measure(args.invocations, cached=True)
+
+    report("uncached", uncached)
+    report("cached", cached)
+    print(f"extension requests: uncached {uncached_requests}, "
+          f"cached {extension.requests - uncached_requests}")
+
+
+if __name__ == "__main__":
+    main()
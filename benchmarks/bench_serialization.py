@@ -0,0 +1,117 @@
+"""Compares the size of the history items and the DynamoDB capacity
+units of a conversation stored in the langchain form of messages
+(`Message`) against the compact form of `history.encode_message`.
+Runs against moto's in-memory DynamoDB:
+
+    pip install "moto[dynamodb]>=5"
+    python benchmarks/bench_serialization.py --turns 50 --answer-words 40 400
+"""
+import argparse
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import history  # noqa: E402
+from config import config  # noqa: E402
+from history import MessageStore, human_message, new_message_id  # noqa: E402
+
+WORDS = ("the lambda reads the history of the session from dynamodb and sends the most recent "
+         "messages with the summary of the older ones to the model which answers in a few "
+         "sentences about aws serverless langchain python deployments").split()
+
+
+def create_table():
+    history._tables.clear()
+    boto3.resource("dynamodb").create_table(
+        TableName=config.DYNAMODB_MESSAGES_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "SessionId", "KeyType": "HASH"},
+            {"AttributeName": "MessageId", "KeyType": "RANGE"}
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "SessionId", "AttributeType": "S"},
+            {"AttributeName": "MessageId", "AttributeType": "S"}
+        ],
+        BillingMode="PAY_PER_REQUEST"
+    )
+
+
+def ai_message(content):
+    return {"type": "ai", "data": {"content": content, "additional_kwargs": {}}}
+
+
+def conversation(turns: int, answer_words: int):
+    for turn in range(turns):
+        yield human_message(f"question {turn}: how do I deploy the {WORDS[turn % len(WORDS)]}?")
+        yield ai_message(" ".join(WORDS[(turn + i) % len(WORDS)] for i in range(answer_words)))
+
+
+def store(session_id: str, messages, compact: bool):
+    """Writes the messages of a session, as the store does or as it did
+    before the compact form
+
+    Returns:
+        The bytes of the messages and the sizes of the items, oldest first
+    """
+
+    table = history.get_table(config.DYNAMODB_MESSAGES_TABLE_NAME)
+    size, item_sizes = 0, []
+    for message in messages:
+        if compact:
+            attribute = {history.COMPACT_ATTRIBUTE: history.encode_message(message)}
+        else:
+            attribute = {"Message": message}
+        item = {"SessionId": session_id, "MessageId": new_message_id(), **attribute}
+        table.put_item(Item=item)
+        size += history.item_size(attribute)
+        item_sizes.append(history.item_size(item))
+    return size, item_sizes
+
+
+def write_units(item_sizes) -> int:
+    """Write units of the items, 1 per started KB of each item"""
+
+    return sum(max(math.ceil(size / 1024), 1) for size in item_sizes)
+
+
+def read_units(item_sizes) -> float:
+    """Read units of an eventually consistent query of the items, half a
+    unit per started 4 KB of their total size"""
+
+    return max(math.ceil(sum(item_sizes) / 4096), 1) * 0.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--answer-words", type=int, nargs="+", default=[40, 400])
+    args = parser.parse_args()
+
+    print(f"{'words':>6} {'form':>8} {'bytes':>9} {'write units':>12} {'read units':>11}")
+    with mock_aws():
+        create_table()
+        for answer_words in args.answer_words:
+            messages = list(conversation(args.turns, answer_words))
+            read = {}
+            for form, compact in (("verbose", False), ("compact", True)):
+                session_id = f"{form}-{answer_words}"
+                size, item_sizes = store(session_id, messages, compact)
+                # the bounded read of the chain, through the store
+                limit = config.HISTORY_READ_LIMIT
+                read[form] = MessageStore(config.DYNAMODB_MESSAGES_TABLE_NAME, session_id).messages(limit=limit)
+                print(f"{answer_words:>6} {form:>8} {size:>9} {write_units(item_sizes):>12} "
+                      f"{read_units(item_sizes[-limit:]):>11}")
+            assert read["verbose"] == read["compact"], "the forms read back different messages"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Compares the DynamoDB storage used by an N-turn conversation on the
+service with copy-on-write sessions against copying the history into
+each new session. Runs against moto's in-memory DynamoDB:
+
+    pip install "moto[dynamodb]>=5"
+    python benchmarks/bench_session_storage.py --turns 10 25 50 100
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import history  # noqa: E402
+from config import config  # noqa: E402
+from history import MessageStore, human_message  # noqa: E402
+from sessions import SessionStore  # noqa: E402
+
+
+def create_table():
+    history._tables.clear()
+    boto3.resource("dynamodb").create_table(
+        TableName=config.DYNAMODB_MESSAGES_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "SessionId", "KeyType": "HASH"},
+            {"AttributeName": "MessageId", "KeyType": "RANGE"}
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "SessionId", "AttributeType": "S"},
+            {"AttributeName": "MessageId", "AttributeType": "S"}
+        ],
+        BillingMode="PAY_PER_REQUEST"
+    )
+
+
+def ai_message(content):
+    return {"type": "ai", "data": {"content": content, "additional_kwargs": {}}}
+
+
+def table_items():
+    table = history.get_table(config.DYNAMODB_MESSAGES_TABLE_NAME)
+    return table.scan(Select="COUNT")["Count"]
+
+
+def copy_on_write(turns: int):
+    session = SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, "first")
+    for turn in range(turns):
+        if session.exists():
+            session = session.fork()
+        session.append(human_message(f"question {turn}"))
+        session.append(ai_message(f"answer {turn}"))
+
+    expected = [f"answer {turns - 1}"]
+    assert [m["data"]["content"] for m in session.messages(limit=1)] == expected
+    assert session.length() == 2 * turns
+    return table_items()
+
+
+def full_copy(turns: int):
+    session = MessageStore(config.DYNAMODB_MESSAGES_TABLE_NAME, "first")
+    for turn in range(turns):
+        messages = session.messages()
+        if messages:
+            session = MessageStore(config.DYNAMODB_MESSAGES_TABLE_NAME, f"session-{turn}")
+            session.extend(messages)
+        session.append(human_message(f"question {turn}"))
+        session.append(ai_message(f"answer {turn}"))
+    return table_items()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 25, 50, 100])
+    args = parser.parse_args()
+
+    print(f"{'turns':>6}{'copy-on-write items':>22}{'per turn':>10}{'full copy items':>18}{'per turn':>10}")
+    for turns in args.turns:
+        with mock_aws():
+            create_table()
+            cow = copy_on_write(turns)
+        with mock_aws():
+            create_table()
+            copied = full_copy(turns)
+        print(f"{turns:>6}{cow:>22}{cow / turns:>10.1f}{copied:>18}{copied / turns:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
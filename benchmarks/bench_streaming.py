@@ -0,0 +1,103 @@
+"""Runs the streaming server of the service offline, against a fake LLM
+with configurable token delays, fake secrets and moto's DynamoDB, and
+compares the time to first token with the time to the full response
+of the buffered `main.handler`.
+
+    pip install "moto[dynamodb]>=5"
+    python benchmarks/bench_streaming.py --turns 5 --first-token-latency 0.3 --token-delay 0.03
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "service"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_SESSION_TOKEN", "testing")
+
+from fake_services import FakeOpenAI, FakeSecretsExtension  # noqa: E402
+
+
+def stream_turn(requests_session, url: str, prompt: str, session_id: str):
+    start = time.perf_counter()
+    first_token = None
+    result = {}
+    with requests_session.post(url, json={"prompt": prompt, "session_id": session_id}, stream=True) as r:
+        for line in r.iter_lines():
+            data = json.loads(line)
+            if "token" in data and first_token is None:
+                first_token = time.perf_counter() - start
+            result = data
+    return first_token, time.perf_counter() - start, result["session_id"]
+
+
+def buffered_turn(main, prompt: str, session_id: str):
+    start = time.perf_counter()
+    response = main.handler({"body": json.dumps({"prompt": prompt, "session_id": session_id})}, None)
+    return time.perf_counter() - start, json.loads(response["body"])["session_id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-delay", type=float, default=0.03)
+    args = parser.parse_args()
+
+    llm = FakeOpenAI(first_token_latency=args.first_token_latency, token_delay=args.token_delay).start()
+    os.environ["OPENAI_API_BASE"] = llm.endpoint + "/v1"
+
+    import requests
+    from moto import mock_aws
+
+    from bench_session_storage import create_table
+    from config import config
+
+    import main as service_main
+    from stream_server import StreamHandler
+
+    # measures the requests of one client, without its rate limit
+    service_main.limiter = None
+
+    secrets = {config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-fake"}}
+    extension = FakeSecretsExtension(secrets, port=0).start()
+    object.__setattr__(config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+    # the token budget needs the tokenizer files, which may not be cached offline
+    object.__setattr__(config, "MEMORY_MAX_TOKENS", None)
+    object.__setattr__(config, "RESPONSE_CACHE_ENABLED", False)
+
+    with mock_aws():
+        create_table()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StreamHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+        first_tokens, streamed, buffered = [], [], []
+        session_id = ""
+        with requests.Session() as requests_session:
+            for turn in range(args.turns):
+                first_token, total, session_id = stream_turn(requests_session, url, f"question {turn}", session_id)
+                first_tokens.append(first_token)
+                streamed.append(total)
+        session_id = ""
+        for turn in range(args.turns):
+            total, session_id = buffered_turn(service_main, f"question {turn}", session_id)
+            buffered.append(total)
+        server.shutdown()
+
+    llm.stop()
+    extension.stop()
+    print(f"streaming: time to first token p50 {statistics.median(first_tokens) * 1000:.0f}ms, "
+          f"full response p50 {statistics.median(streamed) * 1000:.0f}ms")
+    print(f"buffered:  full response p50 {statistics.median(buffered) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Reports the import time of the handler module and the zip size of
+each Lambda bundle, so cold-start regressions show up between builds.
+Run it after bundling:
+
+    python benchmarks/bundle_report.py
+    python benchmarks/bundle_report.py --json >> bundle_history.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# name: (bundle directory, handler module)
+LAMBDAS = {
+    "service": ("service/dist", "main"),
+    "slack-reader": ("slack_bot/dist_reader", "message_reader"),
+    "slack-writer": ("slack_bot/dist_writer", "message_writer"),
+}
+
+
+def import_time_ms(dist: str, module: str, runs: int) -> float:
+    """Best cumulative import time of the module over `runs` fresh interpreters"""
+
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=dist, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        match = re.search(rf"\|\s*(\d+)\s*\| {module}$", result.stderr, re.MULTILINE)
+        cumulative = int(match.group(1)) / 1000
+        best = cumulative if best is None else min(best, cumulative)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print a single json line")
+    args = parser.parse_args()
+
+    report = {"time": int(time.time()), "lambdas": {}}
+    for name, (dist, module) in LAMBDAS.items():
+        dist = os.path.join(ROOT, dist)
+        zip_path = os.path.join(dist, "lambda.zip")
+        if not os.path.exists(zip_path):
+            continue
+        try:
+            import_ms = import_time_ms(dist, module, args.runs)
+        except RuntimeError as e:
+            print(f"{name}: import of {module} failed: {e}", file=sys.stderr)
+            import_ms = None
+        report["lambdas"][name] = {
+            "import_ms": import_ms,
+            "zip_bytes": os.path.getsize(zip_path)
+        }
+
+    if args.json:
+        print(json.dumps(report))
+        return
+
+    print(f"{'lambda':<14}{'import (ms)':>12}{'zip (MB)':>10}")
+    for name, values in report["lambdas"].items():
+        import_ms = "-" if values["import_ms"] is None else f"{values['import_ms']:.1f}"
+        print(f"{name:<14}{import_ms:>12}{values['zip_bytes'] / 2 ** 20:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
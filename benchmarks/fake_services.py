@@ -0,0 +1,321 @@
+"""Local stand-ins for the services the Lambda handlers talk to, so the
+templates can be exercised without an AWS account or API keys."""
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeService:
+    """Runs a `BaseHTTPRequestHandler` on a background thread, counting
+    the requests and the connections they were sent on"""
+
+    def __init__(self, handler_class, host: str = "127.0.0.1", port: int = 0):
+        self.server = ThreadingHTTPServer((host, port), handler_class)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.requests = 0
+        self.connections = 0
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keeps connections alive, like the real services
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, Nagle would hold the
+    # body back until the client acks the headers
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.service.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _SecretsHandler(_Handler):
+    def do_GET(self):
+        service = self.server.service
+        service.requests += 1
+        time.sleep(service.latency)
+
+        url = urlparse(self.path)
+        secret_id = parse_qs(url.query).get("secretId", [""])[0]
+        if url.path != "/secretsmanager/get" or secret_id not in service.secrets:
+            self.send_error(404)
+            return
+        if not self.headers.get("X-Aws-Parameters-Secrets-Token"):
+            self.send_error(403)
+            return
+
+        body = json.dumps({
+            "Name": secret_id,
+            "SecretString": json.dumps(service.secrets[secret_id])
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSecretsExtension(FakeService):
+    """Serves secrets the way the AWS Parameters and Secrets
+    Lambda Extension does on localhost:2773.
+
+    Args:
+        secrets: secret values keyed by secret name
+        latency: seconds to wait before answering each request
+    """
+
+    def __init__(self, secrets: Dict[str, Dict[str, str]], latency: float = 0.0, port: int = 2773):
+        super().__init__(_SecretsHandler, port=port)
+        self.secrets = secrets
+        self.latency = latency
+
+    def rotate(self, secret_id: str, values: Dict[str, str]):
+        self.secrets[secret_id] = values
+
+
+class _OpenAIHandler(_Handler):
+    def do_POST(self):
+        service = self.server.service
+        service.requests += 1
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.rstrip("/") == "/v1/embeddings":
+            service.embedding_requests += 1
+            self._write_json({
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i,
+                     "embedding": service.embedding(text, request.get("dimensions", 64))}
+                    for i, text in enumerate(request["input"])
+                ],
+                "model": request["model"],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}
+            })
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        service.completion_requests += 1
+        service.model_requests[request["model"]] = service.model_requests.get(request["model"], 0) + 1
+        if request["model"] in service.failing_models:
+            body = json.dumps({"error": {"message": "The server is overloaded", "type": "server_error"}}).encode()
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        prompt_tokens = sum(len(m["content"].split()) + 4 for m in request["messages"])
+        tokens = service.reply_tokens(request)
+        if request.get("max_tokens"):
+            tokens = tokens[:request["max_tokens"]]
+        time.sleep(service.model_latency.get(request["model"], service.first_token_latency))
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self._write_event({"role": "assistant"})
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(service.token_delay)
+                self._write_event({"content": token})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+            return
+
+        time.sleep(service.token_delay * max(len(tokens) - 1, 0))
+        self._write_json({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens)
+            }
+        })
+
+    def _write_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_event(self, delta):
+        event = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
+        }
+        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAI(FakeService):
+    """Serves the OpenAI chat completions api, with and without streaming.
+    Point the openai client at it with `OPENAI_API_BASE=<endpoint>/v1`.
+
+    Args:
+        reply: text of every completion, a canned sentence when None.
+            Embeddings are hashed bags of words, so prompts sharing most
+            of their words are similar
+        first_token_latency: seconds before the first token is sent
+        token_delay: seconds between two tokens
+        model_latency: first token latency of specific models
+        failing_models: models that answer with a server error
+    """
+
+    def __init__(self, reply: Optional[str] = None, first_token_latency: float = 0.2,
+                 token_delay: float = 0.02, model_latency: Optional[Dict[str, float]] = None,
+                 failing_models: Iterable[str] = (), port: int = 0):
+        super().__init__(_OpenAIHandler, port=port)
+        self.reply = reply or "This is a fake reply from the local LLM, streamed one token at a time."
+        self.first_token_latency = first_token_latency
+        self.token_delay = token_delay
+        self.model_latency = dict(model_latency or {})
+        self.failing_models = set(failing_models)
+        self.completion_requests = 0
+        self.model_requests: Dict[str, int] = {}
+        self.embedding_requests = 0
+
+    def embedding(self, text: str, dimensions: int = 64):
+        vector = [0.0] * dimensions
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+        return vector
+
+    def reply_tokens(self, request):
+        words = self.reply.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+
+class _SlackHandler(_Handler):
+    def do_POST(self):
+        service = self.server.service
+        service.requests += 1
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(raw or "{}")
+        else:
+            params = {name: values[0] for name, values in parse_qs(raw).items()}
+        time.sleep(service.latency)
+
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        if method != "chat.postMessage":
+            body = {"ok": False, "error": "unknown_method"}
+        elif not self.headers.get("Authorization"):
+            body = {"ok": False, "error": "not_authed"}
+        else:
+            ts = f"{time.time():.6f}"
+            with service.lock:
+                service.posts.append({"channel": params.get("channel"), "text": params.get("text"),
+                                      "thread_ts": params.get("thread_ts"), "ts": ts,
+                                      "posted_at": time.perf_counter()})
+            body = {"ok": True, "channel": params.get("channel"), "ts": ts}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeSlack(FakeService):
+    """Serves `chat.postMessage` of the Slack web api and records the
+    posts. Point the bot at it with `SLACK_API_URL=<endpoint>/api/`.
+
+    Args:
+        latency: seconds to wait before answering each request
+    """
+
+    def __init__(self, latency: float = 0.0, port: int = 0):
+        super().__init__(_SlackHandler, port=port)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.posts = []
+
+
+class _ApiHandler(_Handler):
+    def do_POST(self):
+        service = self.server.service
+        with service.lock:
+            service.requests += 1
+            throttled = service.throttle_every and service.requests % service.throttle_every == 0
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or "{}")
+        time.sleep(service.latency)
+
+        if not self.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256"):
+            status, body = 403, {"message": "Missing Authentication Token"}
+        elif throttled:
+            service.throttled += 1
+            status, body = 429, {"message": "Too Many Requests"}
+        else:
+            status, body = 200, {"response": f"echo: {request.get('prompt', '')}",
+                                 "session_id": request.get("session_id") or "session"}
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeApiGateway(FakeService):
+    """Answers the SigV4 signed chat requests of the webapp the way the
+    API Gateway in front of the service does, echoing the prompt.
+
+    Args:
+        latency: seconds to wait before answering each request
+        throttle_every: answers every nth request with a 429, 0 never does
+    """
+
+    def __init__(self, latency: float = 0.0, throttle_every: int = 0, port: int = 0):
+        super().__init__(_ApiHandler, port=port)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.throttled = 0
+        self.lock = threading.Lock()
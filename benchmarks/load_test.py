@@ -0,0 +1,457 @@
+"""Load tests the real Lambda handlers in-process, offline. DynamoDB and SQS
+are moto's, the LLM, Slack and the secrets extension are the local fakes
+of `fake_services.py`, so no AWS account or API key is needed.
+
+    pip install "moto[dynamodb,sqs]>=5"
+    python benchmarks/load_test.py service --sessions 20 --max-turns 8 --concurrency 4
+    python benchmarks/load_test.py service --async-jobs --sessions 5
+    python benchmarks/load_test.py slack --bursts 10 --channels 3 --threads 2 --max-burst 4 --window 1
+
+Traffic is generated from the seed and can be saved with `--save-profile`
+and replayed with `--profile`, so a change can be measured against the
+same traffic. The report has the p50/p95/p99 latencies, the LLM, Slack and
+DynamoDB calls per turn, the DynamoDB capacity units per turn as reported
+with `ReturnConsumedCapacity` (moto's are estimates, transactions report
+none), and the mean of each stage recorded by `tracing.py`.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_SESSION_TOKEN", "testing")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+from fake_services import FakeOpenAI, FakeSecretsExtension, FakeSlack  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+TOPICS = [
+    "the weather", "nasi lemak", "the traffic", "the new phone", "the football match",
+    "our holiday plans", "the movie last night", "work", "the election", "coffee"
+]
+
+# Messages that don't mention the bot, questions and chatter
+CHANNEL_MESSAGES = [
+    "anyone seen {topic}?", "what do you all think about {topic}", "{topic} was great lol",
+    "ok", "brb", "haha {topic} again", "can someone recommend something like {topic}?"
+]
+
+
+class DynamoDBMeter:
+    """Counts the DynamoDB calls made through the default boto3 session
+    and the capacity they consume. Install it before the handlers create
+    their clients, the hooks are copied into each client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.capacity_units = 0.0
+        session = boto3.setup_default_session() or boto3.DEFAULT_SESSION
+        session.events.register("provide-client-params.dynamodb.*", self._request_capacity)
+        session.events.register("after-call.dynamodb.*", self._count)
+
+    @staticmethod
+    def _request_capacity(params, model, **kwargs):
+        if "ReturnConsumedCapacity" in model.input_shape.members:
+            params.setdefault("ReturnConsumedCapacity", "TOTAL")
+
+    def _count(self, parsed, **kwargs):
+        consumed = parsed.get("ConsumedCapacity") or []
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        with self.lock:
+            self.calls += 1
+            self.capacity_units += sum(c.get("CapacityUnits", 0.0) for c in consumed)
+
+
+class MetricsSink:
+    """Stands in for stdout while the handlers run, keeping the metric
+    lines of `tracing.py` and dropping the other output"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces: List[Dict] = []
+
+    def write(self, text: str):
+        for line in text.splitlines():
+            if line.startswith('{"_aws"'):
+                with self.lock:
+                    self.traces.append(json.loads(line))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name: str, latencies: List[float]):
+    print(f"{name:>12}: p50 {percentile(latencies, 50) * 1000:7.0f}ms  "
+          f"p95 {percentile(latencies, 95) * 1000:7.0f}ms  "
+          f"p99 {percentile(latencies, 99) * 1000:7.0f}ms  ({len(latencies)} samples)")
+
+
+def report_stages(sink: MetricsSink):
+    handlers = sorted({t["Handler"] for t in sink.traces})
+    for handler in handlers:
+        traces = [t for t in sink.traces if t["Handler"] == handler]
+        names = [m["Name"] for t in traces for m in t["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        stages = {name: sum(t.get(name, 0) for t in traces) / len(traces) for name in dict.fromkeys(names)}
+        print(f"{handler} (mean of {len(traces)}): " +
+              ", ".join(f"{name} {value:.1f}" for name, value in stages.items()))
+
+
+def service_profile(args, rng: random.Random) -> Dict:
+    """Sessions of random length, each turn asking about a topic,
+    a share of them asking for an explanation"""
+
+    def prompt():
+        if rng.random() < args.hard_rate:
+            return f"Can you explain {rng.choice(TOPICS)} step by step?"
+        return f"What do you think about {rng.choice(TOPICS)}?"
+
+    return {"target": "service", "sessions": [
+        [prompt() for _ in range(rng.randint(args.min_turns, args.max_turns))]
+        for _ in range(args.sessions)
+    ]}
+
+
+def slack_profile(args, rng: random.Random) -> Dict:
+    """Bursts of messages fanned out over the threads of the channels,
+    or sent to the channels outside of threads, a share of them
+    mentioning the bot and the others a mix of questions and chatter"""
+
+    bursts = []
+    for burst in range(args.bursts):
+        messages = []
+        for channel in rng.sample(range(args.channels), rng.randint(1, args.channels)):
+            # the messages of a channel in a burst are in threads or all outside of them
+            threaded = rng.random() >= args.channel_rate
+            for i in range(rng.randint(1, args.max_burst)):
+                messages.append({
+                    "channel": f"C{channel}",
+                    "thread": f"T{burst // args.thread_bursts}-{rng.randrange(args.threads)}" if threaded else "",
+                    "user": f"U{rng.randint(0, 4)}",
+                    "mention": rng.random() < args.mention_rate,
+                    "text": rng.choice(CHANNEL_MESSAGES).format(topic=rng.choice(TOPICS)),
+                    "event_id": f"E{burst}-{channel}-{i}"
+                })
+        bursts.append(messages)
+    return {"target": "slack", "bursts": bursts}
+
+
+def run_service(profile: Dict, args, llm: FakeOpenAI, sink: MetricsSink) -> Dict:
+    meter = DynamoDBMeter()
+    from config import config
+
+    from bench_response_cache import create_cache_table
+    from bench_session_storage import create_table
+
+    create_table()
+    create_cache_table()
+    if args.async_jobs:
+        create_jobs_resources()
+    object.__setattr__(config, "RESPONSE_CACHE_ENABLED", not args.no_cache)
+    import main
+
+    first_outputs = []
+
+    throttled = []
+
+    def post(payload: Dict) -> Dict:
+        """Sends the request, waiting out the Retry-After of a 429 as the webapp does"""
+
+        while True:
+            response = main.handler({"body": json.dumps(payload)}, None)
+            if response["statusCode"] != 429:
+                return response
+            throttled.append(1)
+            time.sleep(int(response["headers"]["Retry-After"]))
+
+    def run_turn(prompt: str, session_id: str) -> str:
+        response = post({"prompt": prompt, "session_id": session_id})
+        return json.loads(response["body"])["session_id"]
+
+    def run_job(prompt: str, session_id: str) -> str:
+        start = time.perf_counter()
+        response = post({"prompt": prompt, "session_id": session_id, "async": True})
+        job_id = json.loads(response["body"])["job_id"]
+        after = 0
+        while True:
+            response = main.handler({
+                "resource": "/jobs/{job_id}",
+                "pathParameters": {"job_id": job_id},
+                "queryStringParameters": {"wait": "5", "after": str(after)}
+            }, None)
+            job = json.loads(response["body"])
+            if not after and job["output"]:
+                first_outputs.append(time.perf_counter() - start)
+            if job["status"] == "completed":
+                return job["session_id"]
+            if job["status"] == "failed":
+                raise RuntimeError(f"job {job_id} failed")
+            after = len(job["output"])
+
+    def run_session(prompts: List[str]) -> List[float]:
+        latencies, session_id = [], ""
+        for prompt in prompts:
+            start = time.perf_counter()
+            session_id = (run_job if args.async_jobs else run_turn)(prompt, session_id)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    stop = threading.Event()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sink), ThreadPoolExecutor(args.concurrency * 2) as pool:
+        workers = [pool.submit(run_job_worker, main, stop) for _ in range(args.concurrency if args.async_jobs else 0)]
+        try:
+            latencies = [latency for session in pool.map(run_session, profile["sessions"]) for latency in session]
+        finally:
+            stop.set()
+        for worker in workers:
+            worker.result()
+    elapsed = time.perf_counter() - start
+
+    report("turn", latencies)
+    if first_outputs:
+        report("first output", first_outputs)
+    return {"turns": len(latencies), "elapsed": elapsed, "dynamodb": meter, "throttled": len(throttled)}
+
+
+def create_jobs_resources():
+    from config import config
+
+    boto3.resource("dynamodb").create_table(
+        TableName=config.JOBS_TABLE_NAME,
+        KeySchema=[{"AttributeName": "JobId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "JobId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST"
+    )
+    boto3.client("sqs").create_queue(QueueName=config.JOBS_QUEUE_NAME)
+
+
+def create_rate_limit_table():
+    from config import config
+
+    boto3.resource("dynamodb").create_table(
+        TableName=config.RATE_LIMIT_TABLE_NAME,
+        KeySchema=[{"AttributeName": "Key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "Key", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST"
+    )
+
+
+def run_job_worker(main, stop: threading.Event):
+    """Delivers the queued jobs to the job worker handler, as the SQS
+    event source does, until stopped"""
+
+    import jobs
+
+    sqs = boto3.client("sqs")
+    while not stop.is_set():
+        messages = sqs.receive_message(
+            QueueUrl=jobs.get_queue_url(), MaxNumberOfMessages=1, WaitTimeSeconds=1
+        ).get("Messages", [])
+        for message in messages:
+            main.job_handler({"Records": [{"messageId": message["MessageId"], "body": message["Body"]}]}, None)
+            sqs.delete_message(QueueUrl=jobs.get_queue_url(), ReceiptHandle=message["ReceiptHandle"])
+
+
+def run_slack(profile: Dict, args, llm: FakeOpenAI, sink: MetricsSink) -> Dict:
+    meter = DynamoDBMeter()
+    from config import config
+
+    from bench_coalescing import create_resources
+
+    slack = FakeSlack(latency=args.slack_latency).start()
+    object.__setattr__(config, "SLACK_API_URL", slack.endpoint + "/api/")
+    object.__setattr__(config, "COALESCE_WINDOW_SECONDS", args.window)
+    if args.long_term_memory:
+        object.__setattr__(config, "LONG_TERM_MEMORY_ENABLED", True)
+        object.__setattr__(config, "HISTORY_READ_LIMIT", 6)
+
+    queue_url = create_resources()
+    import message_reader
+    import message_writer
+    logging.getLogger().setLevel(logging.WARNING)
+    sqs = boto3.client("sqs")
+
+    def drain() -> List[float]:
+        latencies = []
+        while True:
+            messages = sqs.receive_message(
+                QueueUrl=queue_url, MaxNumberOfMessages=config.WRITER_BATCH_SIZE, AttributeNames=["All"]
+            ).get("Messages", [])
+            if not messages:
+                return latencies
+            records = [{"messageId": m["MessageId"], "body": m["Body"], "receiptHandle": m["ReceiptHandle"],
+                        "attributes": m["Attributes"]} for m in messages]
+            start = time.perf_counter()
+            message_writer.handler({"Records": records}, None)
+            latencies.append(time.perf_counter() - start)
+            for m in messages:
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=m["ReceiptHandle"])
+
+    ack_latencies, batch_latencies, reply_latencies = [], [], []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sink):
+        for burst in profile["bursts"]:
+            # reply latency runs from the oldest message still waiting in the thread
+            waiting: Dict[tuple, float] = {}
+            for message in burst:
+                text = f"<@UBOT> {message['text']}" if message["mention"] else message["text"]
+                # profiles saved before the messages outside of threads had a thread per message
+                thread = message.get("thread", message["event_id"])
+                event = {"channel": message["channel"], "user": message["user"],
+                         "text": text, "ts": message["event_id"]}
+                if thread:
+                    event["thread_ts"] = thread
+                body = json.dumps({
+                    "event_id": message["event_id"],
+                    "authorizations": [{"user_id": "UBOT"}],
+                    "event": event
+                })
+                sent = time.perf_counter()
+                message_reader.handler({"body": body, "headers": {}}, None)
+                ack_latencies.append(time.perf_counter() - sent)
+                waiting.setdefault((message["channel"], thread or None), sent)
+
+            posted = len(slack.posts)
+            batch_latencies.extend(drain())
+            for post in slack.posts[posted:]:
+                thread = (post["channel"], post["thread_ts"])
+                if thread in waiting:
+                    reply_latencies.append(post["posted_at"] - waiting.pop(thread))
+    elapsed = time.perf_counter() - start
+
+    message_writer._loop.run_until_complete(message_writer._http_session.close())
+    slack.stop()
+
+    report("reader ack", ack_latencies)
+    report("writer batch", batch_latencies)
+    if reply_latencies:
+        report("reply", reply_latencies)
+    decisions = Counter(t["relevance"] for t in sink.traces if "relevance" in t)
+    return {"turns": len(ack_latencies), "elapsed": elapsed, "dynamodb": meter, "slack_posts": len(slack.posts),
+            "relevance": decisions, "throttled": sum(t.get("throttled", 0) for t in sink.traces),
+            "deferred": sum(t.get("deferred", 0) for t in sink.traces),
+            "shed": sum(t.get("shed", 0) for t in sink.traces)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("target", choices=["service", "slack"])
+    parser.add_argument("--profile", help="replay the traffic saved with --save-profile")
+    parser.add_argument("--save-profile", help="write the generated traffic to this file")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="first token latency of a model, e.g. gpt-4=1.2")
+    parser.add_argument("--secrets-latency", type=float, default=0.002, help="seconds")
+    parser.add_argument("--rate-limit", metavar="CAPACITY:PER_MINUTE",
+                        help="enable the rate limit, per session or channel")
+    parser.add_argument("--token-budget", action="store_true",
+                        help="keep MEMORY_MAX_TOKENS, needs the tiktoken files cached locally")
+
+    service = parser.add_argument_group("service")
+    service.add_argument("--sessions", type=int, default=20)
+    service.add_argument("--min-turns", type=int, default=1)
+    service.add_argument("--max-turns", type=int, default=8)
+    service.add_argument("--concurrency", type=int, default=4, help="sessions run in parallel")
+    service.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    service.add_argument("--hard-rate", type=float, default=0.2, help="share of prompts routed to the large model")
+    service.add_argument("--async-jobs", action="store_true",
+                         help="send the prompts as background jobs and long-poll them")
+
+    slack = parser.add_argument_group("slack")
+    slack.add_argument("--bursts", type=int, default=10)
+    slack.add_argument("--channels", type=int, default=3, help="channels a burst fans out to")
+    slack.add_argument("--threads", type=int, default=1, help="threads of a channel a burst fans out to")
+    slack.add_argument("--channel-rate", type=float, default=0.3,
+                       help="share of the channels of a burst whose messages are outside of threads")
+    slack.add_argument("--thread-bursts", type=int, default=1, help="consecutive bursts in the same threads")
+    slack.add_argument("--max-burst", type=int, default=4, help="messages per channel in a burst")
+    slack.add_argument("--mention-rate", type=float, default=0.7, help="share of messages mentioning the bot")
+    slack.add_argument("--window", type=float, default=1.0, help="COALESCE_WINDOW_SECONDS, 0 disables")
+    slack.add_argument("--slack-latency", type=float, default=0.05, help="seconds")
+    slack.add_argument("--long-term-memory", action="store_true",
+                       help="enable the long-term memory, with a window of 6 recent messages so they age out "
+                            "with --thread-bursts, needs the tiktoken files cached locally")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.profile:
+        with open(args.profile) as f:
+            profile = json.load(f)
+        if profile["target"] != args.target:
+            parser.error(f"{args.profile} is a {profile['target']} profile")
+    else:
+        profile = (service_profile if args.target == "service" else slack_profile)(args, rng)
+    if args.save_profile:
+        with open(args.save_profile, "w") as f:
+            json.dump(profile, f, indent=1)
+
+    model_latency = {model: float(seconds) for model, seconds in (m.split("=") for m in args.model_latency)}
+    llm = FakeOpenAI(first_token_latency=args.first_token_latency, token_delay=1 / args.tokens_per_second,
+                     model_latency=model_latency).start()
+    os.environ["OPENAI_API_BASE"] = llm.endpoint + "/v1"
+
+    with mock_aws():
+        runner = run_service if args.target == "service" else run_slack
+        sys.path.insert(0, os.path.join(ROOT, "service" if args.target == "service" else "slack_bot"))
+        from config import config
+
+        secrets = {config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-fake", "slack-bot-token": "xoxb-fake"}}
+        extension = FakeSecretsExtension(secrets, latency=args.secrets_latency, port=0).start()
+        object.__setattr__(config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+        if not args.token_budget:
+            object.__setattr__(config, "MEMORY_MAX_TOKENS", None)
+        if args.rate_limit:
+            capacity, per_minute = args.rate_limit.split(":")
+            object.__setattr__(config, "RATE_LIMIT_CAPACITY", int(capacity))
+            object.__setattr__(config, "RATE_LIMIT_PER_MINUTE", float(per_minute))
+            create_rate_limit_table()
+        else:
+            object.__setattr__(config, "RATE_LIMIT_CAPACITY", 0)
+
+        sink = MetricsSink()
+        result = runner(profile, args, llm, sink)
+        extension.stop()
+    llm.stop()
+
+    turns = result["turns"]
+    meter = result["dynamodb"]
+    print(f"{turns} turns in {result['elapsed']:.1f}s, {turns / result['elapsed']:.1f} turns/s")
+    print(f"per turn: {llm.completion_requests / turns:.2f} LLM calls, "
+          f"{llm.embedding_requests / turns:.2f} embedding calls, "
+          + (f"{result['slack_posts'] / turns:.2f} slack posts, " if "slack_posts" in result else "")
+          + f"{meter.calls / turns:.2f} DynamoDB calls, {meter.capacity_units / turns:.2f} capacity units")
+    if args.rate_limit:
+        print(f"rate limit: {result['throttled']} throttled"
+              + (f", {result['deferred']} replies deferred, {result['shed']} dropped" if "shed" in result else ""))
+    if "relevance" in result:
+        print("relevance decisions: " + ", ".join(f"{d} {n}" for d, n in result["relevance"].most_common()))
+    print("LLM calls by model: " + ", ".join(f"{model} {calls}" for model, calls in llm.model_requests.items()))
+    report_stages(sink)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,221 @@
+import os
+from typing import Dict
+
 from aws_cdk import (
-    App, Duration, Stack, 
+    App, CfnOutput, Duration, Stack, 
     aws_apigateway as apigateway, 
+    aws_applicationautoscaling as appscaling,
     aws_lambda as lambda_, 
     aws_secretsmanager as secretsmanager,
-    aws_dynamodb as dynamodb
+    aws_dynamodb as dynamodb,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as event_sources
 )
+from constructs import Construct
 import config
 
 
+def is_arm64(profile: Dict) -> bool:
+    return profile["architecture"] == "arm64"
+
+
+def function_settings(profile: Dict) -> Dict:
+    """Lambda function props of the performance profile"""
+
+    settings = {
+        "architecture": lambda_.Architecture.ARM_64 if is_arm64(profile) else lambda_.Architecture.X86_64
+    }
+    if profile["memory_size"]:
+        settings["memory_size"] = profile["memory_size"]
+    return settings
+
+
+def profile_environment(profile: Dict) -> Dict[str, str]:
+    return {"WARMUP": "true"} if profile["warmup"] else {}
+
+
+def live_target(scope: Construct, id: str, function: lambda_.Function, profile: Dict) -> lambda_.IFunction:
+    """Returns the `live` alias of the function when the profile keeps
+    environments provisioned, with the scaling of the profile, or the
+    function itself otherwise"""
+
+    if not profile["provisioned_concurrency"]:
+        return function
+
+    alias = lambda_.Alias(scope, id,
+        alias_name="live",
+        version=function.current_version,
+        provisioned_concurrent_executions=profile["provisioned_concurrency"]
+    )
+    scaling = profile["scaling"]
+    if scaling:
+        target = alias.add_auto_scaling(
+            min_capacity=profile["provisioned_concurrency"],
+            max_capacity=max(schedule["max"] for schedule in scaling["schedules"])
+        )
+        target.scale_on_utilization(utilization_target=scaling["utilization"])
+        for schedule in scaling["schedules"]:
+            target.scale_on_schedule(schedule["name"],
+                schedule=appscaling.Schedule.expression(schedule["cron"]),
+                min_capacity=schedule["min"],
+                max_capacity=schedule["max"]
+            )
+    return alias
+
+
 class LangChainApp(Stack):
-    def __init__(self, app: App, id: str) -> None:
+    def __init__(self, app: App, id: str, bundle_dir: str = ".") -> None:
+        """The lambdas are deployed from the packages of the bundle
+        scripts, in `bundle_dir`"""
+
         super().__init__(app, id)
 
-        table = dynamodb.Table(self, "table", table_name=config.config.DYNAMODB_TABLE_NAME, 
+        profile = config.config.PERFORMANCE_PROFILES[config.config.PERFORMANCE_PROFILE]
+        secrets_extension_arn = (
+            config.config.SECRETS_EXTENSION_ARM64_ARN if is_arm64(profile) else config.config.SECRETS_EXTENSION_ARN
+        )
+        web_adapter_arn = (
+            config.config.LAMBDA_WEB_ADAPTER_ARM64_ARN if is_arm64(profile) else config.config.LAMBDA_WEB_ADAPTER_ARN
+        )
+
+        # Legacy history table, can be removed once migrated with migrate_history.py
+        dynamodb.Table(self, "table", table_name=config.config.DYNAMODB_TABLE_NAME, 
             partition_key=dynamodb.Attribute(name="SessionId", type=dynamodb.AttributeType.STRING)
         )
 
+        messages_table = dynamodb.Table(self, "messages-table", table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="SessionId", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="MessageId", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST
+        )
+
+        cache_table = dynamodb.Table(self, "response-cache-table", table_name=config.config.RESPONSE_CACHE_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="ContextHash", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="PromptHash", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt"
+        )
+
+        jobs_table = dynamodb.Table(self, "jobs-table", table_name=config.config.JOBS_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="JobId", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt"
+        )
+
+        rate_limit_table = dynamodb.Table(self, "rate-limit-table", table_name=config.config.RATE_LIMIT_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="Key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt"
+        )
+
+        jobs_queue = sqs.Queue(
+            self,
+            "jobs-queue",
+            queue_name=config.config.JOBS_QUEUE_NAME,
+            # 6 times the worker timeout, as recommended for lambda event sources,
+            # so jobs in progress aren't redelivered
+            visibility_timeout=Duration.minutes(30)
+        )
+
         handler = lambda_.Function(self, "LangChainHandler",
             runtime=lambda_.Runtime.PYTHON_3_9,
-            code=lambda_.Code.from_asset("dist/lambda.zip"),
+            code=lambda_.Code.from_asset(os.path.join(bundle_dir, "dist/lambda.zip")),
             handler="main.handler",
             layers=[
                 lambda_.LayerVersion.from_layer_version_arn(
                     self,
                     "SecretsExtensionLayer",
-                    layer_version_arn=config.config.SECRETS_EXTENSION_ARN
+                    layer_version_arn=secrets_extension_arn
                 )
             ],
-            timeout=Duration.minutes(5)
+            timeout=Duration.minutes(5),
+            environment={
+                # tokenizer files bundled with the code
+                "TIKTOKEN_CACHE_DIR": "/var/task/tiktoken_cache",
+                **profile_environment(profile)
+            },
+            **function_settings(profile)
         )
+        handler_target = live_target(self, "LangChainHandlerLive", handler, profile)
 
-        table.grant_read_write_data(handler)
+        messages_table.grant_read_write_data(handler)
+        cache_table.grant_read_write_data(handler)
+        jobs_table.grant_read_write_data(handler)
+        rate_limit_table.grant_read_write_data(handler)
+        jobs_queue.grant_send_messages(handler)
 
         secret = secretsmanager.Secret.from_secret_name_v2(self, 'secret', config.config.API_KEYS_SECRET_NAME)
         secret.grant_read(handler)
         secret.grant_write(handler)
 
+        # Runs the jobs of the requests with `"async": true`, see jobs.py.
+        # Jobs don't wait on the api, so they get the full lambda timeout
+        job_worker = lambda_.Function(self, "LangChainJobWorker",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            code=lambda_.Code.from_asset(os.path.join(bundle_dir, "dist/lambda.zip")),
+            handler="main.job_handler",
+            layers=[
+                lambda_.LayerVersion.from_layer_version_arn(
+                    self,
+                    "JobSecretsExtensionLayer",
+                    layer_version_arn=secrets_extension_arn
+                )
+            ],
+            timeout=Duration.minutes(5),
+            environment={
+                "TIKTOKEN_CACHE_DIR": "/var/task/tiktoken_cache",
+                **profile_environment(profile)
+            },
+            **function_settings(profile)
+        )
+        messages_table.grant_read_write_data(job_worker)
+        cache_table.grant_read_write_data(job_worker)
+        jobs_table.grant_read_write_data(job_worker)
+        secret.grant_read(job_worker)
+        job_worker.add_event_source(event_sources.SqsEventSource(jobs_queue, batch_size=1))
+
+        # Streams the tokens to the client as they are generated. Python
+        # lambdas can't stream responses natively, so the Lambda Web Adapter
+        # runs stream_server.py and streams its chunked http response
+        # through a function url
+        stream_handler = lambda_.Function(self, "LangChainStreamHandler",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            code=lambda_.Code.from_asset(os.path.join(bundle_dir, "dist/lambda.zip")),
+            handler="run.sh",
+            layers=[
+                lambda_.LayerVersion.from_layer_version_arn(
+                    self,
+                    "StreamSecretsExtensionLayer",
+                    layer_version_arn=secrets_extension_arn
+                ),
+                lambda_.LayerVersion.from_layer_version_arn(
+                    self,
+                    "WebAdapterLayer",
+                    layer_version_arn=web_adapter_arn
+                )
+            ],
+            timeout=Duration.minutes(5),
+            environment={
+                "AWS_LAMBDA_EXEC_WRAPPER": "/opt/bootstrap",
+                "AWS_LWA_INVOKE_MODE": "response_stream",
+                "PORT": "8080",
+                "TIKTOKEN_CACHE_DIR": "/var/task/tiktoken_cache",
+                **profile_environment(profile)
+            },
+            **function_settings(profile)
+        )
+        stream_target = live_target(self, "LangChainStreamHandlerLive", stream_handler, profile)
+        messages_table.grant_read_write_data(stream_handler)
+        cache_table.grant_read_write_data(stream_handler)
+        rate_limit_table.grant_read_write_data(stream_handler)
+        secret.grant_read(stream_handler)
+
+        stream_url = stream_target.add_function_url(
+            auth_type=lambda_.FunctionUrlAuthType.AWS_IAM,
+            invoke_mode=lambda_.InvokeMode.RESPONSE_STREAM
+        )
+        CfnOutput(self, "StreamUrl", value=stream_url.url)
+
         
 
         api = apigateway.RestApi(self, "langchain-api",
@@ -55,12 +235,18 @@ class LangChainApp(Stack):
                     },
                     "session_id": {
                         "type": apigateway.JsonSchemaType.STRING
+                    },
+                    "async": {
+                        "type": apigateway.JsonSchemaType.BOOLEAN
+                    },
+                    "cache": {
+                        "type": apigateway.JsonSchemaType.BOOLEAN
                     }
                 }
             }
         )
 
-        post_integration = apigateway.LambdaIntegration(handler)
+        post_integration = apigateway.LambdaIntegration(handler_target)
 
         api.root.add_method(
             "POST", 
@@ -76,6 +262,15 @@ class LangChainApp(Stack):
             }
         )
 
-app = App()
-LangChainApp(app, "LangChainApp")
-app.synth()
\ No newline at end of file
+        # Long-polled for the status and output of the jobs
+        job = api.root.add_resource("jobs").add_resource("{job_id}")
+        job.add_method(
+            "GET",
+            apigateway.LambdaIntegration(handler_target),
+            authorization_type=apigateway.AuthorizationType.IAM
+        )
+
+if __name__ == "__main__":
+    app = App()
+    LangChainApp(app, "LangChainApp")
+    app.synth()
\ No newline at end of file
@@ -2,11 +2,23 @@
 
 rm -rf dist
 
-pip install --platform manylinux2014_x86_64 --implementation cp --only-binary=:all: -r requirements.txt -t dist
+# packages for the architecture of the performance profile, see config.py
+ARCH=$(python -c "import config; print(config.config.PERFORMANCE_PROFILES[config.config.PERFORMANCE_PROFILE]['architecture'])")
+if [[ "$ARCH" == "arm64" ]]; then PLATFORM=manylinux2014_aarch64; else PLATFORM=manylinux2014_x86_64; fi
+pip install --platform $PLATFORM --implementation cp --only-binary=:all: -r requirements.txt -t dist
 # openai doesn't have a binary distribution, so need a separate install
 pip install -I openai -t dist 
 
 # remove extraneous bits from installed packages
 rm -r dist/*.dist-info
-cp config.py chain.py main.py dist/
+cp config.py secrets_provider.py http_client.py history.py sessions.py memory.py cache.py rate_limit.py tracing.py prompts.py router.py chain.py jobs.py warmup.py main.py stream_server.py run.sh dist/
+
+# bundle the tokenizer files, so they aren't downloaded on cold start
+TIKTOKEN_CACHE_DIR=dist/tiktoken_cache python -c "import tiktoken; tiktoken.encoding_for_model('gpt-3.5-turbo')"
+
+# ./bundle.sh --cold-start trims the bundle and precompiles it
+if [[ "$1" == "--cold-start" ]]; then
+    ./optimize_bundle.sh dist main "$ARCH"
+fi
+
 cd dist && zip -r lambda.zip *
\ No newline at end of file
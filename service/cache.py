@@ -0,0 +1,288 @@
+"""Response cache in front of the LLM chain.
+
+Entries are keyed on the hash of the context the response depends on
+(system prompt, model and the recent messages of the conversation) and
+the hash of the normalised prompt. A lookup tries, in order:
+
+1. an exact match in the in-process LRU of the Lambda container
+2. an exact match in the DynamoDB table shared by all containers
+3. when `RESPONSE_CACHE_SIMILARITY_THRESHOLD` is set, the most similar
+   prompt with the same context, comparing OpenAI embeddings
+
+Items in DynamoDB are partitioned by the context hash, so the similarity
+search only reads the entries that share the context of the request.
+"""
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import openai
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from openai.error import AuthenticationError, OpenAIError
+
+from history import get_table
+
+import config
+import tracing
+
+logger = logging.getLogger(__name__)
+
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "saved_ms": 0.0
+}
+
+_cache = None
+
+
+def normalize(prompt: str) -> str:
+    """Lowercases the prompt and drops punctuation and extra whitespace,
+    so trivially different prompts share an entry"""
+
+    return " ".join(re.sub(r"[^\w\s]", " ", prompt.lower()).split())
+
+
+def context_hash(system_prompt: str, model_name: str, messages: Iterable[Dict]) -> str:
+    """Hashes everything besides the prompt that the response depends on"""
+
+    context = {
+        "system": system_prompt,
+        "model": model_name,
+        "messages": [(m["type"], m["data"]["content"]) for m in messages]
+    }
+    return hashlib.sha256(json.dumps(context).encode()).hexdigest()
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(normalize(prompt).encode()).hexdigest()
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """Two tier cache of LLM responses, an in-process LRU with a TTL
+    in front of a DynamoDB table with the same TTL.
+
+    Args:
+        table_name: DynamoDB table with `ContextHash` as partition key,
+            `PromptHash` as sort key and TTL on `ExpiresAt`
+        ttl_seconds: how long an entry is served
+        max_entries: size of the in-process LRU
+        similarity_threshold: minimum cosine similarity of the prompt
+            embeddings for a similar prompt to be a hit, None disables
+            the similarity tier
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        ttl_seconds: int,
+        max_entries: int,
+        similarity_threshold: Optional[float] = None
+    ):
+        self.table = get_table(table_name)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+
+    def lookup(self, context: str, prompt: str, api_key: str) -> Tuple[Optional[Dict], str, Optional[List[float]]]:
+        """Looks up the response for the prompt in the context.
+
+        Returns:
+            The entry, or None on a miss, the tier that answered and the
+            prompt embedding, if one was computed, to store with the response
+        """
+
+        key = (context, prompt_hash(prompt))
+        entry = self._get_local(key)
+        if entry:
+            return entry, "memory", None
+
+        entry = self._get_shared(key)
+        if entry:
+            self._put_local(key, entry)
+            return entry, "dynamodb", None
+
+        if self.similarity_threshold is None:
+            return None, "", None
+
+        embedding = self.embed(prompt, api_key)
+        if embedding is None:
+            return None, "", None
+        entry = self._most_similar(context, embedding)
+        if entry:
+            self._put_local(key, entry)
+            return entry, "similar", embedding
+        return None, "", embedding
+
+    def store(
+        self,
+        context: str,
+        prompt: str,
+        response: str,
+        generation_ms: float,
+        embedding: Optional[List[float]] = None
+    ):
+        """Caches the response to the prompt in the context"""
+
+        key = (context, prompt_hash(prompt))
+        entry = {
+            "Response": response,
+            "GenerationMs": int(generation_ms),
+            "ExpiresAt": int(time.time()) + self.ttl_seconds
+        }
+        if embedding:
+            entry["Embedding"] = embedding
+        self._put_local(key, entry)
+
+        item = {
+            "ContextHash": key[0],
+            "PromptHash": key[1],
+            "Response": response,
+            "GenerationMs": entry["GenerationMs"],
+            "ExpiresAt": entry["ExpiresAt"]
+        }
+        if embedding:
+            item["Embedding"] = array("f", embedding).tobytes()
+        try:
+            self.table.put_item(Item=item)
+        except ClientError as err:
+            logger.warning("response cache write failed: %s", err)
+            tracing.add("cache_errors", 1)
+
+    def embed(self, prompt: str, api_key: str) -> Optional[List[float]]:
+        """Returns the embedding of the normalised prompt, or None if
+        the embeddings api fails, the request then goes to the LLM"""
+
+        try:
+            with tracing.span("embedding"):
+                response = openai.Embedding.create(
+                    input=[normalize(prompt)],
+                    model=config.config.EMBEDDING_MODEL_NAME,
+                    api_key=api_key
+                )
+        except AuthenticationError:
+            raise
+        except OpenAIError as err:
+            logger.warning("prompt embedding failed: %s", err)
+            tracing.add("cache_errors", 1)
+            return None
+        return response["data"][0]["embedding"]
+
+    def _get_local(self, key: Tuple[str, str]) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        if entry["ExpiresAt"] < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put_local(self, key: Tuple[str, str], entry: Dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_shared(self, key: Tuple[str, str]) -> Optional[Dict]:
+        try:
+            item = self.table.get_item(
+                Key={"ContextHash": key[0], "PromptHash": key[1]}
+            ).get("Item")
+        except ClientError as err:
+            logger.warning("response cache read failed: %s", err)
+            tracing.add("cache_errors", 1)
+            return None
+        # expired items are deleted by the table TTL, eventually
+        if not item or item["ExpiresAt"] < time.time():
+            return None
+        return self._entry(item)
+
+    def _most_similar(self, context: str, embedding: List[float]) -> Optional[Dict]:
+        """Returns the entry of the same context whose prompt is the
+        most similar, if it is above the threshold"""
+
+        candidates = [
+            entry for (entry_context, _), entry in self._entries.items()
+            if entry_context == context and "Embedding" in entry
+        ]
+        try:
+            response = self.table.query(
+                KeyConditionExpression=Key("ContextHash").eq(context),
+                Limit=config.config.RESPONSE_CACHE_SIMILARITY_CANDIDATES
+            )
+            candidates.extend(self._entry(item) for item in response["Items"] if "Embedding" in item)
+        except ClientError as err:
+            logger.warning("response cache read failed: %s", err)
+            tracing.add("cache_errors", 1)
+
+        now = time.time()
+        best, best_score = None, self.similarity_threshold
+        for entry in candidates:
+            if entry["ExpiresAt"] < now:
+                continue
+            score = cosine_similarity(embedding, entry["Embedding"])
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    @staticmethod
+    def _entry(item: Dict) -> Dict:
+        entry = {
+            "Response": item["Response"],
+            "GenerationMs": int(item.get("GenerationMs", 0)),
+            "ExpiresAt": int(item["ExpiresAt"])
+        }
+        if "Embedding" in item:
+            entry["Embedding"] = array("f", bytes(item["Embedding"])).tolist()
+        return entry
+
+
+def get_cache() -> ResponseCache:
+    """Returns the response cache, reused across warm invocations"""
+
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(
+            table_name=config.config.RESPONSE_CACHE_TABLE_NAME,
+            ttl_seconds=config.config.RESPONSE_CACHE_TTL_SECONDS,
+            max_entries=config.config.RESPONSE_CACHE_MAX_ENTRIES,
+            similarity_threshold=config.config.RESPONSE_CACHE_SIMILARITY_THRESHOLD
+        )
+    return _cache
+
+
+def record(hit: bool, tier: str = "", saved_ms: float = 0.0):
+    """Counts the lookup and records it in the trace of the request"""
+
+    if hit:
+        _stats["hits"] += 1
+        _stats["saved_ms"] += saved_ms
+        tracing.set_property("cache_tier", tier)
+        tracing.add("cache_saved_ms", saved_ms, "Milliseconds")
+    else:
+        _stats["misses"] += 1
+    tracing.add("cache_hit", int(hit))
+    tracing.debug(f"response cache: {_stats['hits']} hits, {_stats['misses']} misses, "
+                  f"{_stats['saved_ms']:.0f}ms saved in this container")
+
+
+def cache_stats() -> Dict:
+    """Returns the hit and miss counts of this container"""
+
+    lookups = _stats["hits"] + _stats["misses"]
+    return {**_stats, "hit_rate": _stats["hits"] / lookups if lookups else 0.0}
@@ -1,8 +1,13 @@
-from typing import Tuple
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from uuid import uuid4
 
-from langchain import ConversationChain
-from langchain.memory import ConversationBufferMemory, DynamoDBChatMessageHistory
+import openai
+from langchain import LLMChain
+from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.memory import ConversationBufferMemory
 from langchain.prompts import (
     ChatPromptTemplate, 
     MessagesPlaceholder, 
@@ -10,11 +15,138 @@ from langchain.prompts import (
     HumanMessagePromptTemplate
 )
 from langchain.chat_models import ChatOpenAI
-from langchain.schema import messages_to_dict
+from langchain.schema import LLMResult, messages_from_dict
 
+import cache
 import config
+import http_client
+import prompts
+import router
+import tracing
+from memory import DynamoDBMessageHistory, TokenBudgetMemory
+from sessions import SessionStore
 
-def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
+
+# compacted once, the same bytes start the prompt of every turn, see prompts.py
+SYSTEM_PROMPT = prompts.compact("The following is a friendly conversation between a human and an AI. The AI is talkative and provides lots of specific details from its context. If the AI does not know the answer to a question, it truthfully says it does not know.")
+
+# Shared with the openai client, keeps the connection to the
+# LLM endpoint alive across warm invocations
+openai.requestssession = http_client.pooled_session(
+    retries=http_client.retry_policy(
+        config.config.HTTP_RETRIES,
+        config.config.HTTP_BACKOFF_SECONDS,
+        status_forcelist=(),
+        read=False
+    )
+)
+
+# Immutable parts of the chain, built once per container
+_prompt_template = None
+_llms: Dict[Tuple, ChatOpenAI] = {}
+_routed_llms: Dict[Tuple[str, str], router.HedgedChatModel] = {}
+
+# Receives the tokens streamed for the current request
+_on_token: ContextVar[Optional[Callable[[str], None]]] = ContextVar("on_token", default=None)
+
+
+class TokenStreamHandler(StreamingStdOutCallbackHandler):
+    """Forwards the tokens streamed by the LLM to the callback of
+    the current request, so the streaming client can be shared"""
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        on_token = _on_token.get()
+        if on_token:
+            on_token(token)
+
+
+# Start of the LLM call in progress
+_llm_start: ContextVar[float] = ContextVar("llm_start", default=0.0)
+
+
+class UsageHandler(StreamingStdOutCallbackHandler):
+    """Records the time spent in the LLM and the tokens used
+    in the trace of the current request"""
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs) -> None:
+        _llm_start.set(time.perf_counter())
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        # streamed responses don't report the token usage
+        tracing.add("completion_tokens", 1)
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        tracing.add("llm_ms", (time.perf_counter() - _llm_start.get()) * 1000, "Milliseconds")
+        prompts.record_usage((response.llm_output or {}).get("token_usage", {}))
+
+
+_usage_handler = UsageHandler()
+_callbacks = CallbackManager([_usage_handler])
+_streaming_callbacks = CallbackManager([TokenStreamHandler(), _usage_handler])
+
+
+def get_prompt_template() -> ChatPromptTemplate:
+    """Returns the prompt template, building it on first use"""
+
+    global _prompt_template
+    if _prompt_template is None:
+        _prompt_template = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{input}")
+        ])
+    return _prompt_template
+
+
+def get_llm(api_key: str, **model_settings) -> ChatOpenAI:
+    """Returns the LLM client for the api key and model settings,
+    reusing the one built by a previous invocation if present"""
+
+    model_settings.setdefault("callback_manager", _callbacks)
+    key = (api_key, tuple(sorted(model_settings.items())))
+    if key not in _llms:
+        # api_key is passed on each call, as the openai module only
+        # holds the key of the last client that was built
+        _llms[key] = ChatOpenAI(
+            openai_api_key=api_key,
+            model_kwargs={"api_key": api_key},
+            **model_settings
+        )
+    return _llms[key]
+
+
+def get_routed_llm(api_key: str, route: str) -> router.HedgedChatModel:
+    """Returns the model of the route, backed up by the model of
+    its fallback route, reusing the clients of the container"""
+
+    key = (api_key, route)
+    if key not in _routed_llms:
+        fallback = config.config.ROUTE_FALLBACKS.get(route)
+        _routed_llms[key] = router.HedgedChatModel(
+            route=route,
+            model=get_llm(api_key, **config.config.MODEL_ROUTES[route]),
+            fallback=get_llm(api_key, **config.config.MODEL_ROUTES[fallback]) if fallback else None,
+            fallback_route=fallback or "",
+            callback_manager=_callbacks
+        )
+    return _routed_llms[key]
+
+
+def run(
+    api_key: str,
+    session_id: str,
+    prompt: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    use_cache: bool = True
+) -> Tuple[str, str]:
     """This is the main function that executes the prediction chain.
     Updating this code will change the predictions of the service.
     Current implementation creates a new session id for each run, client
@@ -25,6 +157,10 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
         api_key: api key for the LLM service, OpenAI used here
         session_id: session id from the previous execution run, pass blank for first execution
         prompt: prompt question entered by the user
+        on_token: called with each token as the LLM generates the response,
+            the response is streamed from the LLM when set
+        use_cache: whether the response can be served from, and is
+            saved to, the response cache
 
     Returns:
         The prediction from LLM
@@ -33,48 +169,126 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
     if not session_id:
         session_id = str(uuid4())
     
-    chat_memory = DynamoDBChatMessageHistory(
-        table_name=config.config.DYNAMODB_TABLE_NAME,
+    session = SessionStore(
+        table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
         session_id=session_id
     )
-    messages = chat_memory.messages
 
     # Maintains immutable sessions
-    # If previous session was present, create
-    # a new session and copy messages, and 
-    # generate a new session_id 
-    if messages:
-        session_id = str(uuid4())
-        chat_memory = DynamoDBChatMessageHistory(
-            table_name=config.config.DYNAMODB_TABLE_NAME,
-            session_id=session_id
-        )
-        # This is a workaround at the moment. Ideally, this should
-        # be added to the DynamoDBChatMessageHistory class
-        try:
-            messages = messages_to_dict(messages)
-            chat_memory.table.put_item(
-                Item={"SessionId": session_id, "History": messages}
-            )
-        except Exception as e:
-            print(e)
-    
-    memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)
+    # If previous session was present, create a new
+    # session that points to it, so the history is
+    # shared instead of copied
+    with tracing.span("session"):
+        if session.exists():
+            session = session.fork()
+    session_id = session.session_id
+
+    chat_memory = DynamoDBMessageHistory(
+        store=session,
+        window=config.config.HISTORY_READ_LIMIT
+    )
     
-    prompt_template = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template("The following is a friendly conversation between a human and an AI. The AI is talkative and provides lots of specific details from its context. If the AI does not know the answer to a question, it truthfully says it does not know."),
-        MessagesPlaceholder(variable_name="history"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
+    if config.config.MEMORY_MAX_TOKENS:
+        memory = TokenBudgetMemory(
+            chat_memory=chat_memory,
+            llm=get_llm(api_key, model_name=config.config.MODEL_NAME, temperature=0),
+            max_token_limit=config.config.MEMORY_MAX_TOKENS,
+            keep_token_limit=config.config.MEMORY_KEEP_TOKENS,
+            model_name=config.config.MODEL_NAME
+        )
+    else:
+        memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)
     
-    llm = ChatOpenAI(temperature=0, openai_api_key=api_key)
-    conversation = ConversationChain(
-        llm=llm, 
-        prompt=prompt_template,
-        verbose=True, 
-        memory=memory
-    )
-    response = conversation.predict(input=prompt)
+    # read once, for the context of the cache and the prompt
+    with tracing.span("history_read"):
+        summary = session.summary() if config.config.MEMORY_MAX_TOKENS else {}
+        # the older messages are in the summary already
+        items = session.message_items(limit=config.config.HISTORY_READ_LIMIT, after=summary.get("Through"))
+
+    use_cache = use_cache and config.config.RESPONSE_CACHE_ENABLED
+    if use_cache:
+        start = time.perf_counter()
+        with tracing.span("cache_lookup"):
+            context = cache.context_hash(
+                SYSTEM_PROMPT,
+                config.config.MODEL_NAME,
+                [item["Message"] for item in items[-config.config.RESPONSE_CACHE_CONTEXT_MESSAGES:]]
+            )
+            entry, tier, embedding = cache.get_cache().lookup(context, prompt, api_key)
+        if entry:
+            response = entry["Response"]
+            memory.save_context({"input": prompt}, {"response": response})
+            if on_token:
+                on_token(response)
+            lookup_ms = (time.perf_counter() - start) * 1000
+            cache.record(hit=True, tier=tier, saved_ms=max(entry["GenerationMs"] - lookup_ms, 0))
+            return response, session_id
+        cache.record(hit=False)
+
+    if config.config.MEMORY_MAX_TOKENS:
+        variables = memory.memory_variables_from(items, summary)
+    else:
+        variables = {"history": messages_from_dict([item["Message"] for item in items])}
+
+    route, reason = router.classify(prompt, history_messages=session.offset)
+    tracing.set_property("route", route)
+    tracing.set_property("route_reason", reason)
+
+    built = len(_llms)
+    with tracing.span("chain_build"):
+        if on_token:
+            # tokens of two streams can't be mixed, streamed replies aren't hedged
+            llm = get_llm(
+                api_key,
+                streaming=True,
+                callback_manager=_streaming_callbacks,
+                **config.config.MODEL_ROUTES[route]
+            )
+        else:
+            llm = get_routed_llm(api_key, route)
+        # the memory is loaded already, it only saves the turn
+        conversation = LLMChain(
+            llm=llm, 
+            prompt=get_prompt_template(),
+            verbose=config.config.DEBUG
+        )
+    tracing.set_property("llm_client", "built" if len(_llms) > built else "reused")
+
+    start = time.perf_counter()
+    if on_token:
+        token = _on_token.set(_first_token_timer(on_token))
+        try:
+            response = conversation.predict(input=prompt, **variables)
+        finally:
+            _on_token.reset(token)
+    else:
+        response = conversation.predict(input=prompt, **variables)
+    memory.save_context({"input": prompt}, {"response": response})
+    # the summary ahead of the history, as read or rewritten by the memory
+    prompts.record_prefix(SYSTEM_PROMPT, session.summary().get("Summary", "") if config.config.MEMORY_MAX_TOKENS else "")
+
+    if use_cache:
+        generation_ms = (time.perf_counter() - start) * 1000
+        cache.get_cache().store(context, prompt, response, generation_ms, embedding)
+
+    stats = http_client.connection_stats()
+    tracing.debug(f"llm connections: {stats['connections']} opened for {stats['requests']} requests, "
+                  f"reuse rate {stats['reuse_rate']:.0%}")
     
     return response, session_id
 
+
+def _first_token_timer(on_token: Callable[[str], None]) -> Callable[[str], None]:
+    """Wraps the token callback to record the time to first token"""
+
+    start = time.perf_counter()
+    first = True
+
+    def timed_on_token(token: str):
+        nonlocal first
+        if first and token:
+            first = False
+            tracing.add("time_to_first_token_ms", (time.perf_counter() - start) * 1000, "Milliseconds")
+        on_token(token)
+
+    return timed_on_token
@@ -1,4 +1,5 @@
 
+import os
 from dataclasses import dataclass
 import boto3
 
@@ -12,9 +13,199 @@ class Config:
     # See https://docs.aws.amazon.com/systems-manager/latest/userguide/ps-integration-lambda-extensions.html#ps-integration-lambda-extensions-add
     # for extension arn in other regions
     SECRETS_EXTENSION_ARN = 'arn:aws:lambda:us-east-1:177933569100:layer:AWS-Parameters-and-Secrets-Lambda-Extension:4'
+    SECRETS_EXTENSION_ARM64_ARN = 'arn:aws:lambda:us-east-1:177933569100:layer:AWS-Parameters-and-Secrets-Lambda-Extension-Arm64:4'
+
+    # Runs the streaming http server in the lambda, see stream_server.py
+    # See https://github.com/awslabs/aws-lambda-web-adapter for the arn in other regions
+    LAMBDA_WEB_ADAPTER_ARN = 'arn:aws:lambda:us-east-1:753240598075:layer:LambdaAdapterLayerX86:17'
+    LAMBDA_WEB_ADAPTER_ARM64_ARN = 'arn:aws:lambda:us-east-1:753240598075:layer:LambdaAdapterLayerArm64:17'
+
+    # Local endpoint served by the secrets extension
+    SECRETS_EXTENSION_ENDPOINT = "http://localhost:2773"
+
+    # How long a warm container reuses the decoded secret before fetching it again.
+    # The extension keeps its own cache (SECRETS_MANAGER_TTL, 300 seconds by default),
+    # so a rotated secret is picked up within the sum of both TTLs, or on the
+    # next auth failure which forces a refresh
+    SECRETS_CACHE_TTL_SECONDS = 300
+
+    # Outbound http calls share pooled keep-alive sessions, see http_client.py.
+    # Failed calls are retried HTTP_RETRIES times, with a jittered exponential
+    # backoff starting at HTTP_BACKOFF_SECONDS. Calls to the LLM are only retried
+    # when the connection fails, the chain retries the others
+    HTTP_RETRIES = 2
+    HTTP_BACKOFF_SECONDS = 0.1
+
+    # (connect, read) timeouts of the calls to the secrets extension, in seconds
+    SECRETS_EXTENSION_TIMEOUT = (1, 5)
 
     # Dynamo db table that stores the conversation history
+    # as one item per message
+    DYNAMODB_MESSAGES_TABLE_NAME = "conversation-message-store"
+
+    # Legacy table that stores the whole history of a session in one
+    # item, see migrate_history.py to move it to the messages table
     DYNAMODB_TABLE_NAME = "conversation-history-store"
 
+    # Chat model of the summaries and the tokenizer, the replies
+    # are generated by the model of the route of the turn
+    MODEL_NAME = "gpt-3.5-turbo"
+
+    # Models the turns are routed to, with the settings of their client.
+    # request_timeout is in seconds, a timed out call is retried max_retries times
+    MODEL_ROUTES = {
+        "fast": {"model_name": "gpt-3.5-turbo", "temperature": 0, "request_timeout": 30, "max_retries": 1},
+        "large": {"model_name": "gpt-4", "temperature": 0, "request_timeout": 90, "max_retries": 1}
+    }
+
+    # Route of the simple turns, and of the hard ones
+    ROUTE_SIMPLE = "fast"
+    ROUTE_HARD = "large"
+
+    # Route a route falls back to when its model fails or, with hedging,
+    # is slower than usual. Routes without a fallback wait for their model
+    ROUTE_FALLBACKS = {"fast": "large", "large": "fast"}
+
+    # A turn is hard when the prompt is longer than ROUTER_HARD_PROMPT_CHARS,
+    # the conversation has more than ROUTER_HARD_HISTORY_MESSAGES messages,
+    # or the prompt has one of the keywords
+    ROUTER_HARD_PROMPT_CHARS = 500
+    ROUTER_HARD_HISTORY_MESSAGES = 40
+    ROUTER_HARD_KEYWORDS = ("explain", "step by step", "code", "debug", "compare", "analyse", "analyze", "why")
+
+    # Sends the request to the fallback model too when the model hasn't answered
+    # within the ROUTER_HEDGE_PERCENTILE of its last ROUTER_LATENCY_WINDOW calls
+    # in the container, or within ROUTER_HEDGE_DEFAULT_SECONDS until it has made
+    # ROUTER_HEDGE_MIN_SAMPLES calls. Set to False to only fall back on errors
+    ROUTER_HEDGE_ENABLED = True
+    ROUTER_HEDGE_PERCENTILE = 95
+    ROUTER_LATENCY_WINDOW = 200
+    ROUTER_HEDGE_MIN_SAMPLES = 20
+    ROUTER_HEDGE_DEFAULT_SECONDS = 10.0
+
+    # Number of recent messages loaded into the prompt
+    HISTORY_READ_LIMIT = 100
+
+    # Token budget for the history in the prompt, the recent messages
+    # that fit are sent as is and older ones are folded into a rolling
+    # summary. Set to None to send all the messages read from the history
+    MEMORY_MAX_TOKENS = 2000
+
+    # Once over MEMORY_MAX_TOKENS, messages are folded into the summary
+    # until the rest fits in MEMORY_KEEP_TOKENS, so the summary and the
+    # prefix of the prompt only change every few turns
+    MEMORY_KEEP_TOKENS = 1200
+
+    # Each turn creates a session that points to the previous one,
+    # sessions deeper than this are compacted into a new root session
+    MAX_SESSION_DEPTH = 25
+
+    # Caches the responses to repeated prompts, see cache.py. Requests
+    # can bypass the cache with `"cache": false` in the payload
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_TABLE_NAME = "langchain-response-cache"
+    RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+    # Number of responses kept in memory by each Lambda container
+    RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+    # Number of recent messages of the conversation that must match
+    # for a cached response to be used
+    RESPONSE_CACHE_CONTEXT_MESSAGES = 4
+
+    # Minimum cosine similarity of the prompt embeddings for a response
+    # to a different prompt to be used, e.g. 0.95. None, the default,
+    # only uses exact matches; when set, each miss costs one embeddings
+    # request and a similar prompt may get an answer to another question
+    RESPONSE_CACHE_SIMILARITY_THRESHOLD = None
+
+    # Maximum number of cached prompts of the same context compared
+    # with the prompt of a request
+    RESPONSE_CACHE_SIMILARITY_CANDIDATES = 50
+
+    # Embeddings model used for the similarity of the prompts
+    EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
+
+    # Token bucket rate limit of the LLM calls, per IAM principal of the
+    # caller, or per session when there is none, see rate_limit.py. Up to
+    # RATE_LIMIT_CAPACITY requests in a burst, refilled with
+    # RATE_LIMIT_PER_MINUTE a minute. Requests over the limit get a 429
+    # with a Retry-After. Set RATE_LIMIT_CAPACITY to 0 to disable
+    RATE_LIMIT_TABLE_NAME = "langchain-rate-limits"
+    RATE_LIMIT_CAPACITY = 20
+    RATE_LIMIT_PER_MINUTE = 30
+
+    # Generations longer than the 29 seconds the api waits for can run as
+    # background jobs, see jobs.py. A POST with `"async": true` queues a job
+    # and returns its id, `GET /jobs/{job_id}` returns its status and output
+    JOBS_TABLE_NAME = "langchain-jobs"
+    JOBS_QUEUE_NAME = "langchain-jobs"
+
+    # How long jobs and their responses are kept
+    JOB_TTL_SECONDS = 24 * 60 * 60
+
+    # A running job can be taken over by a redelivery after this, longer
+    # than the timeout of the job worker
+    JOB_LEASE_SECONDS = 6 * 60
+
+    # How often the output of a running job is saved as it is generated
+    JOB_OUTPUT_FLUSH_SECONDS = 1.0
+
+    # `GET /jobs/{job_id}?wait=<seconds>` waits for the job to finish, or
+    # its output to grow, for at most JOB_MAX_WAIT_SECONDS, below the api timeout
+    JOB_MAX_WAIT_SECONDS = 20
+    JOB_POLL_INTERVAL_SECONDS = 0.5
+
+    # Logs the full events, prompts and chain steps when the DEBUG
+    # environment variable of the lambda is set to true
+    DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
+
+    # CloudWatch namespace of the metrics logged by tracing.py
+    METRICS_NAMESPACE = "LangChainService"
+
+    # Performance profile the lambdas are deployed with, one of PERFORMANCE_PROFILES.
+    # Pick it at deploy time with `PERFORMANCE_PROFILE=interactive ./bundle.sh && cdk deploy`
+    PERFORMANCE_PROFILE = os.environ.get("PERFORMANCE_PROFILE", "default")
+
+    # memory_size: MB, CPU is allocated in proportion, None keeps the lambda default
+    # architecture: "x86_64" or "arm64" (Graviton), bundle.sh builds the packages for it
+    # provisioned_concurrency: execution environments kept initialised behind the
+    #     `live` alias, which the api and the function url then point to
+    # scaling: scales the provisioned concurrency on the utilization of the
+    #     provisioned environments, within ranges applied on a schedule (UTC)
+    # warmup: runs warmup.py in the init phase, before the first request
+    PERFORMANCE_PROFILES = {
+        "default": {
+            "memory_size": None,
+            "architecture": "x86_64",
+            "provisioned_concurrency": 0,
+            "scaling": None,
+            "warmup": False
+        },
+        "economy": {
+            "memory_size": 1024,
+            "architecture": "arm64",
+            "provisioned_concurrency": 0,
+            "scaling": None,
+            "warmup": True
+        },
+        "interactive": {
+            # a full vCPU
+            "memory_size": 1769,
+            "architecture": "arm64",
+            "provisioned_concurrency": 2,
+            "scaling": {
+                "utilization": 0.7,
+                "schedules": [
+                    {"name": "working-hours", "cron": "cron(0 7 ? * MON-FRI *)", "min": 2, "max": 10},
+                    {"name": "off-hours", "cron": "cron(0 19 ? * MON-FRI *)", "min": 1, "max": 3}
+                ]
+            },
+            "warmup": True
+        }
+    }
+
+    # Set by the stack from the warmup setting of the profile
+    WARMUP = os.environ.get("WARMUP", "false").lower() == "true"
 
 config = Config()
\ No newline at end of file
@@ -0,0 +1,347 @@
+import logging
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Sort key prefix of the message items, keeps them apart
+# from any other item stored under the session
+MESSAGE_PREFIX = "MSG#"
+
+# Upper bound of the message sort keys, sorts after the digits of
+# the message ids and before the other items of the session
+MESSAGE_END = MESSAGE_PREFIX + "~"
+
+# Sort key of the rolling summary of the older messages
+SUMMARY_KEY = "SUMMARY"
+
+# Sort key of the item that marks a session as having a history
+HEADER_KEY = "SESSION"
+
+# Attribute of the message in its compact form, see `encode_message`.
+# Items written before it have the langchain form in `Message`
+COMPACT_ATTRIBUTE = "M"
+
+# Short codes of the message types of langchain
+TYPE_CODES = {"human": "h", "ai": "a", "system": "s", "chat": "c"}
+TYPES = {code: message_type for message_type, code in TYPE_CODES.items()}
+
+# Contents longer than this are stored compressed, when that makes them smaller
+COMPRESS_MIN_BYTES = 1024
+
+_tables = {}
+
+
+def get_table(table_name: str):
+    """Returns the DynamoDB table, reusing the resource across warm invocations"""
+
+    if table_name not in _tables:
+        _tables[table_name] = boto3.resource("dynamodb").Table(table_name)
+    return _tables[table_name]
+
+
+def new_message_id(timestamp_ns: Optional[int] = None) -> str:
+    """Returns a sort key that orders messages by the time they were written"""
+
+    if timestamp_ns is None:
+        timestamp_ns = time.time_ns()
+    return f"{MESSAGE_PREFIX}{timestamp_ns:020d}#{uuid4().hex[:8]}"
+
+
+def human_message(content: str) -> Dict:
+    """Returns a human message in the format of langchain's `messages_to_dict`"""
+
+    return {"type": "human", "data": {"content": content, "additional_kwargs": {}}}
+
+
+def encode_message(message: Dict) -> Dict:
+    """Returns the compact form of a message in the format of langchain's
+    `messages_to_dict`: a short type code and only the fields that are
+    set, with a long content compressed with zlib"""
+
+    data = message["data"]
+    encoded = {"t": TYPE_CODES.get(message["type"], message["type"])}
+    content = data.get("content", "")
+    raw = content.encode()
+    compressed = zlib.compress(raw) if len(raw) > COMPRESS_MIN_BYTES else raw
+    if len(compressed) < len(raw):
+        encoded["z"] = Binary(compressed)
+    elif content:
+        encoded["c"] = content
+    if data.get("additional_kwargs"):
+        encoded["k"] = data["additional_kwargs"]
+    if data.get("role"):
+        encoded["r"] = data["role"]
+    return encoded
+
+
+def decode_message(encoded: Dict) -> Dict:
+    """Returns the message of `encode_message` in the format of langchain's `messages_to_dict`"""
+
+    if "z" in encoded:
+        compressed = encoded["z"]
+        content = zlib.decompress(compressed.value if isinstance(compressed, Binary) else compressed).decode()
+    else:
+        content = encoded.get("c", "")
+    data = {"content": content, "additional_kwargs": encoded.get("k", {})}
+    if "r" in encoded:
+        data["role"] = encoded["r"]
+    return {"type": TYPES.get(encoded["t"], encoded["t"]), "data": data}
+
+
+def decode_item(item: Dict) -> Dict:
+    """Puts the message of an item read from the table in `Message`,
+    in the format of langchain's `messages_to_dict`"""
+
+    if COMPACT_ATTRIBUTE in item:
+        item["Message"] = decode_message(item.pop(COMPACT_ATTRIBUTE))
+    return item
+
+
+def item_size(value: Any) -> int:
+    """Approximate size in bytes of an attribute value as DynamoDB counts it"""
+
+    if isinstance(value, dict):
+        return 3 + sum(len(name.encode()) + 1 + item_size(v) for name, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(1 + item_size(v) for v in value)
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float)):
+        return len(str(value)) // 2 + 1
+    return len(str(value).encode())
+
+
+def record_write(message: Dict, encoded: Dict) -> None:
+    """Records the size of a written message in the trace of the
+    request, and the bytes saved by its compact form"""
+
+    size = item_size({COMPACT_ATTRIBUTE: encoded})
+    tracing.add("history_write_bytes", size, "Bytes")
+    tracing.add("history_bytes_saved", item_size({"Message": message}) - size, "Bytes")
+
+
+def message_range(after: Optional[str] = None):
+    """Key condition on the sort key that selects the messages of a
+    session, or only the ones newer than `after`"""
+
+    if after:
+        # inclusive, the caller drops the message `after` itself
+        return Key("MessageId").between(after, MESSAGE_END)
+    return Key("MessageId").begins_with(MESSAGE_PREFIX)
+
+
+def record_read(response: Dict) -> None:
+    """Records the items and the capacity a read consumed in the trace
+    of the request, the capacity is only returned when requested with
+    `ReturnConsumedCapacity`"""
+
+    tracing.add("history_read_items", response.get("Count", 0))
+    tracing.add("history_read_units", response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+
+
+class MessageStore:
+    """Conversation history stored as one DynamoDB item per message,
+    under the session partition key and sorted by `MessageId`.
+    Appending a message is a single `put_item`, independent of the
+    history size, and concurrent writers don't overwrite each other.
+
+    Messages are plain dicts in the format of langchain's
+    `messages_to_dict`, so the store can be used without langchain.
+    They are stored in the compact form of `encode_message`.
+
+    Args:
+        table_name: name of the DynamoDB table, with `SessionId` as
+            partition key and `MessageId` as sort key
+        session_id: key of the conversation
+    """
+
+    def __init__(self, table_name: str, session_id: str):
+        self.table = get_table(table_name)
+        self.session_id = session_id
+
+    def messages(self, limit: Optional[int] = None) -> List[Dict]:
+        """Returns the most recent messages, oldest first
+
+        Args:
+            limit: maximum number of messages to read, reads all when None
+        """
+
+        return [item["Message"] for item in self.message_items(limit)]
+
+    def message_items(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[Dict]:
+        """Returns the items of the most recent messages, oldest first,
+        with the `MessageId` of each message next to the `Message`
+
+        Args:
+            limit: maximum number of messages to read, reads all when None
+            after: only reads the messages newer than this `MessageId`,
+                usually the newest message of the summary
+        """
+
+        query = {
+            "KeyConditionExpression": Key("SessionId").eq(self.session_id) & message_range(after),
+            "ProjectionExpression": "MessageId, #message, #compact",
+            "ExpressionAttributeNames": {"#message": "Message", "#compact": COMPACT_ATTRIBUTE},
+            "ScanIndexForward": False,
+            "ReturnConsumedCapacity": "TOTAL"
+        }
+        items = []
+        try:
+            while limit is None or len(items) < limit:
+                if limit is not None:
+                    query["Limit"] = limit - len(items)
+                response = self.table.query(**query)
+                record_read(response)
+                items.extend(decode_item(item) for item in response["Items"] if item["MessageId"] != after)
+                if "LastEvaluatedKey" not in response:
+                    break
+                query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as err:
+            logger.error(err)
+
+        items.reverse()
+        return items
+
+    def append(self, message: Dict) -> None:
+        """Writes the message as a new item"""
+
+        encoded = encode_message(message)
+        try:
+            self.table.put_item(Item={
+                "SessionId": self.session_id,
+                "MessageId": new_message_id(),
+                COMPACT_ATTRIBUTE: encoded
+            })
+        except ClientError as err:
+            logger.error(err)
+            return
+        record_write(message, encoded)
+
+    def append_if_exists(self, message: Dict) -> bool:
+        """Writes the message only when the session has a history. The
+        header item is checked in the same request as the write, so
+        there is no read before the write.
+
+        Returns:
+            True when the message was written
+        """
+
+        encoded = encode_message(message)
+        # the client of the table resource takes python types, like the table
+        try:
+            self.table.meta.client.transact_write_items(TransactItems=[
+                {
+                    "ConditionCheck": {
+                        "TableName": self.table.name,
+                        "Key": {"SessionId": self.session_id, "MessageId": HEADER_KEY},
+                        "ConditionExpression": "attribute_exists(SessionId)"
+                    }
+                },
+                {
+                    "Put": {
+                        "TableName": self.table.name,
+                        "Item": {
+                            "SessionId": self.session_id,
+                            "MessageId": new_message_id(),
+                            COMPACT_ATTRIBUTE: encoded
+                        }
+                    }
+                }
+            ])
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "TransactionCanceledException":
+                logger.error(err)
+            return False
+        record_write(message, encoded)
+        return True
+
+    def create_header(self) -> None:
+        """Marks the session as having a history, keeping the
+        attributes of the header if it exists already"""
+
+        try:
+            self.table.update_item(
+                Key={"SessionId": self.session_id, "MessageId": HEADER_KEY},
+                UpdateExpression="SET CreatedAt = if_not_exists(CreatedAt, :now)",
+                ExpressionAttributeValues={":now": int(time.time())}
+            )
+        except ClientError as err:
+            logger.error(err)
+
+    def extend(self, messages: Iterable[Dict], message_ids: Optional[Iterable[str]] = None) -> None:
+        """Writes the messages in batches, keeping their order"""
+
+        messages = list(messages)
+        if message_ids is None:
+            start = time.time_ns()
+            message_ids = [new_message_id(start + i) for i in range(len(messages))]
+
+        with self.table.batch_writer() as batch:
+            for message_id, message in zip(message_ids, messages):
+                batch.put_item(Item={
+                    "SessionId": self.session_id,
+                    "MessageId": message_id,
+                    COMPACT_ATTRIBUTE: encode_message(message)
+                })
+
+    def summary(self) -> Dict:
+        """Returns the rolling summary of the older messages, with the
+        `Summary` text and the `MessageId` of the newest message it covers
+        in `Through`, or an empty dict if there is no summary yet"""
+
+        try:
+            response = self.table.get_item(
+                Key={"SessionId": self.session_id, "MessageId": SUMMARY_KEY}
+            )
+        except ClientError as err:
+            logger.error(err)
+            return {}
+        return response.get("Item", {})
+
+    def save_summary(self, summary: str, through: str) -> None:
+        """Stores the rolling summary next to the messages
+
+        Args:
+            summary: summary text
+            through: `MessageId` of the newest message in the summary
+        """
+
+        try:
+            self.table.put_item(Item={
+                "SessionId": self.session_id,
+                "MessageId": SUMMARY_KEY,
+                "Summary": summary,
+                "Through": through
+            })
+        except ClientError as err:
+            logger.error(err)
+
+    def clear(self) -> None:
+        """Deletes all the items of the session"""
+
+        query = {
+            "KeyConditionExpression": Key("SessionId").eq(self.session_id),
+            "ProjectionExpression": "SessionId, MessageId"
+        }
+        with self.table.batch_writer() as batch:
+            while True:
+                response = self.table.query(**query)
+                for item in response["Items"]:
+                    batch.delete_item(Key=item)
+                if "LastEvaluatedKey" not in response:
+                    break
+                query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
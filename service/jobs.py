@@ -0,0 +1,186 @@
+"""Background jobs for generations that take longer than the 29 seconds
+API Gateway waits for a response.
+
+A POST with `"async": true` saves a pending job and queues it, and
+returns the job id right away. The job worker (`main.job_handler`)
+runs the chain with the Lambda timeout, saving the output to the job
+as it is generated, and the client long-polls `GET /jobs/{job_id}`
+until the job is completed or failed. Jobs expire with the table TTL.
+"""
+import json
+import time
+from typing import Dict, Optional
+from uuid import uuid4
+
+import boto3
+from botocore.exceptions import ClientError
+
+from history import get_table
+
+import config
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+
+# created once per container and reused by warm invocations
+sqs = boto3.client("sqs")
+_queue_url = None
+
+
+def get_queue_url() -> str:
+    """Returns the url of the jobs queue, looked up on first use"""
+
+    global _queue_url
+    if _queue_url is None:
+        _queue_url = sqs.get_queue_url(QueueName=config.config.JOBS_QUEUE_NAME)["QueueUrl"]
+    return _queue_url
+
+
+def submit(prompt: str, session_id: str, use_cache: bool = True) -> str:
+    """Saves a pending job for the prompt and queues it for the worker
+
+    Returns:
+        The id of the job
+    """
+
+    job_id = uuid4().hex
+    now = int(time.time())
+    get_table(config.config.JOBS_TABLE_NAME).put_item(Item={
+        "JobId": job_id,
+        "Status": PENDING,
+        "CreatedAt": now,
+        "ExpiresAt": now + config.config.JOB_TTL_SECONDS
+    })
+    sqs.send_message(
+        QueueUrl=get_queue_url(),
+        MessageBody=json.dumps({
+            "job_id": job_id,
+            "prompt": prompt,
+            "session_id": session_id,
+            "cache": use_cache
+        })
+    )
+    return job_id
+
+
+def get(job_id: str, wait_seconds: float = 0, after: int = 0) -> Optional[Dict]:
+    """Returns the job, waiting up to `wait_seconds` for it to finish or
+    for its output to grow past `after` characters.
+
+    Returns:
+        The status of the job, its output so far, and the response and
+        session id once completed, or None when there is no such job
+    """
+
+    deadline = time.monotonic() + wait_seconds
+    table = get_table(config.config.JOBS_TABLE_NAME)
+    while True:
+        item = table.get_item(Key={"JobId": job_id}, ConsistentRead=True).get("Item")
+        if item is None:
+            return None
+        done = item["Status"] in (COMPLETED, FAILED)
+        if done or len(item.get("Output", "")) > after or time.monotonic() >= deadline:
+            return _job(item)
+        time.sleep(config.config.JOB_POLL_INTERVAL_SECONDS)
+
+
+def start(job_id: str) -> bool:
+    """Claims the job for the worker. A running job can be taken over
+    once its lease has expired, its worker stopped before finishing.
+
+    Returns:
+        False when the job is done or running in another worker
+    """
+
+    now = int(time.time())
+    try:
+        get_table(config.config.JOBS_TABLE_NAME).update_item(
+            Key={"JobId": job_id},
+            UpdateExpression="SET #status = :running, LeaseUntil = :lease_until REMOVE #output",
+            ConditionExpression="#status = :pending OR (#status = :running AND LeaseUntil < :now)",
+            ExpressionAttributeNames={"#status": "Status", "#output": "Output"},
+            ExpressionAttributeValues={
+                ":running": RUNNING,
+                ":pending": PENDING,
+                ":now": now,
+                ":lease_until": now + config.config.JOB_LEASE_SECONDS
+            }
+        )
+        return True
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+    return False
+
+
+def complete(job_id: str, response: str, session_id: str):
+    """Saves the response of the job and the session id of the next turn"""
+
+    get_table(config.config.JOBS_TABLE_NAME).update_item(
+        Key={"JobId": job_id},
+        UpdateExpression="SET #status = :completed, #output = :response, #response = :response, "
+                         "SessionId = :session_id REMOVE LeaseUntil",
+        ExpressionAttributeNames={"#status": "Status", "#output": "Output", "#response": "Response"},
+        ExpressionAttributeValues={":completed": COMPLETED, ":response": response, ":session_id": session_id}
+    )
+
+
+def fail(job_id: str, message: str):
+    """Marks the job as failed, it isn't retried"""
+
+    get_table(config.config.JOBS_TABLE_NAME).update_item(
+        Key={"JobId": job_id},
+        UpdateExpression="SET #status = :failed, #error = :message REMOVE LeaseUntil",
+        ExpressionAttributeNames={"#status": "Status", "#error": "Error"},
+        ExpressionAttributeValues={":failed": FAILED, ":message": message}
+    )
+
+
+class JobOutput:
+    """Collects the tokens of a running job, saving the output to
+    the job at most every `JOB_OUTPUT_FLUSH_SECONDS`
+
+    Args:
+        job_id: id of the running job
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.text = ""
+        self._flushed_at = time.monotonic()
+
+    def add(self, token: str):
+        self.text += token
+        if time.monotonic() - self._flushed_at >= config.config.JOB_OUTPUT_FLUSH_SECONDS:
+            self.flush()
+
+    def reset(self):
+        """Drops the output, when the generation is restarted"""
+
+        self.text = ""
+        self.flush()
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        get_table(config.config.JOBS_TABLE_NAME).update_item(
+            Key={"JobId": self.job_id},
+            UpdateExpression="SET #output = :output",
+            ExpressionAttributeNames={"#output": "Output"},
+            ExpressionAttributeValues={":output": self.text}
+        )
+
+
+def _job(item: Dict) -> Dict:
+    job = {
+        "job_id": item["JobId"],
+        "status": item["Status"].lower(),
+        "output": item.get("Output", "")
+    }
+    if item["Status"] == COMPLETED:
+        job["response"] = item["Response"]
+        job["session_id"] = item["SessionId"]
+    elif item["Status"] == FAILED:
+        job["message"] = item["Error"]
+    return job
@@ -1,32 +1,86 @@
 import json
-import os
-from typing import Dict
+import math
+from typing import Dict, Optional
 
-import requests
+from openai.error import AuthenticationError
 
 import chain
 import config
+import jobs
+import rate_limit
+import secrets_provider
+import tracing
+import warmup
+from sessions import SessionStore
+
+# Shared by the warm invocations, keeps the buckets used by the container
+limiter = rate_limit.TokenBucket(
+    config.config.RATE_LIMIT_TABLE_NAME,
+    config.config.RATE_LIMIT_CAPACITY,
+    config.config.RATE_LIMIT_PER_MINUTE / 60
+) if config.config.RATE_LIMIT_CAPACITY else None
 
 
 def handler(event, context): 
-    print(f"event is {event}")
-    body = json.loads(event["body"])
-    
+    with tracing.trace("main"):
+        tracing.debug(f"event is {event}")
+        if event.get("resource") == "/jobs/{job_id}":
+            response = get_job(event["pathParameters"]["job_id"], event.get("queryStringParameters") or {})
+        else:
+            tracing.add("request_bytes", len(event["body"]), "Bytes")
+            response = handle(json.loads(event["body"]), principal=get_principal(event),
+                              source_ip=get_source_ip(event))
+        tracing.add("response_bytes", len(response["body"]), "Bytes")
+        return response
+
+
+def job_handler(event, context):
+    """Lambda handler of the job worker, runs the jobs queued
+    by the requests with `"async": true`"""
+
+    for record in event["Records"]:
+        with tracing.trace("job"):
+            run_job(json.loads(record["body"]))
+
+
+def handle(body: Dict, principal: str = "", source_ip: str = ""):
     validate_response = validate_inputs(body)
     if validate_response:
         return validate_response
     
     prompt = body['prompt']
     session_id = body["session_id"]
+    # optional, `"cache": false` always calls the LLM
+    use_cache = body.get("cache", True)
+
+    tracing.debug(f"prompt is {prompt}")
+    tracing.debug(f"session_id is {session_id}")
+
+    throttled_response = check_rate_limit(principal, session_id, source_ip)
+    if throttled_response:
+        return throttled_response
 
-    print(f"prompt is {prompt}")
-    print(f"session_id is {session_id}")
+    # optional, `"async": true` answers in a background job, see jobs.py
+    if body.get("async"):
+        job_id = jobs.submit(prompt, session_id, use_cache)
+        tracing.set_property("job_id", job_id)
+        return build_response({"job_id": job_id, "status": "pending"}, status_code=202)
     
-    response, session_id = chain.run(
-        api_key=get_api_key(), 
-        session_id=session_id, 
-        prompt=prompt
-    )
+    try:
+        response, session_id = chain.run(
+            api_key=get_api_key(), 
+            session_id=session_id, 
+            prompt=prompt,
+            use_cache=use_cache
+        )
+    except AuthenticationError:
+        # key might have been rotated since it was cached
+        response, session_id = chain.run(
+            api_key=get_api_key(force_refresh=True), 
+            session_id=session_id, 
+            prompt=prompt,
+            use_cache=use_cache
+        )
 
     return build_response({
         "response": response,
@@ -34,6 +88,124 @@ def handler(event, context):
     })
 
 
+def get_job(job_id: str, params: Dict):
+    """Returns the status and output of the job. With `wait` seconds,
+    waits for the job to finish or its output to grow past `after`
+    characters, so clients can long-poll"""
+
+    try:
+        wait = float(params.get("wait", 0))
+        after = float(params.get("after", 0))
+        # nan and inf parse as floats, but would hold the lambda until its timeout
+        if not (math.isfinite(wait) and math.isfinite(after)):
+            raise ValueError("wait and after must be finite")
+    except ValueError:
+        return build_response({
+            "status": "error",
+            "message": "wait and after must be finite numbers"
+        }, status_code=400)
+    wait = min(max(wait, 0), config.config.JOB_MAX_WAIT_SECONDS)
+    after = max(int(after), 0)
+
+    job = jobs.get(job_id, wait_seconds=wait, after=after)
+    if job is None:
+        return build_response({
+            "status": "error",
+            "message": f"job {job_id} not found"
+        }, status_code=404)
+    return build_response(job)
+
+
+def run_job(body: Dict):
+    """Runs the chain for the job, saving the output to the job as it
+    is generated. Failed jobs aren't retried, the client sees them failed"""
+
+    job_id = body["job_id"]
+    tracing.set_property("job_id", job_id)
+    if not jobs.start(job_id):
+        tracing.debug(f"skipping job {job_id}, it is done or running")
+        return
+
+    output = jobs.JobOutput(job_id)
+    try:
+        try:
+            response, session_id = chain.run(
+                api_key=get_api_key(),
+                session_id=body["session_id"],
+                prompt=body["prompt"],
+                on_token=output.add,
+                use_cache=body.get("cache", True)
+            )
+        except AuthenticationError:
+            # key might have been rotated since it was cached
+            output.reset()
+            response, session_id = chain.run(
+                api_key=get_api_key(force_refresh=True),
+                session_id=body["session_id"],
+                prompt=body["prompt"],
+                on_token=output.add,
+                use_cache=body.get("cache", True)
+            )
+    except Exception as err:
+        print(f"job {job_id} failed: {err}")
+        tracing.add("errors", 1)
+        jobs.fail(job_id, "the generation failed")
+        return
+    jobs.complete(job_id, response, session_id)
+
+
+def get_principal(event: Dict) -> str:
+    """Returns the IAM principal that signed the request, from the
+    context of API Gateway or of the function url, empty when the api
+    doesn't authenticate the caller"""
+
+    context = event.get("requestContext") or {}
+    identity = context.get("identity") or {}
+    iam = (context.get("authorizer") or {}).get("iam") or {}
+    return identity.get("userArn") or iam.get("userArn") or ""
+
+
+def get_source_ip(event: Dict) -> str:
+    """Returns the ip address of the caller, from the context of API
+    Gateway or of the function url"""
+
+    context = event.get("requestContext") or {}
+    return (context.get("identity") or {}).get("sourceIp") or (context.get("http") or {}).get("sourceIp") or ""
+
+
+def rate_limit_key(principal: str, session_id: str, source_ip: str = "") -> str:
+    """Returns the key of the rate limit of the caller: its IAM principal,
+    otherwise the root session of the conversation, which stays the same
+    while every turn returns a new session id, or the source ip of the
+    first turn of a conversation"""
+
+    if principal:
+        return principal
+    if session_id:
+        session = SessionStore(config.config.DYNAMODB_MESSAGES_TABLE_NAME, session_id)
+        return f"session#{session.root}"
+    return f"ip#{source_ip}" if source_ip else "anonymous"
+
+
+def check_rate_limit(principal: str, session_id: str, source_ip: str = "") -> Optional[Dict]:
+    """Takes a token of the rate limit of the caller, see `rate_limit_key`
+
+    Returns:
+        A 429 response with a Retry-After when the caller is over
+        its limit, None otherwise
+    """
+
+    if limiter is None:
+        return None
+    retry_after = limiter.acquire(rate_limit_key(principal, session_id, source_ip))
+    if not retry_after:
+        return None
+    return build_response({
+        "status": "error",
+        "message": "too many requests, retry later"
+    }, status_code=429, headers={"Retry-After": str(math.ceil(retry_after))})
+
+
 def validate_inputs(body: Dict):
     for input_name in ['prompt', 'session_id']:
         if input_name not in body:
@@ -43,25 +215,25 @@ def validate_inputs(body: Dict):
             })
     return ""
 
-def build_response(body: Dict):
+def build_response(body: Dict, status_code: int = 200, headers: Optional[Dict] = None):
     return {
-        "statusCode": 200,
+        "statusCode": status_code,
         "headers": {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            **(headers or {})
         },
         "body": json.dumps(body)
     }
 
 
-def get_api_key():
+def get_api_key(force_refresh: bool = False):
     """Fetches the api keys saved in Secrets Manager"""
 
-    headers = {"X-Aws-Parameters-Secrets-Token": os.environ.get('AWS_SESSION_TOKEN')}
-    secrets_extension_endpoint = "http://localhost:2773" + \
-    "/secretsmanager/get?secretId=" + \
-    config.config.API_KEYS_SECRET_NAME
-  
-    r = requests.get(secrets_extension_endpoint, headers=headers)
-    secret = json.loads(json.loads(r.text)["SecretString"])
+    with tracing.span("secrets"):
+        secret = secrets_provider.get_secrets(force_refresh=force_refresh)
 
     return secret["openai-api-key"]
+
+
+if config.config.WARMUP:
+    warmup.warm_up()
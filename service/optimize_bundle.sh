@@ -0,0 +1,52 @@
+#!/usr/bin/env bash
+# Trims a lambda bundle for faster cold starts.
+# Usage: ./optimize_bundle.sh <dist-dir> <handler-module> <architecture>
+# The import time profile runs in the lambda runtime image, with docker.
+
+set -e
+
+DIST=$1
+HANDLER_MODULE=$2
+ARCH=${3:-x86_64}
+RUNTIME_IMAGE=public.ecr.aws/lambda/python:3.9
+if [[ "$ARCH" == "arm64" ]]; then DOCKER_PLATFORM=linux/arm64; else DOCKER_PLATFORM=linux/amd64; fi
+
+# packages already provided by the lambda python runtime
+RUNTIME_PACKAGES="boto3 botocore s3transfer"
+
+for package in $RUNTIME_PACKAGES; do
+    rm -rf "$DIST/$package"
+done
+
+# test suites and stale bytecode shipped inside the installed packages
+find "$DIST" -type d -name tests -prune -exec rm -rf {} +
+find "$DIST" -type d -name __pycache__ -prune -exec rm -rf {} +
+
+# precompile, the lambda file system is read only so bytecode can't be
+# cached at runtime. Hash based pycs stay valid after zip rounds the mtimes.
+if python -c 'import sys; sys.exit(sys.version_info[:2] != (3, 9))'; then
+    python -m compileall -q -j 0 --invalidation-mode unchecked-hash "$DIST"
+else
+    echo "Skipping precompile, bytecode must be built with python 3.9 to match the lambda runtime"
+fi
+
+# import time profile of the handler module, slowest imports first, in the
+# runtime image so the imports resolve as in the lambda, without the packages
+# dropped above. A failed import fails the bundle, the lambda would fail too
+docker pull -q --platform "$DOCKER_PLATFORM" "$RUNTIME_IMAGE" > /dev/null
+if ! docker run --rm --platform "$DOCKER_PLATFORM" \
+    -v "$PWD/$DIST:/var/task:ro" -w /var/task \
+    -e AWS_DEFAULT_REGION="${AWS_DEFAULT_REGION:-us-east-1}" \
+    --entrypoint /var/lang/bin/python3 "$RUNTIME_IMAGE" \
+    -X importtime -c "import $HANDLER_MODULE" 2> "$DIST.importtime.log"; then
+    grep -v "^import time:" "$DIST.importtime.log" >&2
+    rm "$DIST.importtime.log"
+    echo "Importing $HANDLER_MODULE failed in $RUNTIME_IMAGE" >&2
+    exit 1
+fi
+{
+    head -n 1 "$DIST.importtime.log"
+    tail -n +2 "$DIST.importtime.log" | sort -t '|' -k 2 -n -r | head -n 30
+} > "$DIST.importtime.txt"
+rm "$DIST.importtime.log"
+echo "Import time report written to $DIST.importtime.txt"
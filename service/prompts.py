@@ -0,0 +1,44 @@
+"""Keeps the beginning of the prompts of consecutive turns byte-stable.
+
+Providers cache the prompts they have seen and bill the part of a new
+prompt that starts the same way at a discount (OpenAI does for prompts
+of at least 1024 tokens). A prompt only hits the cache up to its first
+changed byte, so the chains put the parts that rarely change first: the
+system prompt, compacted once per container, then the summary of the
+earlier conversation, which the token budget memory only rewrites every
+few turns, then the history, which grows at the end. Parts that change
+every turn go last, right before the input.
+"""
+import hashlib
+import re
+from typing import Dict
+
+import tracing
+
+
+def compact(text: str) -> str:
+    """Returns the text without the spaces at the end of its lines,
+    runs of spaces and runs of blank lines, which cost tokens and
+    don't change the meaning of a prompt"""
+
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+def record_prefix(*parts: str) -> None:
+    """Records a fingerprint and the size of the stable prefix of the
+    prompt in the trace of the request. Turns with the same fingerprint
+    can hit the prompt cache of the provider."""
+
+    prefix = "\n".join(part for part in parts if part).encode()
+    tracing.set_property("prompt_prefix", hashlib.sha1(prefix).hexdigest()[:12])
+    tracing.add("prompt_prefix_bytes", len(prefix), "Bytes")
+
+
+def record_usage(usage: Dict) -> None:
+    """Records the tokens of an LLM call in the trace of the request,
+    with the prompt tokens served from the prompt cache of the provider"""
+
+    tracing.add("prompt_tokens", usage.get("prompt_tokens", 0))
+    tracing.add("completion_tokens", usage.get("completion_tokens", 0))
+    tracing.add("cached_prompt_tokens", (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0))
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+# Started by the AWS Lambda Web Adapter, see stream_server.py
+exec python3 stream_server.py
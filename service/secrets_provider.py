@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import config
+import http_client
+
+
+# Keeps the connection to the extension alive across warm invocations
+_session = http_client.pooled_session(
+    pool_maxsize=2,
+    timeout=config.config.SECRETS_EXTENSION_TIMEOUT,
+    retries=http_client.retry_policy(config.config.HTTP_RETRIES, config.config.HTTP_BACKOFF_SECONDS)
+)
+
+_lock = threading.Lock()
+_secrets: Optional[Dict[str, str]] = None
+_fetched_at = 0.0
+
+
+def get_secrets(force_refresh: bool = False) -> Dict[str, str]:
+    """Returns the API keys saved in Secrets Manager.
+
+    The decoded secret is cached in module scope, so warm invocations
+    of the Lambda don't call the secrets extension again until the cache
+    expires. Pass `force_refresh` after an auth failure to pick up a
+    rotated secret; concurrent callers share a single refresh.
+
+    Args:
+        force_refresh: skip the cache and fetch the secret again
+    """
+
+    requested_at = time.monotonic()
+    if not force_refresh and _is_fresh(requested_at):
+        return _secrets
+
+    with _lock:
+        # Another caller may have refreshed the secret while we waited
+        if _secrets is not None and _fetched_at >= requested_at:
+            return _secrets
+        if not force_refresh and _is_fresh(time.monotonic()):
+            return _secrets
+        return _refresh()
+
+
+def invalidate() -> None:
+    """Drops the cached secret, next call fetches it again"""
+
+    global _secrets, _fetched_at
+    with _lock:
+        _secrets = None
+        _fetched_at = 0.0
+
+
+def _is_fresh(now: float) -> bool:
+    return _secrets is not None and \
+        now - _fetched_at < config.config.SECRETS_CACHE_TTL_SECONDS
+
+
+def _refresh() -> Dict[str, str]:
+    global _secrets, _fetched_at
+
+    _secrets = fetch_secrets()
+    _fetched_at = time.monotonic()
+    return _secrets
+
+
+def fetch_secrets() -> Dict[str, str]:
+    """Fetches the API keys from the secrets extension, bypassing the cache"""
+
+    headers = {
+        "X-Aws-Parameters-Secrets-Token": os.environ.get('AWS_SESSION_TOKEN')
+    }
+    secrets_extension_endpoint = config.config.SECRETS_EXTENSION_ENDPOINT + \
+    "/secretsmanager/get?secretId=" + \
+    config.config.API_KEYS_SECRET_NAME
+
+    r = _session.get(secrets_extension_endpoint, headers=headers)
+    r.raise_for_status()
+
+    return json.loads(r.json()["SecretString"])
@@ -0,0 +1,239 @@
+"""Copy-on-write conversation sessions.
+
+The service hands back a new, immutable session id on every turn.
+Instead of copying the history into the new session, the new session
+only stores a header pointing to its parent session and the number of
+messages it inherits (the turn offset), plus the messages of its own
+turn. Reading the history walks the parent chain, newest first, until
+enough messages are collected.
+
+A session's own messages are only written during the turn that
+created it, so the history of a parent never changes once it has
+been forked. Every session of a conversation keeps the id of its first
+session as `Root`, a stable id of the conversation across its turns.
+When the chain gets deeper than `MAX_SESSION_DEPTH`,
+the next fork is compacted: the recent messages are copied into a new
+root session, which keeps the walk bounded while storage still grows
+linearly with the number of turns.
+
+Compact a session manually with:
+
+    python sessions.py <session-id>
+"""
+import sys
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from boto3.dynamodb.conditions import Key
+
+from history import HEADER_KEY, MESSAGE_PREFIX, SUMMARY_KEY, MessageStore, decode_item, record_read
+
+import config
+
+# Sort key of the session header item
+SESSION_HEADER = HEADER_KEY
+
+# Items stored next to the messages that sort after them (the header
+# and the rolling summary), read along with the messages in descending order
+_METADATA_ITEMS = 2
+
+
+class SessionStore(MessageStore):
+    """Message store of a copy-on-write session
+
+    Args:
+        table_name: name of the DynamoDB messages table
+        session_id: key of the conversation
+    """
+
+    def __init__(self, table_name: str, session_id: str, header: Optional[Dict] = None):
+        super().__init__(table_name=table_name, session_id=session_id)
+        self.table_name = table_name
+        self._header = header
+        self._summary = None if header is None else {}
+
+    @property
+    def header(self) -> Dict:
+        """Session header, empty for sessions that have no parent"""
+
+        if self._header is None:
+            self._load_metadata()
+        return self._header
+
+    def summary(self) -> Dict:
+        if self._summary is None:
+            self._load_metadata()
+        return self._summary
+
+    def save_summary(self, summary: str, through: str) -> None:
+        super().save_summary(summary, through)
+        self._summary = {"Summary": summary, "Through": through}
+
+    @property
+    def root(self) -> str:
+        """Id of the first session of the conversation, the same for all
+        the sessions forked or compacted from it"""
+        return self.header.get("Root", self.session_id)
+
+    @property
+    def depth(self) -> int:
+        return int(self.header.get("Depth", 0))
+
+    @property
+    def offset(self) -> int:
+        """Number of messages inherited from the parent sessions"""
+        return int(self.header.get("Offset", 0))
+
+    def message_items(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[Dict]:
+        """Returns the items of the most recent messages of the session
+        history, including the inherited ones, oldest first
+
+        Args:
+            limit: maximum number of messages to read, reads all when None
+            after: only returns the messages newer than this `MessageId`,
+                the walk stops at the first session that holds it
+        """
+
+        chunks = []
+        session_id = self.session_id
+        inherited = None
+        for _ in range(config.config.MAX_SESSION_DEPTH + 1):
+            header, items, complete = self._read(session_id, limit)
+            if inherited is not None:
+                # own messages of the parent visible to the child, skips
+                # any message added to the parent after it was forked
+                visible = inherited - int(header.get("Offset", 0))
+                if complete and len(items) > visible:
+                    items = items[len(items) - visible:]
+            if after is not None and items and items[-1]["MessageId"] <= after:
+                # message ids grow along the chain, the rest is older
+                chunks.append([item for item in items if item["MessageId"] > after])
+                break
+            chunks.append(items)
+
+            if limit is not None:
+                limit -= len(items)
+                if limit <= 0:
+                    break
+            if "Parent" not in header:
+                break
+            session_id = header["Parent"]
+            inherited = int(header["Offset"])
+
+        items = [item for chunk in chunks for item in chunk]
+        items.reverse()
+        return items
+
+    def length(self) -> int:
+        """Number of messages in the session history"""
+
+        response = self.table.query(
+            KeyConditionExpression=Key("SessionId").eq(self.session_id) &
+                Key("MessageId").begins_with(MESSAGE_PREFIX),
+            Select="COUNT"
+        )
+        return self.offset + response["Count"]
+
+    def exists(self) -> bool:
+        return bool(self.header) or bool(super().messages(limit=1))
+
+    def fork(self) -> "SessionStore":
+        """Creates a new session that continues this session's history,
+        compacting the history when the parent chain is too deep"""
+
+        if self.depth >= config.config.MAX_SESSION_DEPTH:
+            return self.compact()
+
+        header = {
+            "Parent": self.session_id,
+            "Root": self.root,
+            "Offset": self.length(),
+            "Depth": self.depth + 1
+        }
+        return self._create(header, summary=self.summary())
+
+    def compact(self, window: Optional[int] = None) -> "SessionStore":
+        """Creates a new root session holding a copy of the most recent
+        messages of this session's history
+
+        Args:
+            window: number of messages to copy, defaults to `HISTORY_READ_LIMIT`
+        """
+
+        window = window or config.config.HISTORY_READ_LIMIT
+        items = self.message_items(limit=window)
+        header = {
+            "Source": self.session_id,
+            "Root": self.root,
+            "Offset": self.length() - len(items),
+            "Depth": 0
+        }
+        session = self._create(header, summary=self.summary())
+        # keeps the message ids, the summary refers to them
+        session.extend(
+            [item["Message"] for item in items],
+            message_ids=[item["MessageId"] for item in items]
+        )
+        return session
+
+    def _create(self, header: Dict, summary: Dict) -> "SessionStore":
+        session_id = str(uuid4())
+        self.table.put_item(
+            Item={"SessionId": session_id, "MessageId": SESSION_HEADER, **header},
+            ConditionExpression="attribute_not_exists(SessionId)"
+        )
+        session = SessionStore(self.table_name, session_id, header=header)
+        # carried forward, so the summary is found without walking the parents
+        if summary:
+            session.save_summary(summary["Summary"], summary["Through"])
+        return session
+
+    def _load_metadata(self):
+        """Reads the header and the summary of the session in one query"""
+
+        response = self.table.query(
+            KeyConditionExpression=Key("SessionId").eq(self.session_id) &
+                Key("MessageId").gte(SESSION_HEADER),
+            ReturnConsumedCapacity="TOTAL"
+        )
+        record_read(response)
+        items = {item["MessageId"]: item for item in response["Items"]}
+        self._header = items.get(SESSION_HEADER, {})
+        self._summary = items.get(SUMMARY_KEY, {})
+
+    def _read(self, session_id: str, limit: Optional[int]) -> Tuple[Dict, List[Dict], bool]:
+        """Reads the header and the newest own messages of a session in a
+        single query. Returns the header, the message items newest first,
+        and whether all the own messages were read."""
+
+        query = {
+            "KeyConditionExpression": Key("SessionId").eq(session_id),
+            "ScanIndexForward": False,
+            "ReturnConsumedCapacity": "TOTAL"
+        }
+        if limit is not None:
+            query["Limit"] = limit + _METADATA_ITEMS
+        response = self.table.query(**query)
+        record_read(response)
+        results = response["Items"]
+        while limit is None and "LastEvaluatedKey" in response:
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            response = self.table.query(**query)
+            record_read(response)
+            results.extend(response["Items"])
+
+        header = {}
+        items = []
+        for item in results:
+            if item["MessageId"] == SESSION_HEADER:
+                header = item
+            elif item["MessageId"].startswith(MESSAGE_PREFIX):
+                items.append(decode_item(item))
+        if limit is not None:
+            items = items[:limit]
+        return header, items, "LastEvaluatedKey" not in response
+
+
+if __name__ == "__main__":
+    session = SessionStore(config.config.DYNAMODB_MESSAGES_TABLE_NAME, sys.argv[1]).compact()
+    print(f"Compacted into session {session.session_id}")
@@ -0,0 +1,112 @@
+"""HTTP server behind the streaming function url. It runs in the
+Lambda with the AWS Lambda Web Adapter, which forwards the function
+url requests to this server and streams the response back as it is
+written, so users see the tokens as the LLM generates them.
+
+The response is newline delimited json, one `{"token": ...}` line
+per token, followed by a final line with the full `response` and the
+`session_id` for the next turn, or with a `{"message": ...}` line
+when the generation fails.
+"""
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai.error import AuthenticationError
+
+import chain
+import tracing
+from main import check_rate_limit, get_api_key, get_principal, get_source_ip, validate_inputs
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Readiness check of the web adapter"""
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        with tracing.trace("stream"):
+            self.handle_post()
+
+    def handle_post(self):
+        raw_body = self.rfile.read(int(self.headers["Content-Length"]))
+        tracing.add("request_bytes", len(raw_body), "Bytes")
+        body = json.loads(raw_body)
+
+        # the web adapter passes the context of the function url in a header
+        event = {"requestContext": json.loads(self.headers.get("x-amzn-request-context") or "{}")}
+        throttled_response = None if validate_inputs(body) else check_rate_limit(
+            get_principal(event), body["session_id"], get_source_ip(event)
+        )
+        if throttled_response:
+            data = throttled_response["body"].encode()
+            self.send_response(throttled_response["statusCode"])
+            for name, value in throttled_response["headers"].items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            validate_response = validate_inputs(body)
+            if validate_response:
+                self.write_line(json.loads(validate_response["body"]))
+            else:
+                self.stream(body["prompt"], body["session_id"], body.get("cache", True))
+        finally:
+            # ends the chunked response, or the client waits for more
+            self.wfile.write(b"0\r\n\r\n")
+
+    def stream(self, prompt: str, session_id: str, use_cache: bool = True):
+        def on_token(token: str):
+            self.write_line({"token": token})
+
+        try:
+            try:
+                response, session_id = chain.run(
+                    api_key=get_api_key(),
+                    session_id=session_id,
+                    prompt=prompt,
+                    on_token=on_token,
+                    use_cache=use_cache
+                )
+            except AuthenticationError:
+                # key might have been rotated since it was cached
+                response, session_id = chain.run(
+                    api_key=get_api_key(force_refresh=True),
+                    session_id=session_id,
+                    prompt=prompt,
+                    on_token=on_token,
+                    use_cache=use_cache
+                )
+        except Exception as err:
+            print(f"stream of session {session_id} failed: {err}")
+            tracing.add("errors", 1)
+            self.write_line({"message": "the generation failed"})
+            return
+        self.write_line({"response": response, "session_id": session_id})
+
+    def write_line(self, data):
+        line = (json.dumps(data) + "\n").encode()
+        tracing.add("response_bytes", len(line), "Bytes")
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+    def log_message(self, format, *args):
+        tracing.debug(format % args)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", "8080"))
+    ThreadingHTTPServer(("127.0.0.1", port), StreamHandler).serve_forever()
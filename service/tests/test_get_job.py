@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import main
+from config import config
+
+
+@pytest.fixture
+def polls(monkeypatch):
+    """Arguments of the reads of the jobs"""
+
+    calls = []
+
+    def get(job_id, wait_seconds=0, after=0):
+        calls.append((wait_seconds, after))
+        return {"status": "running", "output": ""}
+
+    monkeypatch.setattr(main.jobs, "get", get)
+    return calls
+
+
+@pytest.mark.parametrize("params", [
+    {"wait": "nan"}, {"wait": "inf"}, {"wait": "-inf"}, {"after": "nan"}, {"after": "inf"}, {"wait": "soon"}
+])
+def test_non_finite_or_invalid_numbers_are_rejected(polls, params):
+    response = main.get_job("job", params)
+
+    assert response["statusCode"] == 400
+    assert json.loads(response["body"])["status"] == "error"
+    assert polls == []
+
+
+def test_wait_and_after_are_clamped(polls):
+    main.get_job("job", {"wait": "-5", "after": "-3"})
+    main.get_job("job", {"wait": "1e9", "after": "12.7"})
+
+    assert polls == [(0, 0), (config.JOB_MAX_WAIT_SECONDS, 12)]
@@ -0,0 +1,75 @@
+import json
+from uuid import uuid4
+
+import pytest
+
+import main
+import rate_limit
+from config import config
+from history import human_message
+from sessions import SessionStore
+
+
+def run(api_key, session_id, prompt, use_cache=True, on_token=None):
+    """`chain.run` without the LLM, forks the session like it does"""
+
+    session = SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, session_id or str(uuid4()))
+    if session.exists():
+        session = session.fork()
+    session.append(human_message(prompt))
+    return "reply", session.session_id
+
+
+@pytest.fixture
+def service(tables, monkeypatch):
+    monkeypatch.setattr(main, "limiter", rate_limit.TokenBucket(config.RATE_LIMIT_TABLE_NAME, 3, 1e-6))
+    monkeypatch.setattr(main, "get_api_key", lambda force_refresh=False: "sk-test")
+    monkeypatch.setattr(main.chain, "run", run)
+
+
+def turn(session_id, source_ip="203.0.113.1"):
+    event = {
+        "body": json.dumps({"prompt": "hello", "session_id": session_id}),
+        "requestContext": {"identity": {"sourceIp": source_ip}}
+    }
+    return main.handler(event, None)
+
+
+def test_chained_turns_drain_the_bucket_of_the_conversation(service):
+    session_id = json.loads(turn("")["body"])["session_id"]
+    statuses = []
+    for _ in range(4):
+        response = turn(session_id)
+        statuses.append(response["statusCode"])
+        if response["statusCode"] == 200:
+            session_id = json.loads(response["body"])["session_id"]
+
+    assert statuses == [200, 200, 200, 429]
+    assert "Retry-After" in response["headers"]
+
+
+def test_conversations_have_their_own_buckets(service):
+    first = json.loads(turn("")["body"])["session_id"]
+    second = json.loads(turn("", source_ip="203.0.113.2")["body"])["session_id"]
+    for _ in range(3):
+        assert turn(first)["statusCode"] == 200
+    assert turn(first)["statusCode"] == 429
+    assert turn(second)["statusCode"] == 200
+
+
+def test_forks_and_compactions_keep_the_root_session(tables):
+    root = SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, "root")
+    root.append(human_message("hello"))
+    forked = root.fork()
+    compacted = SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, forked.session_id).compact()
+
+    assert root.root == "root"
+    assert SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, forked.session_id).root == "root"
+    assert SessionStore(config.DYNAMODB_MESSAGES_TABLE_NAME, compacted.session_id).root == "root"
+
+
+def test_principal_is_the_key_of_signed_requests():
+    assert main.rate_limit_key("arn:aws:iam::1:user/a", "session") == "arn:aws:iam::1:user/a"
+    assert main.get_principal({"requestContext": {"authorizer": {"iam": {"userArn": "arn:aws:iam::1:user/b"}}}}) \
+        == "arn:aws:iam::1:user/b"
+    assert main.get_source_ip({"requestContext": {"http": {"sourceIp": "198.51.100.7"}}}) == "198.51.100.7"
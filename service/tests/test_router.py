@@ -0,0 +1,69 @@
+import time
+
+import pytest
+from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, ChatGeneration, ChatResult, HumanMessage
+
+import config
+import router
+
+# seconds each fake model takes to answer
+LATENCIES = {"slow-model": 0.5, "fast-model": 0.0}
+
+
+class Tokens(StreamingStdOutCallbackHandler):
+    """Records the tokens reaching the handlers of the models"""
+
+    always_verbose = True
+
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+
+def generate(self, messages, stop=None):
+    time.sleep(LATENCIES[self.model_name])
+    self.callback_manager.on_llm_new_token(self.model_name, verbose=True)
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.model_name))])
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    monkeypatch.setattr(ChatOpenAI, "_generate", generate)
+    monkeypatch.setattr(config.Config, "ROUTER_HEDGE_ENABLED", True)
+    monkeypatch.setattr(config.Config, "ROUTER_HEDGE_DEFAULT_SECONDS", 0.05)
+    monkeypatch.setattr(router, "_latencies", {})
+    return Tokens()
+
+
+def model(name, handler):
+    return ChatOpenAI(model_name=name, openai_api_key="sk-test", callback_manager=CallbackManager([handler]))
+
+
+def test_late_call_of_a_hedged_request_is_ignored(tokens):
+    hedged = router.HedgedChatModel(
+        route="fast", model=model("slow-model", tokens),
+        fallback=model("fast-model", tokens), fallback_route="large"
+    )
+
+    result = hedged._generate([HumanMessage(content="hello")])
+    time.sleep(LATENCIES["slow-model"] + 0.2)
+
+    assert result.generations[0].text == "fast-model"
+    assert tokens.tokens == ["fast-model"]
+    # the latency of the slow call still counts for its hedge delay
+    assert len(router._latencies["slow-model"]) == 1
+
+
+@pytest.mark.parametrize("prompt", ["how do I decode base64?", "scan the barcode", "my name is Whyte"])
+def test_keywords_inside_other_words_keep_the_simple_route(prompt):
+    assert router.classify(prompt, 0) == (config.config.ROUTE_SIMPLE, "simple")
+
+
+@pytest.mark.parametrize("prompt", ["Why is the sky blue?", "explain it step by step", "fix this code: x = 1"])
+def test_keywords_route_to_the_hard_model(prompt):
+    assert router.classify(prompt, 0) == (config.config.ROUTE_HARD, "keyword")
@@ -0,0 +1,78 @@
+import zipfile
+
+import pytest
+from aws_cdk import App
+from aws_cdk.assertions import Match, Template
+
+import app
+import config
+
+PROFILES = sorted(config.config.PERFORMANCE_PROFILES)
+
+
+def synth(profile_name: str, tmp_path, monkeypatch) -> Template:
+    """Template of the stack deployed with the performance profile"""
+
+    # the stack packages the bundle of bundle.sh
+    (tmp_path / "dist").mkdir()
+    zipfile.ZipFile(tmp_path / "dist" / "lambda.zip", "w").close()
+    monkeypatch.setattr(config.Config, "PERFORMANCE_PROFILE", profile_name)
+    return Template.from_stack(app.LangChainApp(App(), "LangChainApp", bundle_dir=str(tmp_path)))
+
+
+def functions(template: Template):
+    """Properties of the lambda functions, by handler"""
+
+    return {
+        resource["Properties"]["Handler"]: resource["Properties"]
+        for resource in template.find_resources("AWS::Lambda::Function").values()
+    }
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_functions_have_the_memory_and_architecture_of_the_profile(profile_name, tmp_path, monkeypatch):
+    profile = config.config.PERFORMANCE_PROFILES[profile_name]
+    template = synth(profile_name, tmp_path, monkeypatch)
+
+    for handler, properties in functions(template).items():
+        assert properties.get("MemorySize") == profile["memory_size"], handler
+        assert properties["Architectures"] == [profile["architecture"]], handler
+        assert ("WARMUP" in properties["Environment"]["Variables"]) == profile["warmup"], handler
+        assert "ReservedConcurrentExecutions" not in properties, handler
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_api_and_stream_handlers_have_the_provisioned_concurrency_of_the_profile(profile_name, tmp_path, monkeypatch):
+    profile = config.config.PERFORMANCE_PROFILES[profile_name]
+    template = synth(profile_name, tmp_path, monkeypatch)
+
+    if not profile["provisioned_concurrency"]:
+        template.resource_count_is("AWS::Lambda::Alias", 0)
+        template.resource_count_is("AWS::ApplicationAutoScaling::ScalableTarget", 0)
+        return
+
+    template.resource_count_is("AWS::Lambda::Alias", 2)
+    template.all_resources_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": profile["provisioned_concurrency"]}
+    })
+    scaling = profile["scaling"]
+    if scaling:
+        template.all_resources_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+            "MinCapacity": profile["provisioned_concurrency"],
+            "MaxCapacity": max(schedule["max"] for schedule in scaling["schedules"]),
+            "ScheduledActions": Match.array_with([
+                Match.object_like({"ScheduledActionName": schedule["name"]}) for schedule in scaling["schedules"]
+            ])
+        })
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_job_worker_reads_the_queue_without_a_concurrency_cap(profile_name, tmp_path, monkeypatch):
+    template = synth(profile_name, tmp_path, monkeypatch)
+
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 1)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 1,
+        "ScalingConfig": Match.absent()
+    })
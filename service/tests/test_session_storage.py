@@ -0,0 +1,66 @@
+import pytest
+
+import config
+import history
+from history import human_message
+from sessions import SessionStore
+
+# compacts every 4th fork, copying the 4 most recent messages
+MAX_DEPTH = 3
+WINDOW = 4
+
+
+def ai_message(content):
+    return {"type": "ai", "data": {"content": content, "additional_kwargs": {}}}
+
+
+def conversation(turns: int) -> SessionStore:
+    """Turns of a conversation, each forking the session like `chain.run`"""
+
+    session = SessionStore(config.config.DYNAMODB_MESSAGES_TABLE_NAME, "first")
+    for turn in range(turns):
+        if session.exists():
+            session = session.fork()
+        session.append(human_message(f"question {turn:04d}"))
+        session.append(ai_message(f"answer {turn:04d}"))
+    return session
+
+
+def storage():
+    """Items and bytes stored in the messages table"""
+
+    items = history.get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).scan()["Items"]
+    return len(items), sum(history.item_size(item) for item in items)
+
+
+@pytest.fixture
+def store(tables, monkeypatch):
+    monkeypatch.setattr(config.Config, "MAX_SESSION_DEPTH", MAX_DEPTH)
+    monkeypatch.setattr(config.Config, "HISTORY_READ_LIMIT", WINDOW)
+
+    def store(turns):
+        """Storage of a conversation of the turns, alone in the table"""
+
+        table = history.get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+        for item in table.scan()["Items"]:
+            table.delete_item(Key={"SessionId": item["SessionId"], "MessageId": item["MessageId"]})
+        session = conversation(turns)
+        # read across the forks and the compactions
+        assert [m["data"]["content"] for m in session.messages(limit=2)] == \
+            [f"question {turns - 1:04d}", f"answer {turns - 1:04d}"]
+        assert session.length() == 2 * turns
+        return storage()
+
+    return store
+
+
+def test_storage_grows_linearly_with_the_turns(store):
+    # whole compaction cycles of MAX_DEPTH + 1 turns
+    (items_12, bytes_12), (items_24, bytes_24), (items_48, bytes_48) = store(12), store(24), store(48)
+
+    assert items_48 - items_24 == 2 * (items_24 - items_12)
+    assert bytes_48 - bytes_24 == pytest.approx(2 * (bytes_24 - bytes_12), rel=0.02)
+    # per turn: its 2 messages and the header of its session, plus the
+    # messages copied by the compaction of every cycle
+    assert (items_24 - items_12) / 12 == 3 + WINDOW / (MAX_DEPTH + 1)
+
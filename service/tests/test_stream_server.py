@@ -0,0 +1,54 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import stream_server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(stream_server, "get_api_key", lambda force_refresh=False: "sk-test")
+    monkeypatch.setattr(stream_server, "check_rate_limit", lambda *args: None)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), stream_server.StreamHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(port, body):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.request("POST", "/", json.dumps(body), {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    # the read only returns once the terminating chunk is received
+    lines = [json.loads(line) for line in response.read().splitlines()]
+    connection.close()
+    return response.status, lines
+
+
+def test_tokens_and_the_response_are_streamed(server, monkeypatch):
+    def run(api_key, session_id, prompt, on_token=None, use_cache=True):
+        on_token("hel")
+        on_token("lo")
+        return "hello", "next"
+
+    monkeypatch.setattr(stream_server.chain, "run", run)
+    status, lines = post(server, {"prompt": "hi", "session_id": "s"})
+
+    assert status == 200
+    assert lines == [{"token": "hel"}, {"token": "lo"}, {"response": "hello", "session_id": "next"}]
+
+
+def test_failed_generation_ends_the_stream_with_a_message(server, monkeypatch):
+    def run(api_key, session_id, prompt, on_token=None, use_cache=True):
+        on_token("hel")
+        raise RuntimeError("the model is down")
+
+    monkeypatch.setattr(stream_server.chain, "run", run)
+    status, lines = post(server, {"prompt": "hi", "session_id": "s"})
+
+    assert status == 200
+    assert lines == [{"token": "hel"}, {"message": "the generation failed"}]
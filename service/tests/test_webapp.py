@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+# the webapp runs apart from the lambdas, with its own dependencies
+pytest.importorskip("streamlit")
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+WEBAPP = os.path.join(os.path.dirname(__file__), "..", "webapp")
+sys.path.insert(0, WEBAPP)
+
+import api  # noqa: E402
+
+
+@pytest.fixture
+def ask(monkeypatch):
+    """Asks the question in the app, with the lines the stream answers"""
+
+    monkeypatch.chdir(WEBAPP)
+
+    def ask(*streams):
+        calls = []
+
+        def call_stream(prompt, session_id):
+            calls.append(session_id)
+            yield from streams[len(calls) - 1]
+
+        monkeypatch.setattr(api, "call_stream", call_stream)
+        app = AppTest.from_file(os.path.join(WEBAPP, "app.py"), default_timeout=30).run()
+        for _ in streams:
+            app.text_input(key="input").input("hello").run()
+        errors = [error.value for error in app.error]
+        # the next rerun renders the stored answers again
+        app.run()
+        return app, calls, errors
+
+    return ask
+
+
+def test_answers_are_kept_with_their_session(ask):
+    app, calls, errors = ask([{"token": "hi"}, {"response": "hi there", "session_id": "s1"}],
+                     [{"response": "again", "session_id": "s2"}])
+
+    assert not app.exception
+    assert errors == []
+    assert calls == ["", "s1"]
+    assert [answer["answer"]["response"] for answer in app.session_state.answers] == ["hi there", "again"]
+    assert app.session_state.session_id == "s2"
+
+
+@pytest.mark.parametrize("failure", [
+    # the stream of a failed generation
+    [{"token": "hel"}, {"message": "the generation failed"}],
+    # the body of a rate limited request
+    [{"status": "error", "message": "too many requests, retry later"}]
+])
+def test_failed_answers_keep_the_conversation(ask, failure):
+    app, calls, errors = ask([{"response": "hi there", "session_id": "s1"}], failure)
+
+    assert not app.exception
+    assert errors == [failure[-1]["message"]]
+    assert calls == ["", "s1"]
+    assert len(app.session_state.questions) == len(app.session_state.answers) == 1
+    assert app.session_state.session_id == "s1"
@@ -0,0 +1,114 @@
+"""Per request timings and counters, written to the logs as one
+CloudWatch Embedded Metric Format line per request, which CloudWatch
+turns into metrics without any api call from the Lambda.
+
+    with tracing.trace("main"):
+        with tracing.span("secrets"):
+            ...
+        tracing.add("request_bytes", len(body))
+
+Spans and counters recorded outside of a trace are ignored, so the
+instrumented code also runs in scripts and benchmarks.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Union
+
+import config
+
+_cold_start = True
+# Environments initialised ahead of traffic by provisioned concurrency,
+# their first request doesn't wait for the init phase
+_provisioned = os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE") == "provisioned-concurrency"
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Timings and counters of one request
+
+    Args:
+        handler: name of the handler, the dimension of the metrics
+        cold_start: whether the request waited for the container to initialise
+    """
+
+    def __init__(self, handler: str, cold_start: bool):
+        self.handler = handler
+        self.cold_start = cold_start
+        self.start = time.perf_counter()
+        self.metrics: Dict[str, float] = {}
+        self.units: Dict[str, str] = {}
+        self.properties: Dict[str, Union[str, int, bool]] = {}
+
+    def add(self, name: str, value: float, unit: str = "Count"):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+        self.units[name] = unit
+
+    def emit(self):
+        self.add("duration", (time.perf_counter() - self.start) * 1000, "Milliseconds")
+        self.add("cold_start", int(self.cold_start))
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": config.config.METRICS_NAMESPACE,
+                    "Dimensions": [["Handler"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in self.units.items()]
+                }]
+            },
+            "Handler": self.handler,
+            **self.properties,
+            **{name: round(value, 2) for name, value in self.metrics.items()}
+        }))
+
+
+@contextmanager
+def trace(handler: str):
+    """Traces a request, emitting its metrics when it completes"""
+
+    global _cold_start
+    current = Trace(handler, cold_start=_cold_start and not _provisioned)
+    _cold_start = False
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.emit()
+
+
+@contextmanager
+def span(name: str):
+    """Times the block, adding up the time of spans with the same name"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(f"{name}_ms", (time.perf_counter() - start) * 1000, "Milliseconds")
+
+
+def add(name: str, value: float, unit: str = "Count"):
+    """Adds the value to the metric of the current request"""
+
+    current = _current.get()
+    if current:
+        current.add(name, value, unit)
+
+
+def set_property(name: str, value: Union[str, int, bool]):
+    """Sets a value logged with the metrics of the current request,
+    searchable in CloudWatch Logs Insights but not a metric"""
+
+    current = _current.get()
+    if current:
+        current.properties[name] = value
+
+
+def debug(*args):
+    """Prints only when `DEBUG` is set in the config"""
+
+    if config.config.DEBUG:
+        print(*args)
@@ -0,0 +1,36 @@
+"""Initialises the container before its first request.
+
+Runs in the init phase of the lambdas when the performance profile
+sets `warmup`, see `PERFORMANCE_PROFILES` in config.py. Environments
+kept provisioned run it before they receive traffic, so their first
+request doesn't wait for the api keys, the tokenizer or the clients.
+A failure is logged and left to the first request to retry.
+"""
+import time
+
+import cache
+import chain
+import config
+import memory
+import secrets_provider
+from history import get_table
+
+
+def warm_up():
+    """Fetches the api keys and builds the clients reused by the requests"""
+
+    start = time.perf_counter()
+    try:
+        api_key = secrets_provider.get_secrets()["openai-api-key"]
+        get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+        if config.config.RESPONSE_CACHE_ENABLED:
+            cache.get_cache()
+        chain.get_prompt_template()
+        for route in config.config.MODEL_ROUTES:
+            chain.get_routed_llm(api_key, route)
+        if config.config.MEMORY_MAX_TOKENS:
+            memory.get_encoding(config.config.MODEL_NAME)
+    except Exception as err:
+        print(f"warm up failed: {err}")
+        return
+    print(f"warmed up in {(time.perf_counter() - start) * 1000:.0f}ms")
@@ -1,4 +1,6 @@
 import json
+import random
+from functools import lru_cache
 from urllib.parse import urlparse, urlencode, parse_qs
 
 import re
@@ -7,10 +9,76 @@ import requests
 from boto3 import Session
 from botocore.auth import SigV4Auth
 from botocore.awsrequest import AWSRequest
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-def signing_headers(method, url_string, body):
-    region = re.search("execute-api.(.*).amazonaws.com", url_string).group(1)
+API_URL = "<your-api-endpoint>"
+STREAM_URL = "<your-stream-function-url>"
+
+# (connect, read) timeouts in seconds. API Gateway answers within 29
+# seconds, the stream read timeout is the longest wait between tokens
+API_TIMEOUT = (3.05, 35)
+STREAM_TIMEOUT = (3.05, 60)
+
+# Retries of throttled requests and of requests that couldn't connect,
+# the others might have been answered already
+RETRIES = 3
+BACKOFF_SECONDS = 0.25
+
+# Seconds each poll of a job waits for its output to grow
+JOB_WAIT_SECONDS = 20
+
+
+class JitteredRetry(Retry):
+    """Retry whose backoff is drawn uniformly between zero and the
+    exponential backoff, so throttled clients don't retry together"""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff else 0.0
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=JitteredRetry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=0,
+        status=RETRIES,
+        status_forcelist=(429,),
+        allowed_methods=frozenset({"GET", "POST"}),
+        backoff_factor=BACKOFF_SECONDS,
+        raise_on_status=False
+    ))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Keeps the connections to the api and the stream url alive across messages
+_session = _create_session()
+
+
+@lru_cache(maxsize=None)
+def get_credentials():
+    """Returns the AWS credentials, resolved once. Temporary credentials
+    refresh themselves before they expire"""
+    return Session().get_credentials()
+
+
+@lru_cache(maxsize=None)
+def get_region(url_string: str, service: str) -> str:
+    if service == "lambda":
+        match = re.search("lambda-url.(.*).on.aws", url_string)
+    else:
+        match = re.search("execute-api.(.*).amazonaws.com", url_string)
+    # custom domain names sign with the region of the AWS profile
+    return match.group(1) if match else Session().region_name
+
+
+def signing_headers(method, url_string, body, service="execute-api"):
+    region = get_region(url_string, service)
     url = urlparse(url_string)
     path = url.path or '/'
     querystring = ''
@@ -21,7 +89,7 @@ def signing_headers(method, url_string, body):
     safe_url = url.scheme + '://' + url.netloc.split(
         ':')[0] + path + querystring
     request = AWSRequest(method=method.upper(), url=safe_url, data=body)
-    SigV4Auth(Session().get_credentials(), "execute-api",
+    SigV4Auth(get_credentials(), service,
               region).add_auth(request)
     return dict(request.headers.items())
 
@@ -32,7 +100,55 @@ def call(prompt: str, session_id: str):
         "session_id": session_id
     })
     method = "post"
-    url = "<your-api-endpoint>"
-    r = requests.post(url, headers=signing_headers(method, url, body), data=body)
+    url = API_URL
+    r = _session.post(url, headers=signing_headers(method, url, body), data=body, timeout=API_TIMEOUT)
     response = json.loads(r.text)
-    return response
\ No newline at end of file
+    return response
+
+
+def call_stream(prompt: str, session_id: str):
+    """Calls the streaming function url and yields each json line as it
+    arrives: `{"token": ...}` while the LLM generates, then the final
+    `{"response": ..., "session_id": ...}`."""
+    body = json.dumps({
+        "prompt": prompt,
+        "session_id": session_id
+    })
+    method = "post"
+    url = STREAM_URL
+    headers = signing_headers(method, url, body, service="lambda")
+    with _session.post(url, headers=headers, data=body, stream=True, timeout=STREAM_TIMEOUT) as r:
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def call_job(prompt: str, session_id: str):
+    """Runs the prompt as a background job of the API and long-polls
+    it, for answers that take longer than the API timeout. Yields
+    `{"output": ...}` with the answer so far as it grows, then the
+    final `{"response": ..., "session_id": ...}`."""
+    body = json.dumps({
+        "prompt": prompt,
+        "session_id": session_id,
+        "async": True
+    })
+    url = API_URL
+    r = _session.post(url, headers=signing_headers("post", url, body), data=body, timeout=API_TIMEOUT)
+    job = json.loads(r.text)
+    if "job_id" not in job:
+        yield job
+        return
+
+    job_url = API_URL.rstrip("/") + "/jobs/" + job["job_id"]
+    after = 0
+    while True:
+        url = f"{job_url}?wait={JOB_WAIT_SECONDS}&after={after}"
+        r = _session.get(url, headers=signing_headers("get", url, ""), timeout=API_TIMEOUT)
+        job = json.loads(r.text)
+        if job.get("status") not in ("pending", "running"):
+            yield job
+            return
+        if len(job["output"]) > after:
+            after = len(job["output"])
+            yield {"output": job["output"]}
@@ -6,6 +6,11 @@ import api
 
 USER_ICON = "images/user-icon.png"
 AI_ICON = "images/ai-icon.png"
+# render the answer token by token from the streaming function url
+STREAMING = True
+# with STREAMING, poll a background job of the API instead of the
+# streaming url, for answers that take longer than the API timeout
+ASYNC_JOBS = False
 
 # Check if the user ID is already stored in the session state
 if 'user_id' in st.session_state:
@@ -39,6 +44,12 @@ if "answers" not in st.session_state:
 if "input" not in st.session_state:
     st.session_state.input = ""
 
+if "pending" not in st.session_state:
+    st.session_state.pending = None
+
+if "error" not in st.session_state:
+    st.session_state.error = None
+
 
 st.markdown("""
         <style>
@@ -88,11 +99,27 @@ def handle_input():
         'id': len(st.session_state.questions)
     }
     st.session_state.questions.append(question_with_id)
+    if STREAMING:
+        # answered while the page renders, so tokens can be shown as they arrive
+        st.session_state.pending = question_with_id
+        st.session_state.input = ""
+        return
+    add_answer(api.call(input, st.session_state['session_id']))
+    st.session_state.input = ""
+
+def add_answer(answer):
+    """Keeps the answer of the last question, or drops the question
+    when the api didn't answer it (rate limited, failed generation),
+    so the questions and the answers stay paired"""
+    if "response" not in answer:
+        st.session_state.questions.pop()
+        st.session_state.error = answer.get("message", "the question couldn't be answered")
+        return
+    st.session_state['session_id'] = answer.get('session_id', st.session_state['session_id'])
     st.session_state.answers.append({
-        'answer': api.call(input, st.session_state['session_id']),
+        'answer': answer,
         'id': len(st.session_state.questions)
     })
-    st.session_state.input = ""
 
 def write_user_message(md):
     col1, col2 = st.columns([1,12])
@@ -108,10 +135,34 @@ def render_answer(answer):
         st.image(AI_ICON, use_column_width='always')
     with col2:
         st.info(answer)
+
+def stream_answer(question):
+    col1, col2 = st.columns([1,12])
+    with col1:
+        st.image(AI_ICON, use_column_width='always')
+    with col2:
+        placeholder = st.empty()
+        text = ""
+        answer = {}
+        call = api.call_job if ASYNC_JOBS else api.call_stream
+        for line in call(question['question'], st.session_state['session_id']):
+            if "token" in line:
+                text += line["token"]
+                placeholder.info(text)
+            elif "output" in line:
+                text = line["output"]
+                placeholder.info(text)
+            else:
+                answer = line
+        if "response" in answer:
+            placeholder.info(answer["response"])
+        else:
+            placeholder.error(answer.get("message", "the question couldn't be answered"))
+    return answer
     
 #Each answer will have context of the question asked in order to associate the provided feedback with the respective question
 def write_chat_message(md, q):
-    st.session_state['session_id'] = md['answer']['session_id']
+    st.session_state['session_id'] = md['answer'].get('session_id', st.session_state['session_id'])
     chat = st.container()
     with chat:
         render_answer(md['answer']["response"])
@@ -121,6 +172,15 @@ with st.container():
   for (q, a) in zip(st.session_state.questions, st.session_state.answers):
     write_user_message(q)
     write_chat_message(a, q)
+  pending = st.session_state.pending
+  if pending:
+    write_user_message(pending)
+    answer = stream_answer(pending)
+    st.session_state.pending = None
+    add_answer(answer)
+  elif st.session_state.error:
+    st.error(st.session_state.error)
+  st.session_state.error = None
 
 st.markdown('---')
 input = st.text_input("You are talking to an AI, ask any question.", key="input", on_change=handle_input)
\ No newline at end of file
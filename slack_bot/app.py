@@ -1,6 +1,10 @@
+import os
+from typing import Dict
+
 from aws_cdk import (
     App, Duration, Stack, 
     aws_apigateway as apigateway, 
+    aws_applicationautoscaling as appscaling,
     aws_lambda as lambda_, 
     aws_secretsmanager as secretsmanager,
     aws_dynamodb as dynamodb,
@@ -8,15 +12,103 @@ from aws_cdk import (
     aws_lambda_event_sources as event_sources,
     RemovalPolicy
 )
+from constructs import Construct
 import config
 
 
+def is_arm64(profile: Dict) -> bool:
+    return profile["architecture"] == "arm64"
+
+
+def function_settings(profile: Dict) -> Dict:
+    """Lambda function props of the performance profile"""
+
+    settings = {
+        "architecture": lambda_.Architecture.ARM_64 if is_arm64(profile) else lambda_.Architecture.X86_64
+    }
+    if profile["memory_size"]:
+        settings["memory_size"] = profile["memory_size"]
+    if profile.get("reserved_concurrency"):
+        settings["reserved_concurrent_executions"] = profile["reserved_concurrency"]
+    return settings
+
+
+def profile_environment(profile: Dict) -> Dict[str, str]:
+    return {"WARMUP": "true"} if profile["warmup"] else {}
+
+
+def secrets_layer(scope: Construct, id: str, profile: Dict) -> lambda_.ILayerVersion:
+    return lambda_.LayerVersion.from_layer_version_arn(
+        scope,
+        id,
+        layer_version_arn=(
+            config.config.SECRETS_EXTENSION_ARM64_ARN if is_arm64(profile) else config.config.SECRETS_EXTENSION_ARN
+        )
+    )
+
+
+def live_target(scope: Construct, id: str, function: lambda_.Function, profile: Dict) -> lambda_.IFunction:
+    """Returns the `live` alias of the function when the profile keeps
+    environments provisioned, with the scaling of the profile, or the
+    function itself otherwise"""
+
+    if not profile["provisioned_concurrency"]:
+        return function
+
+    alias = lambda_.Alias(scope, id,
+        alias_name="live",
+        version=function.current_version,
+        provisioned_concurrent_executions=profile["provisioned_concurrency"]
+    )
+    scaling = profile["scaling"]
+    if scaling:
+        target = alias.add_auto_scaling(
+            min_capacity=profile["provisioned_concurrency"],
+            max_capacity=max(schedule["max"] for schedule in scaling["schedules"])
+        )
+        target.scale_on_utilization(utilization_target=scaling["utilization"])
+        for schedule in scaling["schedules"]:
+            target.scale_on_schedule(schedule["name"],
+                schedule=appscaling.Schedule.expression(schedule["cron"]),
+                min_capacity=schedule["min"],
+                max_capacity=schedule["max"]
+            )
+    return alias
+
+
 class SlackBotApp(Stack):
-    def __init__(self, app: App, id: str) -> None:
+    def __init__(self, app: App, id: str, bundle_dir: str = ".") -> None:
+        """The lambdas are deployed from the packages of the bundle
+        scripts, in `bundle_dir`"""
+
         super().__init__(app, id)
 
-        table = dynamodb.Table(self, "table", table_name=config.config.DYNAMODB_TABLE_NAME, 
+        profile = config.config.PERFORMANCE_PROFILES[config.config.PERFORMANCE_PROFILE]
+
+        # Legacy history table, can be removed once migrated with migrate_history.py
+        dynamodb.Table(self, "table", table_name=config.config.DYNAMODB_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="SessionId", type=dynamodb.AttributeType.STRING),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        messages_table = dynamodb.Table(self, "messages-table", table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME, 
             partition_key=dynamodb.Attribute(name="SessionId", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="MessageId", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        idempotency_table = dynamodb.Table(self, "idempotency-table", table_name=config.config.IDEMPOTENCY_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="IdempotencyKey", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        rate_limit_table = dynamodb.Table(self, "rate-limit-table", table_name=config.config.RATE_LIMIT_TABLE_NAME, 
+            partition_key=dynamodb.Attribute(name="Key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
             removal_policy=RemovalPolicy.DESTROY
         )
 
@@ -25,26 +117,27 @@ class SlackBotApp(Stack):
             config.config.MESSAGE_QUEUE_NAME, 
             queue_name=config.config.MESSAGE_QUEUE_NAME,
             fifo=True,
-            visibility_timeout=Duration.minutes(5)
-        )
-
-        layer = lambda_.LayerVersion.from_layer_version_arn(
-            self,
-            "SecretsExtensionLayer",
-            layer_version_arn=config.config.SECRETS_EXTENSION_ARN
+            # 6 times the writer timeout, as recommended for lambda event sources,
+            # so batches in progress aren't redelivered
+            visibility_timeout=Duration.minutes(30)
         )
 
         # Reader lambda
         handler = lambda_.Function(self, "SlackBotReader",
             runtime=lambda_.Runtime.PYTHON_3_9,
-            code=lambda_.Code.from_asset("dist_reader/lambda.zip"),
+            code=lambda_.Code.from_asset(os.path.join(bundle_dir, "dist_reader/lambda.zip")),
             handler="message_reader.handler",
-            layers=[layer],
-            timeout=Duration.minutes(1)
+            layers=[secrets_layer(self, "SecretsExtensionLayer", profile["reader"])],
+            timeout=Duration.minutes(1),
+            environment=profile_environment(profile["reader"]),
+            **function_settings(profile["reader"])
         )
+        reader_target = live_target(self, "SlackBotReaderLive", handler, profile["reader"])
 
         queue.grant_send_messages(handler)
-        table.grant_read_write_data(handler)
+        messages_table.grant_read_write_data(handler)
+        idempotency_table.grant_read_write_data(handler)
+        rate_limit_table.grant_read_write_data(handler)
 
         secret = secretsmanager.Secret.from_secret_name_v2(self, 'secret', config.config.API_KEYS_SECRET_NAME)
         secret.grant_read(handler)
@@ -55,7 +148,7 @@ class SlackBotApp(Stack):
             description="Recieves and processes messages from slack, calling an LLM chain to respond to direct messages."
         )
 
-        post_integration = apigateway.LambdaIntegration(handler)
+        post_integration = apigateway.LambdaIntegration(reader_target)
 
         api.root.add_method(
             "POST", 
@@ -65,18 +158,39 @@ class SlackBotApp(Stack):
         # Writer lambda
         writer_handler = lambda_.Function(self, "SlackBotWriter",
             runtime=lambda_.Runtime.PYTHON_3_9,
-            code=lambda_.Code.from_asset("dist_writer/lambda.zip"),
+            code=lambda_.Code.from_asset(os.path.join(bundle_dir, "dist_writer/lambda.zip")),
             handler="message_writer.handler",
-            layers=[layer],
-            timeout=Duration.minutes(5)
+            layers=[secrets_layer(self, "WriterSecretsExtensionLayer", profile["writer"])],
+            timeout=Duration.minutes(5),
+            environment={
+                # tokenizer files bundled with the code
+                "TIKTOKEN_CACHE_DIR": "/var/task/tiktoken_cache",
+                **profile_environment(profile["writer"])
+            },
+            **function_settings(profile["writer"])
         )
+        writer_target = live_target(self, "SlackBotWriterLive", writer_handler, profile["writer"])
         secret.grant_read(writer_handler)
         queue.grant_consume_messages(writer_handler)
-        table.grant_read_write_data(writer_handler)
+        messages_table.grant_read_write_data(writer_handler)
+        idempotency_table.grant_read_write_data(writer_handler)
 
-        writer_handler.add_event_source(event_sources.SqsEventSource(queue))
+        # max_batching_window isn't supported for fifo queues
+        event_source_settings = {}
+        reserved = profile["writer"]["reserved_concurrency"]
+        if reserved and reserved >= 2:
+            # stops the queue from invoking more writers than are reserved,
+            # which would be throttled and retried
+            event_source_settings["max_concurrency"] = reserved
+        writer_target.add_event_source(event_sources.SqsEventSource(
+            queue,
+            batch_size=config.config.WRITER_BATCH_SIZE,
+            report_batch_item_failures=True,
+            **event_source_settings
+        ))
 
 
-app = App()
-SlackBotApp(app, "SlackBotApp")
-app.synth()
\ No newline at end of file
+if __name__ == "__main__":
+    app = App()
+    SlackBotApp(app, "SlackBotApp")
+    app.synth()
\ No newline at end of file
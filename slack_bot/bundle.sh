@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 
-./bundle_reader.sh 
-./bundle_writer.sh
\ No newline at end of file
+./bundle_reader.sh "$@"
+./bundle_writer.sh "$@"
\ No newline at end of file
@@ -1,9 +1,18 @@
 #!/usr/bin/env bash
 
 rm -rf dist_reader
-pip install --platform manylinux2014_x86_64 --implementation cp --only-binary=:all: -r requirements.txt -t dist_reader
+# packages for the architecture of the performance profile, see config.py
+ARCH=$(python -c "import config; print(config.config.PERFORMANCE_PROFILES[config.config.PERFORMANCE_PROFILE]['reader']['architecture'])")
+if [[ "$ARCH" == "arm64" ]]; then PLATFORM=manylinux2014_aarch64; else PLATFORM=manylinux2014_x86_64; fi
+pip install --platform $PLATFORM --implementation cp --only-binary=:all: -r requirements_reader.txt -t dist_reader
 
 #remove extraneous bits from installed packages
 rm -r dist_reader/*.dist-info
-cp config.py models.py utils.py message_reader.py dist_reader/
+cp config.py models.py utils.py http_client.py secrets_provider.py history.py coalesce.py idempotency.py rate_limit.py relevance.py tracing.py warmup.py message_reader.py dist_reader/
+
+# ./bundle_reader.sh --cold-start trims the bundle and precompiles it
+if [[ "$1" == "--cold-start" ]]; then
+    ./optimize_bundle.sh dist_reader message_reader "$ARCH"
+fi
+
 cd dist_reader && zip -r lambda.zip *
\ No newline at end of file
@@ -1,11 +1,23 @@
 #!/usr/bin/env bash
 
 rm -rf dist_writer
-pip install --platform manylinux2014_x86_64 --implementation cp --only-binary=:all: -r requirements.txt -t dist_writer
+# packages for the architecture of the performance profile, see config.py
+ARCH=$(python -c "import config; print(config.config.PERFORMANCE_PROFILES[config.config.PERFORMANCE_PROFILE]['writer']['architecture'])")
+if [[ "$ARCH" == "arm64" ]]; then PLATFORM=manylinux2014_aarch64; else PLATFORM=manylinux2014_x86_64; fi
+pip install --platform $PLATFORM --implementation cp --only-binary=:all: -r requirements.txt -t dist_writer
 #openai doesn't have a binary distribution, so need a separate install
 pip install -I openai -t dist_writer 
 
 #remove extraneous bits from installed packages
 rm -r dist_writer/*.dist-info
-cp config.py models.py utils.py chain.py message_writer.py dist_writer/
+cp config.py models.py utils.py secrets_provider.py http_client.py history.py coalesce.py idempotency.py tracing.py memory.py long_term_memory.py prompts.py router.py chain.py warmup.py message_writer.py dist_writer/
+
+# bundle the tokenizer files, so they aren't downloaded on cold start
+TIKTOKEN_CACHE_DIR=dist_writer/tiktoken_cache python -c "import tiktoken; tiktoken.encoding_for_model('gpt-3.5-turbo')"
+
+# ./bundle_writer.sh --cold-start trims the bundle and precompiles it
+if [[ "$1" == "--cold-start" ]]; then
+    ./optimize_bundle.sh dist_writer message_writer "$ARCH"
+fi
+
 cd dist_writer && zip -r lambda.zip *
@@ -1,38 +1,33 @@
-from langchain.memory import ConversationBufferMemory, DynamoDBChatMessageHistory
-from langchain import ConversationChain
+import asyncio
+import itertools
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import openai
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.summary import SummarizerMixin
 from langchain.prompts import (
     ChatPromptTemplate, 
     MessagesPlaceholder, 
+    PromptTemplate,
     SystemMessagePromptTemplate, 
     HumanMessagePromptTemplate
 )
 from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, HumanMessage, SystemMessage, messages_from_dict
 
 import config
+import http_client
+import long_term_memory
+import models
+import prompts
+import router
+import tracing
+from history import MessageStore, new_message_id
+from memory import DynamoDBMessageHistory, TokenBudgetMemory
 
-def run(api_key: str, session_id: str, prompt: str) -> str:
-    """This is the main function that executes the prediction chain.
-    Updating this code will change the predictions of the service.
 
-    Args:
-        api_key: api key for the LLM service, OpenAI used here
-        session_id: session id key to store the history
-        prompt: prompt question entered by the user
-
-    Returns:
-        The prediction from LLM
-    """
-    
-    chat_memory = DynamoDBChatMessageHistory(
-        table_name=config.config.DYNAMODB_TABLE_NAME,
-        session_id=session_id
-    )
-    
-    memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)   
-        
-    prompt_template = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template(
-            """You are Tess Pearson. Your slack id is @nottess.
+# compacted once, the same bytes start the prompt of every turn, see prompts.py
+SYSTEM_PROMPT = prompts.compact("""You are Tess Pearson. Your slack id is @nottess.
 You are a female redditor in a slack group for malaysian redditors. 
 You have conversations with multiple other users and share thoughts and comment on topics.
 You should answer as humanly as  possible.
@@ -46,20 +41,238 @@ Add some malaysian slang but dont overdo it.
 
 Keep responses short. answer like a 20 year old girl.
 
-Lets begin!"""
+Lets begin!""")
+
+CHANNEL_SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["summary", "new_lines"],
+    template="""Progressively summarize the conversations of a slack channel, adding onto the previous summary returning a new summary.
+Keep it under 100 words, with only the topics, people and facts that are useful context for the other threads of the channel.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+)
+
+# Shared with the openai client, keeps the connection to the
+# LLM endpoint alive across warm invocations. Used by the summaries,
+# the replies are sent with the aiohttp session of message_writer
+openai.requestssession = http_client.pooled_session(
+    retries=http_client.retry_policy(
+        config.config.HTTP_RETRIES,
+        config.config.HTTP_BACKOFF_SECONDS,
+        status_forcelist=(),
+        read=False
+    )
+)
+
+# Immutable parts of the chain, built once per container
+_prompt_template = None
+_llms: Dict[Tuple, ChatOpenAI] = {}
+_routed_llms: Dict[Tuple[str, str], router.HedgedChatModel] = {}
+
+
+def get_prompt_template() -> ChatPromptTemplate:
+    """Returns the prompt template, building it on first use"""
+
+    global _prompt_template
+    if _prompt_template is None:
+        _prompt_template = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{input}")
+        ])
+    return _prompt_template
+
+
+def get_llm(api_key: str, **model_settings) -> ChatOpenAI:
+    """Returns the LLM client for the api key and model settings,
+    reusing the one built by a previous invocation if present"""
+
+    key = (api_key, tuple(sorted(model_settings.items())))
+    if key not in _llms:
+        # api_key is passed on each call, as the openai module only
+        # holds the key of the last client that was built
+        _llms[key] = ChatOpenAI(
+            openai_api_key=api_key,
+            model_kwargs={"api_key": api_key},
+            **model_settings
+        )
+    return _llms[key]
+
+
+def get_routed_llm(api_key: str, route: str) -> router.HedgedChatModel:
+    """Returns the model of the route, backed up by the model of
+    its fallback route, reusing the clients of the container"""
+
+    key = (api_key, route)
+    if key not in _routed_llms:
+        fallback = config.config.ROUTE_FALLBACKS.get(route)
+        _routed_llms[key] = router.HedgedChatModel(
+            route=route,
+            model=get_llm(api_key, **config.config.MODEL_ROUTES[route]),
+            fallback=get_llm(api_key, **config.config.MODEL_ROUTES[fallback]) if fallback else None,
+            fallback_route=fallback or ""
+        )
+    return _routed_llms[key]
+
+
+class History(NamedTuple):
+    """History of a conversation read ahead of the LLM call"""
+
+    store: MessageStore
+    items: List[Dict]
+    summary: Dict
+    channel: str
+    # set when the channel summary is enabled and the conversation is a thread
+    channel_summary: Optional[str] = None
+
+
+def load_history(channel: str, thread: str = "") -> History:
+    """Reads the recent messages and the summary of the conversation
+    in the thread, so they can be fetched concurrently with the api keys
+
+    Args:
+        channel: slack channel of the conversation
+        thread: ts of the thread, empty for the direct messages outside of threads
+    """
+
+    store = MessageStore(
+        table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
+        session_id=models.session_id(channel, thread)
+    )
+    summary = store.summary() if config.config.MEMORY_MAX_TOKENS else {}
+    # the older messages are in the summary already
+    items = store.message_items(limit=config.config.HISTORY_READ_LIMIT, after=summary.get("Through"))
+    if not (config.config.CHANNEL_SUMMARY_ENABLED and thread):
+        return History(store=store, items=items, summary=summary, channel=channel)
+
+    channel_summary = get_channel_store(channel).summary().get("Summary", "")
+    return History(store=store, items=items, summary=summary, channel=channel, channel_summary=channel_summary)
+
+
+def get_channel_store(channel: str) -> MessageStore:
+    """Returns the store of the summary of all the threads of the channel"""
+
+    return MessageStore(
+        table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
+        session_id=models.channel_session_id(channel)
+    )
+
+
+def update_channel_summary(api_key: str, history: History, prompt: str, response: str):
+    """Folds the exchange into the summary of the channel. Threads
+    answered at the same time each write their own update, the last
+    one is kept, which is good enough for background context."""
+
+    summarizer = SummarizerMixin(
+        llm=get_llm(
+            api_key,
+            model_name=config.config.MODEL_NAME,
+            temperature=0,
+            max_tokens=config.config.CHANNEL_SUMMARY_MAX_TOKENS
         ),
-        MessagesPlaceholder(variable_name="history"),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ])
-    
-    llm = ChatOpenAI(temperature=0, openai_api_key=api_key, max_tokens=100)
-    conversation = ConversationChain(
-        llm=llm, 
-        prompt=prompt_template,
-        verbose=True, 
-        memory=memory
+        prompt=CHANNEL_SUMMARY_PROMPT
     )
-        
-    response = conversation.predict(input=prompt)
+    with tracing.span("channel_summary"):
+        summary = summarizer.predict_new_summary(
+            [HumanMessage(content=prompt), AIMessage(content=response)],
+            history.channel_summary
+        )
+        get_channel_store(history.channel).save_summary(summary, new_message_id())
+
+
+def aged_out(history: History, variables: Dict) -> List[Dict]:
+    """Returns the message items of the history that are in the prompt
+    for the last time: folded into the summary by the token budget
+    memory, or leaving the window of recent messages with this turn"""
+
+    if config.config.MEMORY_MAX_TOKENS:
+        kept = sum(1 for message in variables["history"] if not isinstance(message, SystemMessage))
+        return history.items[:len(history.items) - kept]
+    # the prompt and the response of this turn push out the oldest messages
+    return history.items[:max(len(history.items) + 2 - config.config.HISTORY_READ_LIMIT, 0)]
+
+
+async def run(api_key: str, history: History, prompt: str) -> Tuple[str, Callable[[], None]]:
+    """This is the main function that executes the prediction chain.
+    Updating this code will change the predictions of the service.
+
+    Args:
+        api_key: api key for the LLM service, OpenAI used here
+        history: history of the conversation, see `load_history`
+        prompt: prompt question entered by the user
+
+    Returns:
+        The prediction from LLM, and a function that saves the prompt and
+        the prediction to the history, which can run while the reply is posted
+    """
+    
+    chat_memory = DynamoDBMessageHistory(store=history.store, window=config.config.HISTORY_READ_LIMIT)
+
+    recall = None
+    if config.config.LONG_TERM_MEMORY_ENABLED:
+        # the prompt is embedded and the index searched while the memory loads
+        recall = asyncio.create_task(long_term_memory.recall(api_key, history.channel, prompt))
     
-    return response
+    try:
+        if config.config.MEMORY_MAX_TOKENS:
+            memory = TokenBudgetMemory(
+                chat_memory=chat_memory,
+                llm=get_llm(api_key, model_name=config.config.MODEL_NAME, temperature=0),
+                max_token_limit=config.config.MEMORY_MAX_TOKENS,
+                keep_token_limit=config.config.MEMORY_KEEP_TOKENS,
+                model_name=config.config.MODEL_NAME
+            )
+            # summarizing calls the LLM and writes the summary, off the event loop
+            variables = await asyncio.to_thread(memory.memory_variables_from, history.items, history.summary)
+        else:
+            memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)
+            variables = {"history": messages_from_dict([item["Message"] for item in history.items])}
+
+        route, reason = router.classify(prompt, history_messages=len(history.items))
+        tracing.set_property("route", route)
+        tracing.set_property("route_reason", reason)
+
+        built = len(_llms)
+        with tracing.span("chain_build"):
+            llm = get_routed_llm(api_key, route)
+            messages = get_prompt_template().format_prompt(input=prompt, **variables).to_messages()
+        # the system prompt and the summary of the earlier conversation
+        prompts.record_prefix(*(m.content for m in itertools.takewhile(lambda m: isinstance(m, SystemMessage), messages)))
+        if history.channel_summary:
+            # changes with every reply in the channel, kept out of the prefix
+            messages.insert(-1, SystemMessage(
+                content=f"Summary of the recent threads in the channel: {history.channel_summary}"
+            ))
+        if recall is not None:
+            snippets = await recall
+            if snippets:
+                messages.insert(-1, SystemMessage(
+                    content="Earlier messages of the channel that may be relevant:\n" + "\n".join(snippets)
+                ))
+    finally:
+        if recall is not None:
+            # the search isn't needed once the reply failed, done already otherwise
+            recall.cancel()
+    tracing.set_property("llm_client", "built" if len(_llms) > built else "reused")
+
+    with tracing.span("llm"):
+        result = await llm.agenerate([messages])
+    prompts.record_usage((result.llm_output or {}).get("token_usage", {}))
+    response = result.generations[0][0].text
+    evicted = aged_out(history, variables) if recall is not None else []
+
+    def save():
+        memory.save_context({"input": prompt}, {"response": response})
+        # the reader keeps the messages of the thread from now on
+        history.store.create_header()
+        if history.channel_summary is not None:
+            update_channel_summary(api_key, history, prompt, response)
+        if evicted:
+            long_term_memory.add(api_key, history.channel, history.store.session_id, evicted)
+
+    return response, save
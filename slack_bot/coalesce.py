@@ -0,0 +1,115 @@
+"""Coalesces bursts of messages in a conversation into one reply.
+
+The reader adds each message to a pending item of its conversation, a
+slack thread or the channel of direct messages, and queues a single
+reply request when the first one arrives. The writer waits until `COALESCE_WINDOW_SECONDS` have passed since then, takes all
+the pending messages and answers them with one LLM call.
+"""
+import time
+from typing import Dict, List
+
+from botocore.exceptions import ClientError
+
+from history import get_table
+
+import config
+
+# Sort key of the messages of a conversation that are waiting for a reply
+PENDING_KEY = "PENDING"
+
+
+def add_pending(session_id: str, message: Dict) -> int:
+    """Adds the message to the pending messages of the conversation.
+
+    Args:
+        session_id: conversation of the message, see `models.session_id`
+        message: user, text and event_id of the message
+
+    Returns:
+        Time in ms the first pending message was added, when this
+        is the first one, or the pending messages are stale, and the
+        caller should schedule the reply, 0 otherwise
+    """
+
+    table = get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+    now = int(time.time() * 1000)
+    # the reply request of older pending messages was lost, nobody takes them
+    stale = now - int(stale_after_seconds() * 1000)
+    try:
+        response = table.update_item(
+            Key={"SessionId": session_id, "MessageId": PENDING_KEY},
+            UpdateExpression="SET Messages = list_append(if_not_exists(Messages, :empty), :message), "
+                             "FirstAt = if_not_exists(FirstAt, :now)",
+            ConditionExpression="attribute_not_exists(FirstAt) OR FirstAt > :stale",
+            ExpressionAttributeValues={":empty": [], ":message": [message], ":now": now, ":stale": stale},
+            ReturnValues="UPDATED_OLD"
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        try:
+            # starts the batch again, the stale messages are answered with this one
+            table.update_item(
+                Key={"SessionId": session_id, "MessageId": PENDING_KEY},
+                UpdateExpression="SET Messages = list_append(Messages, :message), FirstAt = :now",
+                ConditionExpression="FirstAt <= :stale",
+                ExpressionAttributeValues={":message": [message], ":now": now, ":stale": stale}
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            # another message started the batch again or it was taken meanwhile
+            return add_pending(session_id, message)
+        return now
+    # the old list is only returned when there were pending messages already
+    if "Messages" in response.get("Attributes", {}):
+        return 0
+    return now
+
+
+def take_pending(session_id: str) -> List[Dict]:
+    """Removes and returns the pending messages of the conversation, in the
+    order they were added. Messages added afterwards start a new batch."""
+
+    response = get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).delete_item(
+        Key={"SessionId": session_id, "MessageId": PENDING_KEY},
+        ReturnValues="ALL_OLD"
+    )
+    return response.get("Attributes", {}).get("Messages", [])
+
+
+def restore_pending(session_id: str, messages: List[Dict]):
+    """Puts taken messages back in front of the pending messages, when
+    answering them failed and the reply request is going to be retried"""
+
+    get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).update_item(
+        Key={"SessionId": session_id, "MessageId": PENDING_KEY},
+        UpdateExpression="SET Messages = list_append(:messages, if_not_exists(Messages, :empty)), "
+                         "FirstAt = if_not_exists(FirstAt, :now)",
+        ExpressionAttributeValues={":empty": [], ":messages": messages, ":now": int(time.time() * 1000)}
+    )
+
+
+def stale_after_seconds() -> float:
+    """Seconds after which pending messages are left over from a reply
+    request that was lost, past the window and the longest deferral of
+    a rate limited reply"""
+
+    return (config.config.COALESCE_WINDOW_SECONDS + config.config.RATE_LIMIT_MAX_DEFER_SECONDS
+            + config.config.COALESCE_STALE_SECONDS)
+
+
+def window_remaining(first_at: int) -> float:
+    """Returns the seconds left until the coalescing window of the
+    first message has passed, 0 when it has passed already"""
+
+    return max(first_at / 1000 + config.config.COALESCE_WINDOW_SECONDS - time.time(), 0)
+
+
+def merge(messages: List[Dict]) -> str:
+    """Merges the pending messages into one prompt, naming the
+    speaker of each message when there is more than one"""
+
+    if len(messages) == 1:
+        return messages[0]["text"]
+    return "\n".join(f"<@{m['user']}>: {m['text']}" for m in messages)
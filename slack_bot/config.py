@@ -1,4 +1,5 @@
 
+import os
 from dataclasses import dataclass
 
 import boto3
@@ -48,12 +49,285 @@ class Config:
     # Needed for reading secrets from SecretManager
     # See https://docs.aws.amazon.com/systems-manager/latest/userguide/ps-integration-lambda-extensions.html#ps-integration-lambda-extensions-add
     SECRETS_EXTENSION_ARN = SECRETS_EXTENSION_ARNS[region]
+    # published by the same accounts for Graviton lambdas
+    SECRETS_EXTENSION_ARM64_ARN = SECRETS_EXTENSION_ARN.replace(
+        ":layer:AWS-Parameters-and-Secrets-Lambda-Extension:",
+        ":layer:AWS-Parameters-and-Secrets-Lambda-Extension-Arm64:"
+    )
+
+    # Local endpoint served by the secrets extension
+    SECRETS_EXTENSION_ENDPOINT = "http://localhost:2773"
+
+    # Base url of the Slack web api, the benchmarks point it at a local fake
+    SLACK_API_URL = "https://www.slack.com/api/"
+
+    # Timeout of the calls to the Slack web api in seconds, and the number of
+    # times a rate limited call is retried, after the delay Slack asks for
+    SLACK_TIMEOUT_SECONDS = 10
+    SLACK_RATE_LIMIT_RETRIES = 2
+
+    # How long a warm container reuses the decoded secrets before fetching them again.
+    # The extension keeps its own cache (SECRETS_MANAGER_TTL, 300 seconds by default),
+    # so rotated secrets are picked up within the sum of both TTLs, or on the
+    # next auth failure which forces a refresh
+    SECRETS_CACHE_TTL_SECONDS = 300
+
+    # Outbound http calls share pooled keep-alive sessions, see http_client.py.
+    # Failed calls are retried HTTP_RETRIES times, with a jittered exponential
+    # backoff starting at HTTP_BACKOFF_SECONDS. Calls to the LLM are only retried
+    # when the connection fails, the chain retries the others
+    HTTP_RETRIES = 2
+    HTTP_BACKOFF_SECONDS = 0.1
+
+    # (connect, read) timeouts of the calls to the secrets extension, in seconds
+    SECRETS_EXTENSION_TIMEOUT = (1, 5)
 
     # Dynamo db table that stores the conversation history
+    # as one item per message
+    DYNAMODB_MESSAGES_TABLE_NAME = "slack-bot-messages"
+
+    # Legacy table that stores the whole history of a channel in one
+    # item, see migrate_history.py to move it to the messages table
     DYNAMODB_TABLE_NAME = "slack-bot-message-history"
 
+    # Chat model of the summaries and the tokenizer, the replies
+    # are generated by the model of the route of the turn
+    MODEL_NAME = "gpt-3.5-turbo"
+
+    # Models the replies are routed to, with the settings of their client.
+    # request_timeout is in seconds, a timed out call is retried max_retries times
+    MODEL_ROUTES = {
+        "fast": {"model_name": "gpt-3.5-turbo", "temperature": 0, "max_tokens": 100,
+                 "request_timeout": 20, "max_retries": 1},
+        "large": {"model_name": "gpt-4", "temperature": 0, "max_tokens": 200,
+                  "request_timeout": 60, "max_retries": 1}
+    }
+
+    # Route of the simple turns, and of the hard ones
+    ROUTE_SIMPLE = "fast"
+    ROUTE_HARD = "large"
+
+    # Route a route falls back to when its model fails or, with hedging,
+    # is slower than usual. Routes without a fallback wait for their model
+    ROUTE_FALLBACKS = {"fast": "large", "large": "fast"}
+
+    # A turn is hard when the prompt is longer than ROUTER_HARD_PROMPT_CHARS,
+    # the conversation has more than ROUTER_HARD_HISTORY_MESSAGES messages,
+    # or the prompt has one of the keywords
+    ROUTER_HARD_PROMPT_CHARS = 300
+    ROUTER_HARD_HISTORY_MESSAGES = 20
+    ROUTER_HARD_KEYWORDS = ("explain", "step by step", "code", "debug", "compare", "analyse", "analyze", "why")
+
+    # Sends the request to the fallback model too when the model hasn't answered
+    # within the ROUTER_HEDGE_PERCENTILE of its last ROUTER_LATENCY_WINDOW calls
+    # in the container, or within ROUTER_HEDGE_DEFAULT_SECONDS until it has made
+    # ROUTER_HEDGE_MIN_SAMPLES calls. Set to False to only fall back on errors
+    ROUTER_HEDGE_ENABLED = True
+    ROUTER_HEDGE_PERCENTILE = 95
+    ROUTER_LATENCY_WINDOW = 200
+    ROUTER_HEDGE_MIN_SAMPLES = 20
+    ROUTER_HEDGE_DEFAULT_SECONDS = 8.0
+
+    # Number of recent messages loaded into the prompt
+    HISTORY_READ_LIMIT = 30
+
+    # Token budget for the history in the prompt, the recent messages
+    # that fit are sent as is and older ones are folded into a rolling
+    # summary. Set to None to send all the messages read from the history
+    MEMORY_MAX_TOKENS = 500
+
+    # Once over MEMORY_MAX_TOKENS, messages are folded into the summary
+    # until the rest fits in MEMORY_KEEP_TOKENS, so the summary and the
+    # prefix of the prompt only change every few turns
+    MEMORY_KEEP_TOKENS = 300
+
+    # Adds a short summary of the recent threads of the channel to the
+    # prompt, updated after each reply with one more call to MODEL_NAME.
+    # Conversations are kept per thread, see `models.session_id`
+    CHANNEL_SUMMARY_ENABLED = False
+    CHANNEL_SUMMARY_MAX_TOKENS = 150
+
+    # Long-term memory of the channels, see long_term_memory.py. Messages
+    # that drop out of the prompt of a thread are embedded after the reply
+    # and added to a vector index of the channel. The LONG_TERM_MEMORY_TOP_K
+    # closest to a prompt, with a cosine similarity of at least
+    # LONG_TERM_MEMORY_MIN_SIMILARITY, are added to it within
+    # LONG_TERM_MEMORY_MAX_TOKENS
+    LONG_TERM_MEMORY_ENABLED = False
+    LONG_TERM_MEMORY_TOP_K = 4
+    LONG_TERM_MEMORY_MIN_SIMILARITY = 0.3
+    LONG_TERM_MEMORY_MAX_TOKENS = 300
+
+    # Embeddings model of the long-term memory, it must support shortening
+    # the embeddings to LONG_TERM_MEMORY_DIMENSIONS, a multiple of 64
+    LONG_TERM_MEMORY_EMBEDDING_MODEL = "text-embedding-3-small"
+    LONG_TERM_MEMORY_DIMENSIONS = 256
+
+    # The index of a channel is kept in append-only shards, one per batch of
+    # at most LONG_TERM_MEMORY_SHARD_SIZE embeddings, items of the messages
+    # table under 400KB, or numpy files in LONG_TERM_MEMORY_INDEX_PATH when
+    # set, for local runs. Writer containers cache the index of a channel for
+    # LONG_TERM_MEMORY_INDEX_TTL_SECONDS
+    LONG_TERM_MEMORY_SHARD_SIZE = 1000
+    LONG_TERM_MEMORY_INDEX_PATH = ""
+    LONG_TERM_MEMORY_INDEX_TTL_SECONDS = 60
+
+    # A search compares the sign bits of the embeddings and ranks the
+    # LONG_TERM_MEMORY_CANDIDATES closest by their int8 embeddings.
+    # Set to 0 to compare the int8 embeddings of the whole index
+    LONG_TERM_MEMORY_CANDIDATES = 64
+
+    # Messages that don't mention the bot are answered when the sum of the
+    # weights of their signals reaches RELEVANCE_THRESHOLD, see relevance.py.
+    # Mentions and direct messages are always answered
+    RELEVANCE_SIGNALS = {
+        "question": 0.5,        # asks something, has a "?" or starts with a question word
+        "keyword": 0.4,         # has one of RELEVANCE_KEYWORDS
+        "thread_reply": 0.1,    # is a reply in a thread
+        "short": -0.3           # has fewer than RELEVANCE_MIN_WORDS words
+    }
+    RELEVANCE_THRESHOLD = 0.6
+    RELEVANCE_KEYWORDS = ("tess", "anyone", "anybody", "recommend", "thoughts", "opinion")
+    RELEVANCE_MIN_WORDS = 4
+
+    # At most RELEVANCE_MAX_REPLIES unprompted replies per channel within
+    # RELEVANCE_RATE_WINDOW_SECONDS, and none within RELEVANCE_COOLDOWN_SECONDS
+    # of the last one. The state of a channel is cached in the reader for
+    # RELEVANCE_STATE_TTL_SECONDS
+    RELEVANCE_MAX_REPLIES = 6
+    RELEVANCE_RATE_WINDOW_SECONDS = 60 * 60
+    RELEVANCE_COOLDOWN_SECONDS = 120
+    RELEVANCE_STATE_TTL_SECONDS = 30
+
+    # Logs the score, the signals and the decision of each message
+    RELEVANCE_DECISION_LOG = True
+
+    # Token bucket rate limit of the replies in each channel, see
+    # rate_limit.py. Up to RATE_LIMIT_CAPACITY replies in a burst, refilled
+    # with RATE_LIMIT_PER_MINUTE a minute. Over the limit, the replies to
+    # mentions and direct messages are deferred until the channel has a
+    # token again, up to RATE_LIMIT_MAX_DEFER_SECONDS, and the other
+    # replies are dropped. Set RATE_LIMIT_CAPACITY to 0 to disable
+    RATE_LIMIT_TABLE_NAME = "slack-bot-rate-limits"
+    RATE_LIMIT_CAPACITY = 10
+    RATE_LIMIT_PER_MINUTE = 6
+    RATE_LIMIT_MAX_DEFER_SECONDS = 5 * 60
+
     # Queue name for the slack messages
     MESSAGE_QUEUE_NAME = "slack-bot-message-queue.fifo"
 
+    # Messages of a thread that arrive within this many seconds of the
+    # first one are answered together with one reply. Set to 0 to answer
+    # every message separately
+    COALESCE_WINDOW_SECONDS = 2
+
+    # Pending messages are stale once they wait this many seconds past the
+    # window and the longest deferral, their reply request was lost. The
+    # next message of the conversation requests a new reply for them
+    COALESCE_STALE_SECONDS = 60
+
+    # Table that records the slack events received and the replies
+    # sent, so retried events and redelivered messages are skipped
+    IDEMPOTENCY_TABLE_NAME = "slack-bot-idempotency"
+    IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+
+    # How long the writer holds the claim on a reply before another
+    # invocation can take over, longer than the writer timeout
+    IDEMPOTENCY_LEASE_SECONDS = 6 * 60
+
+    # Number of queue messages the writer receives per invocation, 10 at
+    # most for a fifo queue. Fifo queues don't support a batching window,
+    # the batch holds the messages that are available when it is polled
+    WRITER_BATCH_SIZE = 10
+
+    # Number of threads the writer answers concurrently within a batch,
+    # messages of the same thread are always answered in order
+    WRITER_MAX_CONCURRENCY = 5
+
+    # Logs the full events, prompts and chain steps when the DEBUG
+    # environment variable of the lambda is set to true
+    DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
+
+    # CloudWatch namespace of the metrics logged by tracing.py
+    METRICS_NAMESPACE = "SlackBot"
+
+    # Performance profile the lambdas are deployed with, one of PERFORMANCE_PROFILES.
+    # Pick it at deploy time with `PERFORMANCE_PROFILE=interactive ./bundle.sh && cdk deploy`
+    PERFORMANCE_PROFILE = os.environ.get("PERFORMANCE_PROFILE", "default")
+
+    # Settings of the reader and the writer in each profile:
+    # memory_size: MB, CPU is allocated in proportion, None keeps the lambda default
+    # architecture: "x86_64" or "arm64" (Graviton), the bundle scripts build the packages for it
+    # provisioned_concurrency: execution environments kept initialised behind the
+    #     `live` alias, which the api and the queue then invoke
+    # scaling: scales the provisioned concurrency on the utilization of the
+    #     provisioned environments, within ranges applied on a schedule (UTC)
+    # reserved_concurrency: caps the concurrent writers, which also caps the
+    #     concurrent LLM calls, None for no cap
+    # warmup: runs warmup.py in the init phase, before the first request
+    PERFORMANCE_PROFILES = {
+        "default": {
+            "reader": {
+                "memory_size": None,
+                "architecture": "x86_64",
+                "provisioned_concurrency": 0,
+                "scaling": None,
+                "warmup": False
+            },
+            "writer": {
+                "memory_size": None,
+                "architecture": "x86_64",
+                "provisioned_concurrency": 0,
+                "scaling": None,
+                "reserved_concurrency": None,
+                "warmup": False
+            }
+        },
+        "economy": {
+            "reader": {
+                "memory_size": 512,
+                "architecture": "arm64",
+                "provisioned_concurrency": 0,
+                "scaling": None,
+                "warmup": True
+            },
+            "writer": {
+                "memory_size": 1024,
+                "architecture": "arm64",
+                "provisioned_concurrency": 0,
+                "scaling": None,
+                "reserved_concurrency": 5,
+                "warmup": True
+            }
+        },
+        "interactive": {
+            # acks slack within its 3 second timeout, even after an idle period
+            "reader": {
+                "memory_size": 1024,
+                "architecture": "arm64",
+                "provisioned_concurrency": 1,
+                "scaling": {
+                    "utilization": 0.7,
+                    "schedules": [
+                        {"name": "working-hours", "cron": "cron(0 7 ? * MON-FRI *)", "min": 2, "max": 5},
+                        {"name": "off-hours", "cron": "cron(0 19 ? * MON-FRI *)", "min": 1, "max": 2}
+                    ]
+                },
+                "warmup": True
+            },
+            "writer": {
+                # a full vCPU
+                "memory_size": 1769,
+                "architecture": "arm64",
+                "provisioned_concurrency": 1,
+                "scaling": None,
+                "reserved_concurrency": 10,
+                "warmup": True
+            }
+        }
+    }
+
+    # Set by the stack from the warmup setting of the profile
+    WARMUP = os.environ.get("WARMUP", "false").lower() == "true"
 
 config = Config()
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""Pooled HTTP sessions for the outbound calls of the Lambdas.
+
+Sessions keep their connections alive across requests, and across warm
+invocations when held in module scope, apply a default connect and read
+timeout to requests that don't set one, and retry failed requests with
+jittered exponential backoff.
+"""
+import random
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+# Counts outbound requests, newly opened connections and retries for the
+# lifetime of the container, to measure keep-alive connection reuse
+_stats = {"requests": 0, "connections": 0, "retries": 0}
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _stats["connections"] += 1
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _stats["connections"] += 1
+        return super()._new_conn()
+
+
+class JitteredRetry(Retry):
+    """Retry whose backoff is drawn uniformly between zero and the
+    exponential backoff, so clients that failed together don't retry
+    together. Honours the Retry-After header of throttled responses."""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff else 0.0
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        _stats["retries"] += 1
+        return retry
+
+
+def retry_policy(
+    retries: int,
+    backoff_seconds: float,
+    status_forcelist: Tuple[int, ...] = (429, 500, 502, 503, 504),
+    read: bool = True
+) -> JitteredRetry:
+    """Retries connection errors and the listed statuses of idempotent
+    requests `retries` times.
+
+    Args:
+        retries: maximum number of retries of a request
+        backoff_seconds: backoff of the first retry, doubled on each retry
+        status_forcelist: response statuses that are retried
+        read: whether requests that failed after being sent are retried,
+            only safe for idempotent requests
+    """
+
+    return JitteredRetry(
+        total=retries,
+        connect=retries,
+        read=retries if read else 0,
+        status=retries,
+        status_forcelist=status_forcelist,
+        backoff_factor=backoff_seconds,
+        raise_on_status=False
+    )
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTP adapter that keeps connections alive between
+    requests and records how often they are reused
+
+    Args:
+        timeout: seconds, or (connect, read) seconds, applied to
+            the requests sent without a timeout
+    """
+
+    def __init__(self, timeout: Optional[Union[float, Tuple[float, float]]] = None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        _stats["requests"] += 1
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def pooled_session(
+    pool_maxsize: int = 10,
+    timeout: Optional[Union[float, Tuple[float, float]]] = None,
+    retries: Optional[Retry] = None
+) -> requests.Session:
+    """Creates a session whose connections are kept alive
+    across requests, and across warm Lambda invocations when
+    the session is held in module scope
+
+    Args:
+        pool_maxsize: connections kept open per host
+        timeout: seconds, or (connect, read) seconds, for the requests
+            that don't set a timeout, None waits forever
+        retries: retry policy, see `retry_policy`, None doesn't retry
+    """
+
+    session = requests.Session()
+    adapter = PooledAdapter(
+        timeout=timeout,
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=retries or 0
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def connection_stats() -> Dict[str, float]:
+    """Returns the request, connection and retry counts, and
+    the share of requests that reused an open connection"""
+
+    requests_sent = _stats["requests"]
+    connections = _stats["connections"]
+    reuse_rate = 1 - connections / requests_sent if requests_sent else 0.0
+    return {
+        "requests": requests_sent,
+        "connections": connections,
+        "retries": _stats["retries"],
+        "reuse_rate": max(reuse_rate, 0.0)
+    }
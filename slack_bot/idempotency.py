@@ -0,0 +1,118 @@
+"""Makes sure each slack event is handled once, even when Slack retries
+the event or SQS redelivers the reply request.
+
+Work is claimed with a conditional write to the idempotency table. A
+claim is held for `IDEMPOTENCY_LEASE_SECONDS`, after which another
+invocation can take over the work of a crashed one, and is marked
+completed once done. Items expire with the table TTL.
+"""
+import logging
+import time
+from typing import Dict, Optional
+
+from botocore.exceptions import ClientError
+
+from history import get_table
+
+import config
+
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETED = "COMPLETED"
+
+
+class AlreadyInProgress(Exception):
+    """Another invocation holds the claim on the work"""
+
+
+def claim(key: str, lease_seconds: Optional[int] = None) -> bool:
+    """Claims the work identified by the key.
+
+    Args:
+        key: idempotency key of the work
+        lease_seconds: how long the claim is held before another
+            invocation can take over, `IDEMPOTENCY_LEASE_SECONDS` when None
+
+    Returns:
+        True when the work was claimed, False when it was completed already
+
+    Raises:
+        AlreadyInProgress: another invocation is doing the work
+    """
+
+    if lease_seconds is None:
+        lease_seconds = config.config.IDEMPOTENCY_LEASE_SECONDS
+    now = int(time.time())
+    table = get_table(config.config.IDEMPOTENCY_TABLE_NAME)
+    try:
+        table.put_item(
+            Item={
+                "IdempotencyKey": key,
+                "Status": IN_PROGRESS,
+                "LeaseUntil": now + lease_seconds,
+                "ExpiresAt": now + config.config.IDEMPOTENCY_TTL_SECONDS
+            },
+            ConditionExpression="attribute_not_exists(IdempotencyKey) OR "
+                                "(#status = :in_progress AND LeaseUntil < :now)",
+            ExpressionAttributeNames={"#status": "Status"},
+            ExpressionAttributeValues={":in_progress": IN_PROGRESS, ":now": now}
+        )
+        return True
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+    item: Dict = table.get_item(Key={"IdempotencyKey": key}, ConsistentRead=True).get("Item", {})
+    if item.get("Status") == COMPLETED:
+        return False
+    raise AlreadyInProgress(key)
+
+
+def complete(key: str):
+    """Marks the claimed work as done, later claims return False"""
+
+    get_table(config.config.IDEMPOTENCY_TABLE_NAME).update_item(
+        Key={"IdempotencyKey": key},
+        UpdateExpression="SET #status = :completed REMOVE LeaseUntil",
+        ExpressionAttributeNames={"#status": "Status"},
+        ExpressionAttributeValues={":completed": COMPLETED}
+    )
+
+
+def release(key: str):
+    """Gives up the claim, so the work can be retried right away"""
+
+    try:
+        get_table(config.config.IDEMPOTENCY_TABLE_NAME).delete_item(
+            Key={"IdempotencyKey": key},
+            ConditionExpression="#status = :in_progress",
+            ExpressionAttributeNames={"#status": "Status"},
+            ExpressionAttributeValues={":in_progress": IN_PROGRESS}
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def record_event(event_id: str) -> bool:
+    """Records that the slack event was received, in one conditional write.
+
+    Returns:
+        False when the event was received before
+    """
+
+    now = int(time.time())
+    try:
+        get_table(config.config.IDEMPOTENCY_TABLE_NAME).put_item(
+            Item={
+                "IdempotencyKey": f"event#{event_id}",
+                "Status": COMPLETED,
+                "ExpiresAt": now + config.config.IDEMPOTENCY_TTL_SECONDS
+            },
+            ConditionExpression="attribute_not_exists(IdempotencyKey)"
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        # handle the event rather than drop it when the table isn't available
+        logging.error(err)
+    return True
@@ -0,0 +1,395 @@
+"""Long-term memory of the channels, for the context that dropped out of
+the prompts of their threads.
+
+Messages that drop out of the prompt of a thread, into the rolling
+summary or out of the window of recent messages, are embedded in one
+batch after the reply, while it is posted, and added to the vector index
+of the channel. Before a reply, the prompt is embedded while the history
+is loaded, and the snippets of the index closest to it that fit in
+`LONG_TERM_MEMORY_MAX_TOKENS` are added to the prompt.
+
+The index keeps int8 embeddings of `LONG_TERM_MEMORY_DIMENSIONS` in
+append-only shards, one per batch of up to `LONG_TERM_MEMORY_SHARD_SIZE`
+messages, stored as items of the channel next to its summary, or as
+files in `LONG_TERM_MEMORY_INDEX_PATH` for local runs. The shards only
+keep references to the messages, whose text is read for the few
+snippets added to a prompt. A shard is written once and never changes,
+so adding messages only writes their embeddings, and a writer container
+caches the index of a channel and only reads the shards added since. A search compares the sign bits of the
+embeddings first, 32 bytes each with 256 dimensions, and ranks the
+`LONG_TERM_MEMORY_CANDIDATES` closest by their int8 embeddings, see
+`benchmarks/bench_long_term_memory.py` for the latency and the recall
+against the size of the index.
+"""
+import asyncio
+import glob
+import logging
+import os
+import random
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+import boto3
+import numpy as np
+import openai
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+from openai.error import OpenAIError
+
+import config
+import models
+import tracing
+from history import decode_item, get_table
+from memory import count_tokens
+
+# Sort keys of the shards of the index, in the partition of the channel
+SHARD_PREFIX = "LTM#"
+
+# Indexes of channels kept by the container, the oldest is dropped past this
+MAX_CACHED_INDEXES = 50
+
+# Messages shorter than this aren't worth recalling
+MIN_SNIPPET_CHARS = 20
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+class Shard(NamedTuple):
+    """Embeddings of a batch of up to `LONG_TERM_MEMORY_SHARD_SIZE` messages"""
+
+    number: int
+    # "<session id>/<message id>" of each message
+    refs: List[str]
+    # int8, one row per message
+    vectors: np.ndarray
+
+
+class ChannelIndex:
+    """Vector index of a channel, searched in memory
+
+    Args:
+        shards: shards of the index, in order
+    """
+
+    def __init__(self, shards: List[Shard]):
+        self.shards = shards
+        self.refs = [ref for shard in shards for ref in shard.refs]
+        self.known = set(self.refs)
+        dimensions = config.config.LONG_TERM_MEMORY_DIMENSIONS
+        self.vectors = np.concatenate([shard.vectors for shard in shards]) if shards \
+            else np.zeros((0, dimensions), dtype=np.int8)
+        self.norms = np.linalg.norm(self.vectors.astype(np.float32), axis=1)
+        self.norms[self.norms == 0] = 1
+        self.bits = sign_bits(self.vectors)
+        self.read_at = time.monotonic()
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, str]]:
+        """Returns the cosine similarity and the reference of the `k`
+        messages closest to the query, closest first
+
+        Args:
+            query: normalized embedding of the query
+        """
+
+        if not self.refs:
+            return []
+        candidates = np.arange(len(self.refs))
+        limit = config.config.LONG_TERM_MEMORY_CANDIDATES
+        if limit and len(self.refs) > limit:
+            distances = popcount(self.bits ^ sign_bits(query[None, :])).sum(axis=1)
+            candidates = np.argpartition(distances, limit)[:limit]
+        scores = self.vectors[candidates].astype(np.float32) @ query / self.norms[candidates]
+        top = np.argsort(-scores)[:k]
+        return [(float(scores[i]), self.refs[candidates[i]]) for i in top]
+
+
+def sign_bits(vectors: np.ndarray) -> np.ndarray:
+    """Returns the signs of the embeddings packed in 64 bit words"""
+
+    return np.packbits(vectors > 0, axis=1).view(np.uint64)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Returns the number of bits set in each 64 bit word"""
+
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    return (words * _H01) >> np.uint64(56)
+
+
+def quantize(embeddings: np.ndarray) -> np.ndarray:
+    """Returns the embeddings as int8, each scaled to its largest value.
+    Cosine similarities don't depend on the scale of a vector."""
+
+    scale = np.abs(embeddings).max(axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    return np.round(embeddings / scale * 127).astype(np.int8)
+
+
+def normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class DynamoDBShards:
+    """Shards stored as items of the messages table, in the partition
+    of the channel summary"""
+
+    def read(self, channel: str, first: int = 0) -> List[Shard]:
+        """Returns the shards of the channel from the `first` one"""
+
+        table = get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+        query = {
+            "KeyConditionExpression": Key("SessionId").eq(models.channel_session_id(channel)) &
+            Key("MessageId").between(shard_key(first), SHARD_PREFIX + "~")
+        }
+        shards = []
+        while True:
+            response = table.query(**query)
+            for item in response["Items"]:
+                vectors = np.frombuffer(bytes(item["Vectors"]), dtype=np.int8)
+                shards.append(Shard(
+                    number=int(item["MessageId"][len(SHARD_PREFIX):]),
+                    refs=list(item["Refs"]),
+                    vectors=vectors.reshape(len(item["Refs"]), -1)
+                ))
+            if "LastEvaluatedKey" not in response:
+                return shards
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def write(self, channel: str, shard: Shard) -> bool:
+        """Writes the shard unless another container already wrote a
+        shard with its number
+
+        Returns:
+            False when the shard was written by another container
+        """
+
+        try:
+            get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).put_item(
+                Item={
+                    "SessionId": models.channel_session_id(channel),
+                    "MessageId": shard_key(shard.number),
+                    "Count": len(shard.refs),
+                    "Refs": shard.refs,
+                    "Vectors": Binary(shard.vectors.tobytes())
+                },
+                ConditionExpression="attribute_not_exists(MessageId)"
+            )
+            return True
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        return False
+
+
+class FileShards:
+    """Shards stored as numpy files in a directory per channel, for
+    local runs. Not shared by the containers of a Lambda.
+
+    Args:
+        path: directory of the index
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self, channel: str, first: int = 0) -> List[Shard]:
+        shards = []
+        for file in sorted(glob.glob(os.path.join(self.path, channel, "*.npz"))):
+            number = int(os.path.basename(file).split(".")[0])
+            if number >= first:
+                with np.load(file) as data:
+                    shards.append(Shard(number=number, refs=data["refs"].tolist(), vectors=data["vectors"]))
+        return shards
+
+    def write(self, channel: str, shard: Shard) -> bool:
+        directory = os.path.join(self.path, channel)
+        os.makedirs(directory, exist_ok=True)
+        file = os.path.join(directory, f"{shard.number:06d}.npz")
+        # hidden from the glob of `read` until it is complete
+        temporary = os.path.join(directory, f".{shard.number:06d}.{os.getpid()}.tmp.npz")
+        np.savez(temporary, refs=np.array(shard.refs), vectors=shard.vectors)
+        try:
+            # unlike a rename, fails when another process wrote the shard
+            os.link(temporary, file)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temporary)
+
+
+def shard_key(number: int) -> str:
+    return f"{SHARD_PREFIX}{number:06d}"
+
+
+def get_shards():
+    """Returns the storage of the shards, see `LONG_TERM_MEMORY_INDEX_PATH`"""
+
+    if config.config.LONG_TERM_MEMORY_INDEX_PATH:
+        return FileShards(config.config.LONG_TERM_MEMORY_INDEX_PATH)
+    return DynamoDBShards()
+
+
+_indexes: Dict[str, ChannelIndex] = {}
+_dynamodb = None
+
+
+def get_index(channel: str, refresh: bool = False) -> ChannelIndex:
+    """Returns the index of the channel, reading the shards that could
+    have changed when it is older than `LONG_TERM_MEMORY_INDEX_TTL_SECONDS`"""
+
+    index = _indexes.get(channel)
+    if not refresh and index and time.monotonic() - index.read_at < config.config.LONG_TERM_MEMORY_INDEX_TTL_SECONDS:
+        return index
+
+    # the shards don't change, only the ones added since are read
+    kept = index.shards if index else []
+    with tracing.span("memory_index_read"):
+        shards = kept + get_shards().read(channel, first=len(kept))
+    index = ChannelIndex(shards)
+    _indexes.pop(channel, None)
+    if len(_indexes) >= MAX_CACHED_INDEXES:
+        _indexes.pop(next(iter(_indexes)))
+    _indexes[channel] = index
+    return index
+
+
+def snippet(message: Dict) -> str:
+    """Returns the text of a message in the format of langchain's
+    `messages_to_dict`, as it is recalled in a prompt"""
+
+    content = message["data"]["content"].strip()
+    return f"you: {content}" if message["type"] == "ai" else content
+
+
+def embedding_settings(api_key: str) -> Dict:
+    return {
+        "model": config.config.LONG_TERM_MEMORY_EMBEDDING_MODEL,
+        "dimensions": config.config.LONG_TERM_MEMORY_DIMENSIONS,
+        "api_key": api_key
+    }
+
+
+def add(api_key: str, channel: str, session_id: str, items: List[Dict]) -> int:
+    """Embeds the messages in one batch and adds them to the index of
+    the channel. Messages already in the index are skipped, so it can
+    be called again for the same messages when a reply is retried.
+
+    Args:
+        api_key: api key for the embeddings api
+        channel: slack channel of the conversation
+        session_id: session of the messages
+        items: message items that dropped out of the prompt
+
+    Returns:
+        The number of messages added
+    """
+
+    index = get_index(channel)
+    refs, texts = [], []
+    for item in items:
+        ref = f"{session_id}/{item['MessageId']}"
+        text = snippet(item["Message"])
+        if ref not in index.known and len(text) >= MIN_SNIPPET_CHARS:
+            refs.append(ref)
+            texts.append(text)
+    if not refs:
+        return 0
+
+    try:
+        with tracing.span("memory_embed"):
+            response = openai.Embedding.create(input=texts, **embedding_settings(api_key))
+    except OpenAIError as err:
+        logging.warning(f"long-term memory embedding failed: {err}")
+        return 0
+    vectors = quantize(np.asarray([data["embedding"] for data in response["data"]], dtype=np.float32))
+
+    shard_size = config.config.LONG_TERM_MEMORY_SHARD_SIZE
+    shards = get_shards()
+    with tracing.span("memory_index_write"):
+        while refs:
+            for attempt in range(2):
+                index = get_index(channel, refresh=attempt > 0)
+                number = index.shards[-1].number + 1 if index.shards else 0
+                shard = Shard(number=number, refs=refs[:shard_size], vectors=vectors[:shard_size])
+                if shards.write(channel, shard):
+                    _indexes[channel] = ChannelIndex(index.shards + [shard])
+                    refs, vectors = refs[shard_size:], vectors[shard_size:]
+                    break
+            else:
+                # another container keeps writing to the index of the channel
+                logging.warning(f"long-term memory of {channel} changed concurrently, {len(refs)} messages skipped")
+                break
+    added = len(texts) - len(refs)
+    tracing.add("memory_indexed", added)
+    return added
+
+
+async def recall(api_key: str, channel: str, prompt: str) -> List[str]:
+    """Returns the snippets of the long-term memory of the channel that
+    are closest to the prompt, most relevant first, that fit in
+    `LONG_TERM_MEMORY_MAX_TOKENS`. Empty when the embeddings api fails."""
+
+    try:
+        with tracing.span("memory_recall_embed"):
+            response = await openai.Embedding.acreate(input=[prompt], **embedding_settings(api_key))
+    except OpenAIError as err:
+        logging.warning(f"long-term memory embedding failed: {err}")
+        return []
+    query = normalize(response["data"][0]["embedding"])
+
+    with tracing.span("memory_recall_search"):
+        index = await asyncio.to_thread(get_index, channel)
+        hits = [ref for score, ref in index.search(query, config.config.LONG_TERM_MEMORY_TOP_K)
+                if score >= config.config.LONG_TERM_MEMORY_MIN_SIMILARITY]
+    if not hits:
+        return []
+
+    with tracing.span("memory_recall_read"):
+        texts = await asyncio.to_thread(read_snippets, hits)
+    snippets = []
+    budget = config.config.LONG_TERM_MEMORY_MAX_TOKENS
+    for ref in hits:
+        if ref not in texts:
+            continue
+        tokens = count_tokens(texts[ref], config.config.MODEL_NAME)
+        if tokens > budget:
+            break
+        budget -= tokens
+        snippets.append(texts[ref])
+    tracing.add("memory_recalled", len(snippets))
+    return snippets
+
+
+def read_snippets(refs: List[str]) -> Dict[str, str]:
+    """Returns the snippets of the referenced messages that still exist"""
+
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource("dynamodb")
+    table_name = config.config.DYNAMODB_MESSAGES_TABLE_NAME
+    keys = [dict(zip(("SessionId", "MessageId"), ref.rsplit("/", 1))) for ref in refs]
+    request, items = {table_name: {"Keys": keys}}, []
+    for attempt in range(config.config.HTTP_RETRIES + 1):
+        if attempt:
+            # throttled keys are returned unprocessed, not as an error
+            time.sleep(random.uniform(0, config.config.HTTP_BACKOFF_SECONDS * 2 ** attempt))
+        response = _dynamodb.batch_get_item(RequestItems=request)
+        items.extend(response["Responses"].get(table_name, []))
+        request = response.get("UnprocessedKeys")
+        if not request:
+            break
+    else:
+        logging.warning(f"long-term memory snippets of {len(request[table_name]['Keys'])} messages unread")
+    return {
+        f"{item['SessionId']}/{item['MessageId']}": snippet(decode_item(item)["Message"])
+        for item in items
+    }
@@ -0,0 +1,148 @@
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.summary import SummarizerMixin
+from langchain.schema import (
+    AIMessage,
+    BaseChatMessageHistory,
+    BaseMessage,
+    HumanMessage,
+    _message_to_dict,
+    _message_from_dict,
+    messages_from_dict,
+)
+
+import tracing
+from history import MessageStore
+
+# Tokens added by the chat format around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Returns the local tokenizer of the model, loaded once per container"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    return len(get_encoding(model_name).encode(text)) + MESSAGE_OVERHEAD_TOKENS
+
+
+class DynamoDBMessageHistory(BaseChatMessageHistory):
+    """Chat message history for langchain memories, backed by
+    the item-per-message `MessageStore`.
+
+    Args:
+        store: message store of the conversation
+        window: number of recent messages returned by `messages`,
+            all messages are returned when None
+    """
+
+    def __init__(self, store: MessageStore, window: Optional[int] = None):
+        self.store = store
+        self.session_id = store.session_id
+        self.window = window
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        """Retrieve the recent messages from DynamoDB"""
+        with tracing.span("history_read"):
+            return messages_from_dict(self.store.messages(limit=self.window))
+
+    def add_user_message(self, message: str) -> None:
+        self.append(HumanMessage(content=message))
+
+    def add_ai_message(self, message: str) -> None:
+        self.append(AIMessage(content=message))
+
+    def append(self, message: BaseMessage) -> None:
+        """Append the message to the session in DynamoDB"""
+        with tracing.span("history_write"):
+            self.store.append(_message_to_dict(message))
+
+    def clear(self) -> None:
+        """Clear session memory from DynamoDB"""
+        self.store.clear()
+
+
+class TokenBudgetMemory(BaseChatMemory, SummarizerMixin):
+    """Conversation memory that keeps the most recent messages that fit
+    in a token budget. Older messages are folded into a rolling summary,
+    stored next to the history, which is updated only with the messages
+    that dropped out of the budget since the last update.
+
+    The summary is passed to the prompt as a system message ahead of
+    the recent messages. Once the messages go over the budget, they are
+    folded into the summary until the rest fits in `keep_token_limit`,
+    so the summary, and the prefix of the prompt, stay the same for the
+    next turns instead of changing with every turn.
+    """
+
+    chat_memory: DynamoDBMessageHistory
+    max_token_limit: int = 1000
+    keep_token_limit: Optional[int] = None
+    model_name: str = "gpt-3.5-turbo"
+    memory_key: str = "history"
+    return_messages: bool = True
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the summary and the recent messages within the budget"""
+
+        store = self.chat_memory.store
+        with tracing.span("history_read"):
+            summary = store.summary()
+            # the older messages are in the summary already
+            items = store.message_items(limit=self.chat_memory.window, after=summary.get("Through"))
+        return self.memory_variables_from(items, summary)
+
+    def memory_variables_from(self, items: List[Dict], summary: Dict) -> Dict[str, Any]:
+        """Same as `load_memory_variables`, for message items and a
+        summary already read from the store
+
+        Args:
+            items: message items of the recent messages, oldest first
+            summary: summary item of the store, empty if there is none
+        """
+
+        store = self.chat_memory.store
+        summary_text = summary.get("Summary", "")
+
+        budget = self.max_token_limit
+        if summary_text:
+            budget -= count_tokens(summary_text, self.model_name)
+
+        tokens = [count_tokens(item["Message"]["data"]["content"], self.model_name) for item in items]
+        if sum(tokens) > budget and self.keep_token_limit is not None:
+            budget -= self.max_token_limit - self.keep_token_limit
+
+        kept = 0
+        for item_tokens in reversed(tokens):
+            if item_tokens > budget:
+                break
+            budget -= item_tokens
+            kept += 1
+
+        evicted = items[:len(items) - kept]
+        through = summary.get("Through", "")
+        unsummarized = [item for item in evicted if item["MessageId"] > through]
+        if unsummarized:
+            with tracing.span("summarize"):
+                summary_text = self.predict_new_summary(
+                    [_message_from_dict(item["Message"]) for item in unsummarized],
+                    summary_text
+                )
+                store.save_summary(summary_text, unsummarized[-1]["MessageId"])
+
+        messages = messages_from_dict([item["Message"] for item in items[len(items) - kept:]])
+        if summary_text:
+            messages.insert(0, self.summary_message_cls(
+                content=f"Summary of the earlier conversation: {summary_text}"
+            ))
+        return {self.memory_key: messages}
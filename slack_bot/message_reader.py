@@ -1,37 +1,65 @@
 import json
+import time
+from typing import Dict, List
 
 import boto3
 
-from langchain.memory import DynamoDBChatMessageHistory
+import coalesce
+import idempotency
+from history import MessageStore, human_message
 from models import SlackMessage
 
 
 import config
+import rate_limit
+import relevance
+import tracing
 import utils
-import random
-
-from langchain.schema import (
-    BaseMessage,
-    HumanMessage,
-    _message_to_dict,
-    messages_from_dict,
-    messages_to_dict,
-)
+import warmup
 
 import logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(logging.DEBUG if config.config.DEBUG else logging.INFO)
+
+# created once per container and reused by warm invocations
+sqs = boto3.client('sqs')
+_queue_url = None
+
+# Shared by the warm invocations, keeps the buckets used by the container
+limiter = rate_limit.TokenBucket(
+    config.config.RATE_LIMIT_TABLE_NAME,
+    config.config.RATE_LIMIT_CAPACITY,
+    config.config.RATE_LIMIT_PER_MINUTE / 60
+) if config.config.RATE_LIMIT_CAPACITY else None
+
+
+def get_queue_url() -> str:
+    """Returns the url of the message queue, looked up on first use"""
+
+    global _queue_url
+    if _queue_url is None:
+        _queue_url = sqs.get_queue_url(
+            QueueName=config.config.MESSAGE_QUEUE_NAME,
+        )["QueueUrl"]
+    return _queue_url
 
 
 def handler(event, context):
     """Lambda handler that reads the messages from slack and
     distributes them to an sqs queue or DynamoDB store based on 
     whether message was directly addressed to the bot (a message
-    that starts with `@bot-name`) or a conversation between two
+    that starts with `@bot-name`) or is relevant enough for the bot
+    to join in, see `relevance.py`, or a conversation between two
     or more slack users. Note that the conversation history is only
     stored after the first direct message to the bot is received.
     """
 
+    with tracing.trace("message_reader"):
+        tracing.add("request_bytes", len(event['body']), "Bytes")
+        return handle(event)
+
+
+def handle(event):
     body = json.loads(event['body'])
 
     logging.debug(body)
@@ -41,64 +69,127 @@ def handler(event, context):
         challenge = body["challenge"]
         return utils.build_response({"challenge": challenge})
 
-    sqs = boto3.client('sqs')
-    queue_url = sqs.get_queue_url(
-        QueueName=config.config.MESSAGE_QUEUE_NAME,
-    )
+    # Slack retries the events it didn't get an ack for within 3 seconds,
+    # the first delivery of those is still being handled
+    headers = {name.lower(): value for name, value in (event.get("headers") or {}).items()}
+    if headers.get("x-slack-retry-reason") == "http_timeout":
+        logging.info(f"Skipping retry {headers.get('x-slack-retry-num')} of event {body.get('event_id')}")
+        return utils.build_response("Processed message successfully!")
 
     slack_message = SlackMessage(body)
-    print('slack_message', body)
-    print('slack_message.channel', slack_message.channel)
-    chat_memory = CustomDynamoDBChatMessageHistory(
-        table_name=config.config.DYNAMODB_TABLE_NAME,
-        session_id=slack_message.channel
-    )
-    messages = chat_memory.messages
+    with tracing.span("idempotency"):
+        new_event = idempotency.record_event(slack_message.event_id)
+    if not new_event:
+        logging.info(f"Skipping event {slack_message.event_id}, it was received already")
+        return utils.build_response("Processed message successfully!")
 
-    logging.debug(f"Thread id is {slack_message.channel}")
+    logging.debug(f"Thread id is {slack_message.session_id}")
 
     try:
         if not slack_message.is_bot_reply():
-            if slack_message.is_direct_message() or random.randint(0, 1) == 1:
-                logging.info(f"Sending message with event_id: {slack_message.event_id} to queue")
-
-                # send to queue
-                sqs.send_message(
-                    QueueUrl=queue_url["QueueUrl"],
-                    MessageBody=(event['body']),
-                    MessageGroupId=str(slack_message.channel),
-                    MessageDeduplicationId=slack_message.event_id
-                )
-            elif messages:
-                logging.debug(f"Saving message with event_id: {slack_message.event_id} to history")
-
-                # add to memory for context
-                chat_memory.add_user_message(slack_message.sanitized_text())
-
+            with tracing.span("relevance"):
+                reply = relevance.should_reply(slack_message)
+            if reply and config.config.COALESCE_WINDOW_SECONDS:
+                with tracing.span("coalesce"):
+                    first_at = coalesce.add_pending(slack_message.session_id, {
+                        "user": slack_message.user,
+                        "text": slack_message.sanitized_text(),
+                        "event_id": slack_message.event_id
+                    })
+                # one reply request per burst, later messages join the pending ones
+                if first_at:
+                    try:
+                        sent = send_reply_request(slack_message, {
+                            "channel": slack_message.channel,
+                            "thread": slack_message.thread,
+                            "first_at": first_at
+                        })
+                    except Exception:
+                        # the pending messages would wait for a reply that never comes
+                        logging.exception(f"Failed to request the reply to event {slack_message.event_id}")
+                        tracing.add("errors", 1)
+                        sent = False
+                    if not sent:
+                        save_pending_to_history(
+                            slack_message.session_id, coalesce.take_pending(slack_message.session_id)
+                        )
+            elif reply:
+                if not send_reply_request(slack_message, body):
+                    save_to_history(slack_message)
+            else:
+                save_to_history(slack_message)
 
         logging.info(f"Done processing message with event id: {slack_message.event_id}")
     except Exception as e:
+        tracing.add("errors", 1)
         logging.error(e)
 
     return utils.build_response("Processed message successfully!")
 
 
-class CustomDynamoDBChatMessageHistory(DynamoDBChatMessageHistory):
-    def append(self, message: BaseMessage) -> None:
-        print("ATTENTION: custom class")
-        """Append the message to the record in DynamoDB"""
-        from botocore.exceptions import ClientError
+def send_reply_request(slack_message: SlackMessage, request: Dict) -> bool:
+    """Queues the request for a reply to the message. The threads of a
+    channel are answered in parallel, the messages of a thread in order.
+    While the channel is over its rate limit, replies to the bot's
+    mentions are deferred and the others are dropped.
+
+    Returns:
+        False when the reply was dropped
+    """
+
+    delay = 0
+    if limiter:
+        if slack_message.is_direct_message() or slack_message.is_im():
+            # deferred replies take their token now, so they are spread out at the rate limit
+            delay = limiter.reserve(slack_message.channel, config.config.RATE_LIMIT_MAX_DEFER_SECONDS)
+        else:
+            delay = None if limiter.acquire(slack_message.channel) else 0
+        if delay is None:
+            tracing.add("shed", 1)
+            logging.info(f"Dropping reply to event {slack_message.event_id}, the channel is over its rate limit")
+            return False
+    if delay:
+        tracing.add("deferred", 1)
+        # the writer puts the request back in the queue until then
+        request = {**request, "not_before": int((time.time() + delay) * 1000)}
+
+    logging.info(f"Sending message with event_id: {slack_message.event_id} to queue")
+    with tracing.span("queue_send"):
+        sqs.send_message(
+            QueueUrl=get_queue_url(),
+            MessageBody=json.dumps(request),
+            MessageGroupId=slack_message.session_id,
+            MessageDeduplicationId=slack_message.event_id
+        )
+    return True
+
+
+def save_to_history(slack_message: SlackMessage):
+    """Adds the message to the history of its thread for context, only
+    kept once the bot has answered in the thread"""
+
+    chat_memory = MessageStore(
+        table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
+        session_id=slack_message.session_id
+    )
+    with tracing.span("history_write"):
+        saved = chat_memory.append_if_exists(human_message(slack_message.sanitized_text()))
+    if saved:
+        logging.debug(f"Saved message with event_id: {slack_message.event_id} to history")
+
 
-        messages = messages_to_dict(self.messages)
-        _message = _message_to_dict(message)
-        messages.append(_message)
+def save_pending_to_history(session_id: str, messages: List[Dict]):
+    """Adds the pending messages of a burst that won't be answered to
+    the history of their conversation, like `save_to_history`"""
+
+    chat_memory = MessageStore(
+        table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
+        session_id=session_id
+    )
+    with tracing.span("history_write"):
+        for message in messages:
+            chat_memory.append_if_exists(human_message(message["text"]))
 
-        # limit memory to recent chats
-        messages = messages[-10:]
 
-        try:
-            self.table.put_item(
-                Item={"SessionId": self.session_id, "History": messages}
-            )
-        except ClientError as err:
-            logger.error(err)
\ No newline at end of file
+if config.config.WARMUP:
+    warmup.warm_up_reader(get_queue_url)
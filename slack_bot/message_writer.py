@@ -1,16 +1,61 @@
+import asyncio
 import json
+import math
+import time
+from typing import Dict, List, Optional
 
-from slack_sdk import WebClient
+import aiohttp
+import boto3
+import openai
+from openai.error import AuthenticationError
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_async_handlers import (
+    AsyncConnectionErrorRetryHandler,
+    AsyncRateLimitErrorRetryHandler
+)
+from slack_sdk.web.async_client import AsyncWebClient
 
+import models
 from models import SlackMessage
 import chain
+import coalesce
+import idempotency
 
+import config
+import tracing
 import utils
+import warmup
 
 import logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(logging.DEBUG if config.config.DEBUG else logging.INFO)
+
+# Slack errors that indicate the bot token is no longer valid
+SLACK_AUTH_ERRORS = {"invalid_auth", "not_authed", "token_revoked", "token_expired", "account_inactive"}
+
+# Reused across warm invocations, with the http session of the
+# Slack and OpenAI clients, so their connections are kept alive
+_loop = asyncio.new_event_loop()
+_http_session: Optional[aiohttp.ClientSession] = None
+
+# Slack clients by bot token, built on first use
+_slack_clients: Dict[str, AsyncWebClient] = {}
+
+# created once per container, puts deferred records back in the queue
+sqs = boto3.client("sqs")
+_queue_url = None
+
+
+class Deferred(Exception):
+    """The record asks for a reply later, its channel is over its rate limit
+
+    Args:
+        seconds: how long until the reply can be sent
+    """
+
+    def __init__(self, seconds: float):
+        super().__init__(f"deferred by {seconds:.0f}s")
+        self.seconds = seconds
 
 
 def handler(event, context):
@@ -18,39 +63,235 @@ def handler(event, context):
     sqs queue, and calls the LLM chain to process the
     user's message. This lambda writes the response from
     the LLM chain to the slack thread.
+
+    Messages of different threads in the batch are processed
+    concurrently, messages of the same thread in the order they
+    were received. Failed messages are reported back to sqs, so
+    only those are retried.
     """
 
     logging.debug(event)
-    
-    record = event['Records'][0]
+    logging.info(f"Processing batch of {len(event['Records'])} records")
+    return _loop.run_until_complete(process_batch(event['Records']))
+
+
+async def process_batch(records: List[Dict]) -> Dict:
+    """Processes the records of the batch, returning the failed ones"""
+
+    global _http_session
+    if _http_session is None:
+        _http_session = aiohttp.ClientSession()
+    openai.aiosession.set(_http_session)
+
+    groups: Dict[str, List[Dict]] = {}
+    for record in records:
+        group_id = record['attributes'].get('MessageGroupId', record['messageId'])
+        groups.setdefault(group_id, []).append(record)
+
+    semaphore = asyncio.Semaphore(config.config.WRITER_MAX_CONCURRENCY)
+    failed = await asyncio.gather(*(process_group(group, semaphore) for group in groups.values()))
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_ids in failed for message_id in message_ids
+        ]
+    }
+
+
+async def process_group(records: List[Dict], semaphore: asyncio.Semaphore) -> List[str]:
+    """Processes the records of one thread in order. Stops at the
+    first failure, so the failed record and the ones after it are
+    retried in order.
+
+    Returns:
+        The message ids of the records that were not processed
+    """
+
+    async with semaphore:
+        for i, record in enumerate(records):
+            try:
+                await process_record(record)
+            except Deferred as deferred:
+                logging.info(f"Deferring record with message id: {record['messageId']}, {deferred}")
+                try:
+                    await asyncio.to_thread(defer, records[i:], deferred.seconds)
+                except Exception:
+                    # retried after the visibility timeout of the queue instead
+                    logging.exception(f"Failed to defer record with message id: {record['messageId']}")
+                return [r['messageId'] for r in records[i:]]
+            except Exception:
+                logging.exception(f"Failed to process record with message id: {record['messageId']}")
+                return [r['messageId'] for r in records[i:]]
+    return []
+
+
+async def process_record(record: Dict):
+    """Answers the slack messages in the record once, skipping
+    records that were answered by a previous delivery"""
+
     body = json.loads(record['body'])
-    slack_message = SlackMessage(body=body)
-    
+    wait = body.get("not_before", 0) / 1000 - time.time()
+    if wait >= 1:
+        raise Deferred(wait)
+    key = idempotency_key(body)
+    if not await asyncio.to_thread(idempotency.claim, key):
+        logging.info(f"Skipping {key}, it was answered already")
+        return
+
     try:
-        SECRETS = utils.get_secrets()
-        API_KEY = SECRETS["openai-api-key"]
-        SLACK_TOKEN = SECRETS["slack-bot-token"]
-
-        logging.info(f"Sending message with event_id: {slack_message.event_id} to LLM chain")
-        
-        response_text = chain.run(
-            api_key=API_KEY, 
-            session_id=slack_message.channel,
-            prompt=slack_message.sanitized_text()
+        await reply(body)
+    except Exception:
+        await asyncio.to_thread(idempotency.release, key)
+        raise
+    try:
+        await asyncio.to_thread(idempotency.complete, key)
+    except Exception:
+        # the reply is posted, the record is done. The claim holds off
+        # other deliveries until its lease expires, releasing it would
+        # let them post the reply again
+        logging.exception(f"Failed to complete {key} after replying")
+
+
+def get_queue_url() -> str:
+    """Returns the url of the message queue, looked up on first use"""
+
+    global _queue_url
+    if _queue_url is None:
+        _queue_url = sqs.get_queue_url(QueueName=config.config.MESSAGE_QUEUE_NAME)["QueueUrl"]
+    return _queue_url
+
+
+def defer(records: List[Dict], seconds: float):
+    """Keeps the records of a thread out of the queue for the seconds,
+    the records are delivered again in order once they have passed"""
+
+    for start in range(0, len(records), 10):
+        sqs.change_message_visibility_batch(
+            QueueUrl=get_queue_url(),
+            Entries=[{
+                "Id": str(i),
+                "ReceiptHandle": record["receiptHandle"],
+                "VisibilityTimeout": math.ceil(seconds)
+            } for i, record in enumerate(records[start:start + 10])]
         )
-        
-        client = WebClient(token=SLACK_TOKEN)
-        
-        logging.info(f"Writing response for message with event_id: {slack_message.event_id} to slack")
-
-        client.chat_postMessage(
-            channel=slack_message.channel,
-            text=response_text
+
+
+def idempotency_key(body: Dict) -> str:
+    """Returns the key of the reply request, the same for every delivery"""
+
+    if "first_at" in body:
+        session_id = models.session_id(body["channel"], body.get("thread", ""))
+        return f"reply#{session_id}#{body['first_at']}"
+    return f"reply#{body['event_id']}"
+
+
+async def reply(body: Dict):
+    """Answers the slack messages in the body of the record, either a
+    burst of pending messages of a thread or a single slack message"""
+
+    if "first_at" in body:
+        thread = body.get("thread", "")
+        session_id = models.session_id(body["channel"], thread)
+        await asyncio.sleep(coalesce.window_remaining(body["first_at"]))
+        messages = await asyncio.to_thread(coalesce.take_pending, session_id)
+        if not messages:
+            # already answered, the record is a redelivery
+            return
+        event_ids = ", ".join(m["event_id"] for m in messages)
+        try:
+            await answer(body["channel"], thread, coalesce.merge(messages), event_ids)
+        except Exception:
+            await asyncio.to_thread(coalesce.restore_pending, session_id, messages)
+            raise
+    else:
+        slack_message = SlackMessage(body=body)
+        await answer(slack_message.channel, slack_message.thread,
+                     slack_message.sanitized_text(), slack_message.event_id)
+
+
+async def answer(channel: str, thread: str, prompt: str, event_ids: str):
+    """Calls the LLM chain with the prompt and posts the reply to the
+    thread. The api keys and the history are fetched concurrently,
+    and the history is written back while the reply is posted."""
+
+    # traced per answer, as the messages of a batch are answered concurrently
+    with tracing.trace("message_writer"):
+        tracing.set_property("event_ids", event_ids)
+        tracing.add("prompt_bytes", len(prompt.encode()), "Bytes")
+        try:
+            with tracing.span("secrets_and_history"):
+                secrets, history = await asyncio.gather(
+                    asyncio.to_thread(utils.get_secrets),
+                    asyncio.to_thread(chain.load_history, channel, thread)
+                )
+
+            logging.info(f"Sending message with event_id: {event_ids} to LLM chain")
+
+            try:
+                response_text, save = await chain.run(
+                    api_key=secrets["openai-api-key"], 
+                    history=history,
+                    prompt=prompt
+                )
+            except AuthenticationError:
+                # key might have been rotated since it was cached
+                secrets = await asyncio.to_thread(utils.get_secrets, True)
+                response_text, save = await chain.run(
+                    api_key=secrets["openai-api-key"], 
+                    history=history,
+                    prompt=prompt
+                )
+            
+            logging.info(f"Writing response for message with event_id: {event_ids} to slack")
+
+            save_history = asyncio.create_task(asyncio.to_thread(save))
+            try:
+                with tracing.span("slack_post"):
+                    try:
+                        await post_message(channel, response_text, secrets, thread)
+                    except SlackApiError as e:
+                        if e.response["error"] not in SLACK_AUTH_ERRORS:
+                            raise
+                        secrets = await asyncio.to_thread(utils.get_secrets, True)
+                        await post_message(channel, response_text, secrets, thread)
+            finally:
+                await save_history
+        except SlackApiError as e:
+            assert e.response["error"]
+            tracing.add("errors", 1)
+            logging.error(e)
+
+
+def get_slack_client(token: str) -> AsyncWebClient:
+    """Returns the Slack client of the bot token, reusing the one
+    built by a previous invocation if present"""
+
+    if token not in _slack_clients:
+        _slack_clients[token] = AsyncWebClient(
+            token=token,
+            base_url=config.config.SLACK_API_URL,
+            session=_http_session,
+            timeout=config.config.SLACK_TIMEOUT_SECONDS,
+            retry_handlers=[
+                AsyncConnectionErrorRetryHandler(),
+                # waits for the Retry-After of the response, plus a jitter
+                AsyncRateLimitErrorRetryHandler(max_retry_count=config.config.SLACK_RATE_LIMIT_RETRIES)
+            ]
         )
-    except SlackApiError as e:
-        assert e.response["error"]
-        logging.error(e)
-    
-    return utils.build_response("Processed message successfully!")
+    return _slack_clients[token]
+
+
+async def post_message(channel: str, text: str, secrets: Dict[str, str], thread: str = ""):
+    """Posts the message to the slack thread, or to the channel
+    when the message isn't in a thread"""
+
+    client = get_slack_client(secrets["slack-bot-token"])
+    await client.chat_postMessage(
+        channel=channel,
+        text=text,
+        thread_ts=thread or None
+    )
 
 
+if config.config.WARMUP:
+    warmup.warm_up_writer()
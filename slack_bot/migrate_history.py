@@ -0,0 +1,58 @@
+"""Copies the sessions of the legacy history table, which keeps the
+whole `History` list in one item, to the item-per-message table.
+
+Migrated messages get sort keys that order before any message
+written by the new store, and the same keys on every run, so the
+migration can be re-run safely while the Lambda is serving traffic.
+
+    python migrate_history.py [--dry-run] [--delete]
+"""
+import argparse
+
+from history import MESSAGE_PREFIX, MessageStore, get_table
+
+import config
+
+
+def legacy_message_ids(count: int):
+    return [f"{MESSAGE_PREFIX}{i:020d}#00000000" for i in range(count)]
+
+
+def migrate(dry_run: bool = False, delete: bool = False):
+    legacy_table = get_table(config.config.DYNAMODB_TABLE_NAME)
+
+    scan = {}
+    sessions = messages = 0
+    while True:
+        response = legacy_table.scan(**scan)
+        for item in response["Items"]:
+            history = item.get("History", [])
+            sessions += 1
+            messages += len(history)
+            if dry_run:
+                continue
+
+            store = MessageStore(
+                table_name=config.config.DYNAMODB_MESSAGES_TABLE_NAME,
+                session_id=item["SessionId"]
+            )
+            store.extend(history, message_ids=legacy_message_ids(len(history)))
+            store.create_header()
+            if delete:
+                legacy_table.delete_item(Key={"SessionId": item["SessionId"]})
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    action = "Found" if dry_run else "Migrated"
+    print(f"{action} {messages} messages in {sessions} sessions")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="only count the sessions and messages")
+    parser.add_argument("--delete", action="store_true", help="delete legacy items once copied")
+    args = parser.parse_args()
+
+    migrate(dry_run=args.dry_run, delete=args.delete)
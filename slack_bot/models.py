@@ -1,6 +1,19 @@
 from typing import Dict
 
 
+def session_id(channel: str, thread: str = "") -> str:
+    """Returns the id of the conversation of a slack thread, the channel
+    itself for the messages that aren't in a thread"""
+
+    return f"{channel}#{thread}" if thread else channel
+
+
+def channel_session_id(channel: str) -> str:
+    """Returns the id the summary of all the threads of the channel is kept under"""
+
+    return f"{channel}#channel"
+
+
 class SlackMessage:
     """Encapsulates the message sent by the Slack API"""
 
@@ -10,15 +23,22 @@ class SlackMessage:
         self.event_id = body["event_id"] 
         self.channel = self.message_event["channel"]
         self.text = self.message_event["text"]
+        self.user = self.message_event.get("user", "")
         if "authorizations" in body:
             self.authorizations = body["authorizations"]
         else:
             self.authorizations = []
         
-        if "thread_ts" in self.message_event:
-            self.thread = self.message_event["thread_ts"]
-        else:
-            self.thread = self.message_event["ts"]
+        # messages outside of threads, in a channel or a direct message,
+        # are the conversation of the channel, answered in the channel
+        # and coalesced with the other messages of the channel
+        self.thread = self.message_event.get("thread_ts", "")
+
+    @property
+    def session_id(self) -> str:
+        """Id of the conversation the message belongs to"""
+
+        return session_id(self.channel, self.thread)
 
     def is_bot_reply(self):
         return "bot_id" in self.message_event
@@ -33,6 +53,11 @@ class SlackMessage:
         bot_id = self.get_bot_id()
         return bot_id and f"<@{bot_id}>" in self.text
 
+    def is_im(self):
+        """Whether the message was sent in a direct message channel with the bot"""
+
+        return self.message_event.get("channel_type") == "im"
+
     def sanitized_text(self):
         """Removes bot id from direct messages"""
 
@@ -0,0 +1,174 @@
+"""Token bucket rate limits shared by the containers of a Lambda.
+
+A bucket holds up to `capacity` tokens and gains `rate` tokens a second,
+each request takes one. The buckets are items of a DynamoDB table, with
+a TTL once they would be full again. A request takes a token with an
+atomic, conditional decrement, and the bucket is refilled with a
+conditional write when a token has accrued since its last refill, so
+most requests take a single DynamoDB call. Requests that can wait
+reserve a token instead, which goes into debt when the bucket is empty,
+so they are spread out at the rate of the bucket.
+
+Each container keeps the state of the buckets it used. As other
+containers only take tokens from the shared bucket, a bucket that is
+empty in the container is empty in the table too, and its requests are
+throttled without calling DynamoDB.
+"""
+import time
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+import tracing
+from history import get_table
+
+# Buckets kept by the container, dropped all at once past this size
+MAX_LOCAL_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Rate limit of the requests of each key
+
+    Args:
+        table_name: table of the buckets, with `Key` as partition key
+            and TTL on `ExpiresAt`
+        capacity: most requests of a key in a burst
+        rate: tokens added to the bucket of a key per second
+    """
+
+    def __init__(self, table_name: str, capacity: int, rate: float):
+        self.table_name = table_name
+        self.capacity = capacity
+        self.rate = rate
+        # tokens and time of the buckets used by the container
+        self._local: Dict[str, Tuple[float, float]] = {}
+
+    def acquire(self, key: str) -> float:
+        """Takes a token from the bucket of the key
+
+        Returns:
+            0 when the request can go ahead, otherwise the seconds
+            until the bucket has a token again
+        """
+
+        allowed, tokens = self._acquire(key, floor=1)
+        if allowed:
+            return 0.0
+        tracing.add("throttled", 1)
+        return (1 - tokens) / self.rate
+
+    def reserve(self, key: str, max_delay: float) -> Optional[float]:
+        """Takes a token from the bucket of the key, borrowed from the
+        next ones when the bucket is empty, for a request that waits
+        until the token accrues. Each reservation adds to the wait of
+        the next ones.
+
+        Args:
+            max_delay: longest wait, in seconds, the request accepts
+
+        Returns:
+            The seconds the request waits, 0 to go ahead, or None when
+            the wait would be over `max_delay` and nothing was taken
+        """
+
+        allowed, tokens = self._acquire(key, floor=1 - max_delay * self.rate)
+        if not allowed:
+            tracing.add("throttled", 1)
+            return None
+        return max(-tokens, 0) / self.rate
+
+    def _acquire(self, key: str, floor: float) -> Tuple[bool, float]:
+        """Takes a token when the bucket holds at least `floor` tokens
+
+        Returns:
+            Whether a token was taken, and the tokens left in the bucket
+        """
+
+        now = time.time()
+        tokens = self._tokens_at(key, now)
+        if tokens < floor:
+            return False, tokens
+        with tracing.span("rate_limit"):
+            allowed, tokens = self._take(key, now, floor)
+        if len(self._local) >= MAX_LOCAL_BUCKETS:
+            self._local.clear()
+        self._local[key] = (tokens, now)
+        return allowed, tokens
+
+    def _tokens_at(self, key: str, now: float) -> float:
+        tokens, at = self._local.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - at) * self.rate)
+
+    def _take(self, key: str, now: float, floor: float) -> Tuple[bool, float]:
+        """Takes a token from the bucket in the table, when it holds at
+        least `floor` tokens
+
+        Returns:
+            Whether a token was taken, and the tokens left in the bucket
+        """
+
+        table = get_table(self.table_name)
+        update = {
+            "UpdateExpression": "SET Tokens = Tokens - :one",
+            "ExpressionAttributeValues": {":one": 1, ":floor": _decimal(floor), ":stale": _decimal(now - 1 / self.rate)}
+        }
+        if floor < 1:
+            # the bucket in debt lives until it is full again
+            update["UpdateExpression"] += ", ExpiresAt = :expires"
+            update["ExpressionAttributeValues"][":expires"] = self._expires_at(now, floor - 1)
+        for _ in range(2):
+            try:
+                response = table.update_item(
+                    Key={"Key": key},
+                    # refilled with the write below once a token has accrued
+                    ConditionExpression="Tokens >= :floor AND RefilledAt > :stale",
+                    ReturnValues="UPDATED_NEW",
+                    **update
+                )
+                return True, float(response["Attributes"]["Tokens"])
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+
+            item = table.get_item(Key={"Key": key}, ConsistentRead=True).get("Item")
+            tokens = self._refilled(item, now)
+            if tokens < floor:
+                return False, tokens
+            condition = {"ConditionExpression": "attribute_not_exists(RefilledAt)"}
+            if item is not None:
+                condition = {
+                    "ConditionExpression": "RefilledAt = :refilled_at",
+                    "ExpressionAttributeValues": {":refilled_at": item["RefilledAt"]}
+                }
+            try:
+                table.put_item(
+                    Item={
+                        "Key": key,
+                        "Tokens": _decimal(tokens - 1),
+                        "RefilledAt": _decimal(now),
+                        "ExpiresAt": self._expires_at(now, tokens - 1)
+                    },
+                    **condition
+                )
+                return True, tokens - 1
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            # refilled by another container in the meantime, take from its refill
+        return False, 0.0
+
+    def _expires_at(self, now: float, tokens: float) -> int:
+        """Time the bucket is full again, when its item can be dropped"""
+
+        return int(now + (self.capacity - tokens) / self.rate) + 60
+
+    def _refilled(self, item: Optional[Dict], now: float) -> float:
+        if item is None:
+            return self.capacity
+        elapsed = max(now - float(item["RefilledAt"]), 0)
+        return min(self.capacity, float(item["Tokens"]) + elapsed * self.rate)
+
+
+def _decimal(value: float) -> Decimal:
+    return Decimal(f"{value:.3f}")
@@ -0,0 +1,197 @@
+"""Decides whether the bot joins a conversation it wasn't asked into.
+
+Mentions of the bot and direct messages are always answered. Other
+channel messages are scored by the local signals of `SIGNALS`, each
+adding its weight of `RELEVANCE_SIGNALS` in `config.py`, and answered
+when the score reaches `RELEVANCE_THRESHOLD` and the channel is within
+its limits: at most `RELEVANCE_MAX_REPLIES` unprompted replies per
+`RELEVANCE_RATE_WINDOW_SECONDS`, none within `RELEVANCE_COOLDOWN_SECONDS`
+of the last one.
+
+The times of the unprompted replies of a channel are kept in an item of
+the channel and cached in the reader container. A reply is claimed
+with a conditional write on the version of the item, so the containers
+of the reader share the limits. Scoring runs in process and a decision
+takes at most two DynamoDB calls, well within the 3 seconds Slack waits
+for the ack. Each decision is logged with its signals and score, see
+`RELEVANCE_DECISION_LOG`, to tune the weights and the threshold against
+the replies they cost.
+"""
+import json
+import logging
+import re
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from botocore.exceptions import ClientError
+
+from history import get_table
+from models import SlackMessage
+
+import config
+import tracing
+
+# Sort key of the relevance state of a channel, next to its messages
+STATE_KEY = "RELEVANCE"
+
+REPLY = "reply"
+IGNORED = "ignored"
+COOLDOWN = "cooldown"
+RATE_LIMITED = "rate_limited"
+
+QUESTION_WORDS = ("who", "what", "when", "where", "why", "how", "which", "anyone", "anybody",
+                  "does", "do", "is", "are", "can", "could", "should", "would", "will")
+
+_words = re.compile(r"[\w']+")
+
+
+def _is_question(message: SlackMessage) -> bool:
+    text = message.sanitized_text().lower()
+    words = _words.findall(text)
+    return "?" in text or bool(words and words[0] in QUESTION_WORDS)
+
+
+def _has_keyword(message: SlackMessage) -> bool:
+    words = set(_words.findall(message.sanitized_text().lower()))
+    return any(keyword in words for keyword in config.config.RELEVANCE_KEYWORDS)
+
+
+def _is_short(message: SlackMessage) -> bool:
+    return len(_words.findall(message.sanitized_text())) < config.config.RELEVANCE_MIN_WORDS
+
+
+def _is_thread_reply(message: SlackMessage) -> bool:
+    return "thread_ts" in message.message_event
+
+
+# Signals by name, weighted by `RELEVANCE_SIGNALS`. Add a signal here
+# and give it a weight in config.py to plug it in
+SIGNALS: Dict[str, Callable[[SlackMessage], bool]] = {
+    "question": _is_question,
+    "keyword": _has_keyword,
+    "short": _is_short,
+    "thread_reply": _is_thread_reply
+}
+
+
+class ChannelState(NamedTuple):
+    """Unprompted replies of a channel, as cached by the container"""
+
+    replies: List[int]
+    version: int
+    read_at: float
+
+
+_states: Dict[str, ChannelState] = {}
+
+
+def score(message: SlackMessage) -> Tuple[float, List[str]]:
+    """Scores a message that doesn't mention the bot
+
+    Returns:
+        The sum of the weights of the signals of the message, and their names
+    """
+
+    signals = [name for name, weight in config.config.RELEVANCE_SIGNALS.items()
+               if weight and SIGNALS[name](message)]
+    return sum(config.config.RELEVANCE_SIGNALS[name] for name in signals), signals
+
+
+def should_reply(message: SlackMessage) -> bool:
+    """Decides whether the message is sent to the LLM, claiming an
+    unprompted reply of the channel when it isn't a mention"""
+
+    if message.is_direct_message() or message.is_im():
+        decision, value, signals = REPLY, 1.0, ["mention"]
+    else:
+        value, signals = score(message)
+        decision = IGNORED
+        if value >= config.config.RELEVANCE_THRESHOLD:
+            decision = claim(message.channel)
+
+    tracing.set_property("relevance", decision)
+    if config.config.RELEVANCE_DECISION_LOG:
+        logging.info(json.dumps({"relevance": {
+            "event_id": message.event_id,
+            "channel": message.channel,
+            "thread": message.thread,
+            "score": round(value, 3),
+            "signals": signals,
+            "decision": decision
+        }}))
+    return decision == REPLY
+
+
+def limit(replies: List[int], now: int) -> str:
+    """Returns the limit of the channel the next reply would break,
+    empty when it is within its limits
+
+    Args:
+        replies: times of the unprompted replies in ms, oldest first
+        now: current time in ms
+    """
+
+    if replies and now - replies[-1] < config.config.RELEVANCE_COOLDOWN_SECONDS * 1000:
+        return COOLDOWN
+    window_start = now - config.config.RELEVANCE_RATE_WINDOW_SECONDS * 1000
+    if sum(1 for t in replies if t > window_start) >= config.config.RELEVANCE_MAX_REPLIES:
+        return RATE_LIMITED
+    return ""
+
+
+def claim(channel: str) -> str:
+    """Records an unprompted reply of the channel if it is within its
+    limits. The cached state is refreshed when another container
+    replied in the channel since it was read.
+
+    Returns:
+        `REPLY` when the reply was claimed, otherwise the limit it broke
+    """
+
+    for attempt in range(2):
+        state = get_state(channel, refresh=attempt > 0)
+        now = int(time.time() * 1000)
+        broken = limit(state.replies, now)
+        if broken:
+            return broken
+
+        window_start = now - config.config.RELEVANCE_RATE_WINDOW_SECONDS * 1000
+        replies = [t for t in state.replies if t > window_start] + [now]
+        try:
+            with tracing.span("relevance_claim"):
+                get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).put_item(
+                    Item={"SessionId": channel, "MessageId": STATE_KEY, "Replies": replies,
+                          "Version": state.version + 1},
+                    ConditionExpression="attribute_not_exists(Version) OR Version = :version",
+                    ExpressionAttributeValues={":version": state.version}
+                )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            continue
+        _states[channel] = ChannelState(replies=replies, version=state.version + 1, read_at=time.monotonic())
+        return REPLY
+    # another container keeps replying in the channel
+    return COOLDOWN
+
+
+def get_state(channel: str, refresh: bool = False) -> ChannelState:
+    """Returns the state of the channel, read from the table when it
+    isn't cached or is older than `RELEVANCE_STATE_TTL_SECONDS`"""
+
+    state = _states.get(channel)
+    if not refresh and state and time.monotonic() - state.read_at < config.config.RELEVANCE_STATE_TTL_SECONDS:
+        return state
+
+    with tracing.span("relevance_read"):
+        item = get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).get_item(
+            Key={"SessionId": channel, "MessageId": STATE_KEY},
+            ConsistentRead=True
+        ).get("Item", {})
+    state = ChannelState(
+        replies=[int(t) for t in item.get("Replies", [])],
+        version=int(item.get("Version", 0)),
+        read_at=time.monotonic()
+    )
+    _states[channel] = state
+    return state
@@ -0,0 +1,243 @@
+"""Routes each turn of a conversation to a model.
+
+A local classifier sends the simple turns to a fast, cheap model and
+the hard ones (long prompts, long conversations, prompts asking for
+explanations or code) to a larger model, see `MODEL_ROUTES` and the
+`ROUTER_*` settings in `config.py`.
+
+The model of a route is wrapped in a `HedgedChatModel`, which calls
+the fallback model of the route when the model fails and, when the
+model is slower than its p95 latency, sends the same request to the
+fallback model and returns whichever answers first. Latencies are
+tracked per model in the container, the route, the reason and the
+latency of each call are recorded in the trace of the request.
+"""
+import asyncio
+import contextvars
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from langchain.callbacks.base import CallbackManager
+from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, ChatResult
+from openai.error import AuthenticationError
+
+import config
+import tracing
+
+_latencies: Dict[str, Deque[float]] = {}
+
+_words = re.compile(r"[\w']+")
+
+
+def classify(prompt: str, history_messages: int) -> Tuple[str, str]:
+    """Picks the route of the turn.
+
+    Args:
+        prompt: prompt of the user
+        history_messages: number of messages in the conversation so far
+
+    Returns:
+        The route and the reason it was picked
+    """
+
+    if len(prompt) > config.config.ROUTER_HARD_PROMPT_CHARS:
+        return config.config.ROUTE_HARD, "prompt_length"
+    if history_messages > config.config.ROUTER_HARD_HISTORY_MESSAGES:
+        return config.config.ROUTE_HARD, "history_length"
+    # whole words only, "code" doesn't match "decode", keywords can be phrases
+    words = f" {' '.join(_words.findall(prompt.lower()))} "
+    for keyword in config.config.ROUTER_HARD_KEYWORDS:
+        if f" {keyword} " in words:
+            return config.config.ROUTE_HARD, "keyword"
+    return config.config.ROUTE_SIMPLE, "simple"
+
+
+def record_latency(model_name: str, seconds: float):
+    """Adds the latency of a call to the recent latencies of the model"""
+
+    _latencies.setdefault(model_name, deque(maxlen=config.config.ROUTER_LATENCY_WINDOW)).append(seconds)
+
+
+def hedge_delay(model_name: str) -> float:
+    """Seconds to wait for the model before hedging, the
+    `ROUTER_HEDGE_PERCENTILE` of its recent latencies"""
+
+    latencies = _latencies.get(model_name, ())
+    if len(latencies) < config.config.ROUTER_HEDGE_MIN_SAMPLES:
+        return config.config.ROUTER_HEDGE_DEFAULT_SECONDS
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * config.config.ROUTER_HEDGE_PERCENTILE / 100))
+    return ordered[index]
+
+
+class HedgedChatModel(BaseChatModel):
+    """Chat model of a route, backed up by the fallback model of the route
+
+    Args:
+        route: name of the route, recorded with the metrics
+        model: model of the route
+        fallback: model called when `model` fails or is slow, optional
+        fallback_route: name of the route of the fallback model
+    """
+
+    route: str
+    model: ChatOpenAI
+    fallback: Optional[ChatOpenAI] = None
+    fallback_route: str = ""
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat"
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        combined = self.model._combine_llm_outputs(llm_outputs)
+        # the model that answered, which may be the fallback
+        for output in llm_outputs:
+            if output and "model_name" in output:
+                combined["model_name"] = output["model_name"]
+        return combined
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None) -> ChatResult:
+        context = contextvars.copy_context()
+        calls: Dict[Future, Tuple[ChatOpenAI, CallCallbacks]] = {}
+
+        def start(model: ChatOpenAI, route: str) -> Future:
+            callbacks = CallCallbacks(list(model.callback_manager.handlers))
+            future = _run_in_thread(context.copy().run, self._call, model, route, messages, stop, callbacks)
+            calls[future] = (model, callbacks)
+            return future
+
+        pending = {start(self.model, self.route)}
+        fallback_sent = self.fallback is None
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=None if fallback_sent else self._hedge_delay(),
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except AuthenticationError:
+                        raise
+                    except Exception as err:
+                        error = err
+                        continue
+                    tracing.set_property("model", calls[future][0].model_name)
+                    return result
+                if not fallback_sent:
+                    fallback_sent = True
+                    self._record_fallback(hedged=not done)
+                    pending.add(start(self.fallback, self.fallback_route))
+            raise error
+        finally:
+            # a sync call can't be cancelled, the slower one runs to its end
+            # but its callbacks and metrics don't reach the request anymore
+            for future in pending:
+                calls[future][1].abandon()
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None) -> ChatResult:
+        task = asyncio.ensure_future(self._acall(self.model, self.route, messages, stop))
+        calls = {task: self.model}
+        pending = {task}
+        fallback_sent = self.fallback is None
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=None if fallback_sent else self._hedge_delay(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        result = task.result()
+                    except AuthenticationError:
+                        raise
+                    except Exception as err:
+                        error = err
+                        continue
+                    tracing.set_property("model", calls[task].model_name)
+                    return result
+                if not fallback_sent:
+                    fallback_sent = True
+                    self._record_fallback(hedged=not done)
+                    task = asyncio.ensure_future(self._acall(self.fallback, self.fallback_route, messages, stop))
+                    calls[task] = self.fallback
+                    pending.add(task)
+            raise error
+        finally:
+            # the slower call isn't needed anymore
+            for task in pending:
+                task.cancel()
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Seconds before the fallback is called, None only calls
+        the fallback when the model fails"""
+
+        if not config.config.ROUTER_HEDGE_ENABLED:
+            return None
+        return hedge_delay(self.model.model_name)
+
+    def _record_fallback(self, hedged: bool):
+        tracing.add("hedged" if hedged else "fallbacks", 1)
+        tracing.debug(f"{'hedging' if hedged else 'falling back'} route {self.route} with {self.fallback_route}")
+
+    @staticmethod
+    def _call(model: ChatOpenAI, route: str, messages: List[BaseMessage], stop: Optional[List[str]],
+              callbacks: "CallCallbacks") -> ChatResult:
+        start = time.perf_counter()
+        # the clients are shared, the copy holds the callbacks of this call
+        result = model.copy(update={"callback_manager": callbacks})._generate(messages, stop=stop)
+        seconds = time.perf_counter() - start
+        if callbacks.abandoned:
+            # the latency still counts for the hedge delay of the model
+            record_latency(model.model_name, seconds)
+        else:
+            _record_call(model, route, seconds)
+        return result
+
+    @staticmethod
+    async def _acall(model: ChatOpenAI, route: str, messages: List[BaseMessage],
+                     stop: Optional[List[str]]) -> ChatResult:
+        start = time.perf_counter()
+        result = await model._agenerate(messages, stop=stop)
+        _record_call(model, route, time.perf_counter() - start)
+        return result
+
+
+class CallCallbacks(CallbackManager):
+    """Callbacks of one call of a hedged request, which stop reaching
+    the handlers once the request is answered by the other call"""
+
+    abandoned = False
+
+    def abandon(self):
+        self.abandoned = True
+        self.set_handlers([])
+
+
+def _run_in_thread(function: Callable, *args) -> Future:
+    """Runs the function in a daemon thread. Unlike the threads of an
+    executor, the interpreter doesn't wait for it on exit, so an
+    abandoned call doesn't hold up the shutdown of the process"""
+
+    future: Future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except BaseException as err:
+            future.set_exception(err)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _record_call(model: ChatOpenAI, route: str, seconds: float):
+    record_latency(model.model_name, seconds)
+    tracing.add(f"model_{route}_ms", seconds * 1000, "Milliseconds")
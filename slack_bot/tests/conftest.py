@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+
+@pytest.fixture
+def tables():
+    """Messages, idempotency and rate limit tables in moto's in-memory DynamoDB"""
+
+    import boto3
+    from moto import mock_aws
+
+    import history
+    from config import config
+
+    with mock_aws():
+        history._tables.clear()
+        dynamodb = boto3.resource("dynamodb")
+        dynamodb.create_table(
+            TableName=config.DYNAMODB_MESSAGES_TABLE_NAME,
+            KeySchema=[
+                {"AttributeName": "SessionId", "KeyType": "HASH"},
+                {"AttributeName": "MessageId", "KeyType": "RANGE"}
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "SessionId", "AttributeType": "S"},
+                {"AttributeName": "MessageId", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        for table_name, key in ((config.IDEMPOTENCY_TABLE_NAME, "IdempotencyKey"), (config.RATE_LIMIT_TABLE_NAME, "Key")):
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST"
+            )
+        yield
+        history._tables.clear()
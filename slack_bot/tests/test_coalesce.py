@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import coalesce
+import config
+import message_reader
+import models
+from history import MessageStore, get_table, human_message
+
+SESSION_ID = models.session_id("C1", "T1")
+
+
+def message(number):
+    return {"user": "U1", "text": f"message {number}", "event_id": f"E{number}"}
+
+
+def test_messages_join_the_pending_batch(tables):
+    assert coalesce.add_pending(SESSION_ID, message(1))
+    assert coalesce.add_pending(SESSION_ID, message(2)) == 0
+
+    assert coalesce.take_pending(SESSION_ID) == [message(1), message(2)]
+
+
+def test_stale_pending_messages_start_a_new_batch(tables):
+    coalesce.add_pending(SESSION_ID, message(1))
+    # the reply request of the batch was lost
+    get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME).update_item(
+        Key={"SessionId": SESSION_ID, "MessageId": coalesce.PENDING_KEY},
+        UpdateExpression="SET FirstAt = FirstAt - :age",
+        ExpressionAttributeValues={":age": int(coalesce.stale_after_seconds() * 1000) + 1}
+    )
+
+    assert coalesce.add_pending(SESSION_ID, message(2))
+    assert coalesce.add_pending(SESSION_ID, message(3)) == 0
+    assert coalesce.take_pending(SESSION_ID) == [message(1), message(2), message(3)]
+
+
+class FailingQueue:
+    """Queue whose sends fail, like a throttled or unreachable SQS"""
+
+    def __init__(self):
+        self.sends = 0
+
+    def send_message(self, **kwargs):
+        self.sends += 1
+        raise ConnectionError("queue unreachable")
+
+
+@pytest.fixture
+def reader(tables, monkeypatch):
+    queue = FailingQueue()
+    monkeypatch.setattr(message_reader, "sqs", queue)
+    monkeypatch.setattr(message_reader, "_queue_url", "queue")
+    monkeypatch.setattr(message_reader, "limiter", None)
+    monkeypatch.setattr(config.Config, "COALESCE_WINDOW_SECONDS", 2)
+    return queue
+
+
+def mention(number):
+    return {"body": json.dumps({
+        "event_id": f"E{number}",
+        "authorizations": [{"user_id": "UBOT"}],
+        "event": {"channel": "C1", "user": "U1", "text": f"<@UBOT> question {number}",
+                  "ts": f"{number}.0", "thread_ts": "T1"}
+    })}
+
+
+def test_failed_reply_request_releases_the_pending_messages(reader):
+    history = MessageStore(config.config.DYNAMODB_MESSAGES_TABLE_NAME, SESSION_ID)
+    history.append(human_message("earlier"))
+    history.create_header()
+
+    message_reader.handle(mention(1))
+    message_reader.handle(mention(2))
+
+    # each message requested its own reply, none joined a dead batch
+    assert reader.sends == 2
+    assert coalesce.take_pending(SESSION_ID) == []
+    assert [m["data"]["content"] for m in history.messages()] == ["earlier", "question 1", "question 2"]
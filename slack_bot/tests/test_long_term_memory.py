@@ -0,0 +1,112 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import chain
+import config
+import long_term_memory
+from history import MessageStore, human_message
+
+TABLE = config.config.DYNAMODB_MESSAGES_TABLE_NAME
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    """Embeddings api returning random embeddings"""
+
+    rng = np.random.default_rng(0)
+
+    def create(input, **kwargs):
+        return {"data": [{"embedding": rng.standard_normal(kwargs["dimensions"]).tolist()} for _ in input]}
+
+    monkeypatch.setattr(long_term_memory.openai.Embedding, "create", create)
+    monkeypatch.setattr(long_term_memory, "_indexes", {})
+
+
+def items(first, count):
+    return [
+        {"MessageId": f"MSG#{i:04d}", "Message": human_message(f"a message long enough to recall {i}")}
+        for i in range(first, first + count)
+    ]
+
+
+class ThrottledTable:
+    """`batch_get_item` returning the keys after the first one unprocessed"""
+
+    def __init__(self):
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        self.requests.append(RequestItems)
+        first, *rest = RequestItems[TABLE]["Keys"]
+        item = {**first, "Message": human_message(f"message {first['MessageId']}")}
+        return {
+            "Responses": {TABLE: [item]},
+            "UnprocessedKeys": {TABLE: {"Keys": rest}} if rest else {}
+        }
+
+
+def test_unprocessed_keys_are_read_again(monkeypatch):
+    table = ThrottledTable()
+    monkeypatch.setattr(long_term_memory, "_dynamodb", table)
+    monkeypatch.setattr(config.Config, "HTTP_BACKOFF_SECONDS", 0)
+
+    snippets = long_term_memory.read_snippets(["C1#T1/M1", "C1#T1/M2"])
+
+    assert list(snippets) == ["C1#T1/M1", "C1#T1/M2"]
+    assert len(table.requests) == 2
+
+
+def test_each_batch_is_written_in_a_new_shard(tables, embeddings):
+    long_term_memory.add("sk-test", "C1", "C1#T1", items(0, 3))
+    first = long_term_memory.DynamoDBShards().read("C1")
+    long_term_memory.add("sk-test", "C1", "C1#T1", items(3, 2))
+
+    shards = long_term_memory.DynamoDBShards().read("C1")
+    assert [len(shard.refs) for shard in shards] == [3, 2]
+    # the first shard isn't written again
+    assert shards[0].refs == first[0].refs
+    assert np.array_equal(shards[0].vectors, first[0].vectors)
+
+
+def test_shard_written_by_another_container_is_kept(tables, embeddings):
+    long_term_memory.add("sk-test", "C1", "C1#T1", items(0, 3))
+    other = long_term_memory.Shard(number=1, refs=["C1#T2/MSG#0000"],
+                                   vectors=np.ones((1, config.config.LONG_TERM_MEMORY_DIMENSIONS), dtype=np.int8))
+    assert long_term_memory.DynamoDBShards().write("C1", other)
+
+    # the cached index of the channel doesn't have the shard of the other container yet
+    assert long_term_memory.add("sk-test", "C1", "C1#T1", items(3, 2)) == 2
+
+    shards = long_term_memory.DynamoDBShards().read("C1")
+    assert [len(shard.refs) for shard in shards] == [3, 1, 2]
+    assert len(long_term_memory.get_index("C1").refs) == 6
+
+
+def test_recall_is_cancelled_when_the_reply_fails(monkeypatch):
+    cancelled = []
+
+    async def recall(api_key, channel, prompt):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(channel)
+            raise
+
+    def classify(prompt, history_messages):
+        raise RuntimeError("router failed")
+
+    monkeypatch.setattr(config.Config, "LONG_TERM_MEMORY_ENABLED", True)
+    monkeypatch.setattr(chain.long_term_memory, "recall", recall)
+    monkeypatch.setattr(chain.router, "classify", classify)
+    history = chain.History(store=MessageStore(TABLE, "C1#T1"), items=[], summary={}, channel="C1")
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await chain.run("sk-test", history, "hello")
+        # lets the cancelled task run its handler, before the loop ends
+        await asyncio.sleep(0)
+        assert cancelled == ["C1"]
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import pytest
+
+import message_writer
+
+
+@pytest.fixture
+def claims(monkeypatch):
+    """Calls made to the idempotency table, with a reply that succeeds"""
+
+    calls = []
+
+    async def reply(body):
+        calls.append("reply")
+
+    monkeypatch.setattr(message_writer, "reply", reply)
+    monkeypatch.setattr(message_writer.idempotency, "claim", lambda key: calls.append("claim") or True)
+    monkeypatch.setattr(message_writer.idempotency, "release", lambda key: calls.append("release"))
+    return calls
+
+
+def records():
+    return [{"messageId": "m1", "body": json.dumps({"event_id": "E1", "channel": "C1"})}]
+
+
+def process(records):
+    return asyncio.run(message_writer.process_group(records, asyncio.Semaphore(1)))
+
+
+def test_failed_completion_after_the_reply_keeps_the_claim(claims, monkeypatch):
+    def complete(key):
+        claims.append("complete")
+        raise RuntimeError("throttled")
+
+    monkeypatch.setattr(message_writer.idempotency, "complete", complete)
+
+    assert process(records()) == []
+    assert claims == ["claim", "reply", "complete"]
+
+
+def test_failed_reply_releases_the_claim(claims, monkeypatch):
+    async def reply(body):
+        raise RuntimeError("slack is down")
+
+    monkeypatch.setattr(message_writer, "reply", reply)
+    monkeypatch.setattr(message_writer.idempotency, "complete", lambda key: claims.append("complete"))
+
+    assert process(records()) == ["m1"]
+    assert claims == ["claim", "release"]
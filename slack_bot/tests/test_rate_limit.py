@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import config
+import message_reader
+import rate_limit
+
+# a token every 10 seconds, after a burst of 2
+RATE = 0.1
+
+
+class Queue:
+    """Records the reply requests sent to the queue"""
+
+    def __init__(self):
+        self.requests = []
+
+    def send_message(self, MessageBody, **kwargs):
+        self.requests.append(json.loads(MessageBody))
+
+
+@pytest.fixture
+def queue(tables, monkeypatch):
+    queue = Queue()
+    monkeypatch.setattr(message_reader, "sqs", queue)
+    monkeypatch.setattr(message_reader, "_queue_url", "queue")
+    monkeypatch.setattr(message_reader, "limiter", rate_limit.TokenBucket(config.config.RATE_LIMIT_TABLE_NAME, 2, RATE))
+    monkeypatch.setattr(config.Config, "RATE_LIMIT_MAX_DEFER_SECONDS", 35)
+    return queue
+
+
+def message(number, mention=True):
+    text = f"<@UBOT> question {number}" if mention else f"thanks for all the answers {number}"
+    return {"body": json.dumps({
+        "event_id": f"E{number}",
+        "authorizations": [{"user_id": "UBOT"}],
+        # one thread each, so they aren't coalesced
+        "event": {"channel": "C1", "user": "U1", "text": text, "ts": f"{number}.0", "thread_ts": f"T{number}"}
+    })}
+
+
+def test_mentions_over_the_limit_are_spread_out_at_its_rate(queue):
+    for number in range(7):
+        message_reader.handle(message(number))
+
+    not_before = [request.get("not_before") for request in queue.requests]
+    assert not_before[:2] == [None, None]
+    # each deferred reply waits a token longer than the one before it
+    deferred = not_before[2:]
+    # the replies that would wait past the longest deferral are dropped
+    assert len(deferred) == 3
+    for earlier, later in zip(deferred, deferred[1:]):
+        assert later - earlier == pytest.approx(1000 / RATE, abs=100)
+
+
+def test_deferred_replies_keep_unprompted_replies_out(queue, monkeypatch):
+    monkeypatch.setattr(message_reader.relevance, "should_reply", lambda message: True)
+    for number in range(3):
+        message_reader.handle(message(number))
+    message_reader.handle(message(3, mention=False))
+
+    assert [request["thread"] for request in queue.requests] == ["T0", "T1", "T2"]
+
+
+def test_reservations_over_the_longest_wait_take_nothing(tables):
+    bucket = rate_limit.TokenBucket(config.config.RATE_LIMIT_TABLE_NAME, 1, RATE)
+
+    assert bucket.reserve("key", 15) == 0
+    assert bucket.reserve("key", 15) == pytest.approx(10, abs=0.1)
+    assert bucket.reserve("key", 15) is None
+    assert bucket.reserve("key", 25) == pytest.approx(20, abs=0.1)
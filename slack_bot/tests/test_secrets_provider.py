@@ -0,0 +1,90 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import config
+import secrets_provider
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks"))
+
+from fake_services import FakeSecretsExtension  # noqa: E402
+
+TTL_SECONDS = 0.5
+
+
+@pytest.fixture
+def extension(monkeypatch):
+    """The secrets extension, with the api keys secret"""
+
+    with FakeSecretsExtension({config.config.API_KEYS_SECRET_NAME: {"openai-api-key": "sk-1"}},
+                              latency=0.05, port=0) as extension:
+        monkeypatch.setattr(config.Config, "SECRETS_EXTENSION_ENDPOINT", extension.endpoint)
+        monkeypatch.setattr(config.Config, "SECRETS_CACHE_TTL_SECONDS", TTL_SECONDS)
+        monkeypatch.setenv("AWS_SESSION_TOKEN", "token")
+        secrets_provider.invalidate()
+        yield extension
+        secrets_provider.invalidate()
+
+
+def test_secret_is_cached_within_the_ttl(extension):
+    assert secrets_provider.get_secrets() == {"openai-api-key": "sk-1"}
+    extension.rotate(config.config.API_KEYS_SECRET_NAME, {"openai-api-key": "sk-2"})
+
+    assert secrets_provider.get_secrets() == {"openai-api-key": "sk-1"}
+    assert extension.requests == 1
+
+
+def test_secret_is_fetched_again_once_expired(extension):
+    secrets_provider.get_secrets()
+    extension.rotate(config.config.API_KEYS_SECRET_NAME, {"openai-api-key": "sk-2"})
+    time.sleep(TTL_SECONDS)
+
+    assert secrets_provider.get_secrets() == {"openai-api-key": "sk-2"}
+    assert extension.requests == 2
+
+
+def test_concurrent_callers_share_one_fetch(extension):
+    barrier = threading.Barrier(8)
+    results = []
+
+    def get():
+        barrier.wait()
+        results.append(secrets_provider.get_secrets())
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{"openai-api-key": "sk-1"}] * 8
+    assert extension.requests == 1
+
+
+def test_force_refresh_bypasses_the_cache(extension):
+    secrets_provider.get_secrets()
+    extension.rotate(config.config.API_KEYS_SECRET_NAME, {"openai-api-key": "sk-2"})
+
+    assert secrets_provider.get_secrets(force_refresh=True) == {"openai-api-key": "sk-2"}
+    assert secrets_provider.get_secrets() == {"openai-api-key": "sk-2"}
+    assert extension.requests == 2
+
+
+def test_concurrent_forced_refreshes_share_one_fetch(extension):
+    secrets_provider.get_secrets()
+    barrier = threading.Barrier(4)
+
+    def refresh():
+        barrier.wait()
+        secrets_provider.get_secrets(force_refresh=True)
+
+    threads = [threading.Thread(target=refresh) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert extension.requests == 2
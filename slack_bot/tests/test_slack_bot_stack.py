@@ -0,0 +1,84 @@
+import zipfile
+
+import pytest
+from aws_cdk import App
+from aws_cdk.assertions import Match, Template
+
+import app
+import config
+
+PROFILES = sorted(config.config.PERFORMANCE_PROFILES)
+
+
+def synth(profile_name: str, tmp_path, monkeypatch) -> Template:
+    """Template of the stack deployed with the performance profile"""
+
+    # the stack packages the bundles of bundle_reader.sh and bundle_writer.sh
+    for bundle in ("dist_reader", "dist_writer"):
+        (tmp_path / bundle).mkdir()
+        zipfile.ZipFile(tmp_path / bundle / "lambda.zip", "w").close()
+    monkeypatch.setattr(config.Config, "PERFORMANCE_PROFILE", profile_name)
+    return Template.from_stack(app.SlackBotApp(App(), "SlackBotApp", bundle_dir=str(tmp_path)))
+
+
+def function(template: Template, handler: str):
+    """Logical id and properties of the lambda function of the handler"""
+
+    resources = template.find_resources("AWS::Lambda::Function", {"Properties": {"Handler": handler}})
+    assert len(resources) == 1
+    logical_id, resource = next(iter(resources.items()))
+    return logical_id, resource["Properties"]
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+@pytest.mark.parametrize("role, handler", [
+    ("reader", "message_reader.handler"),
+    ("writer", "message_writer.handler")
+])
+def test_functions_have_the_settings_of_the_profile(profile_name, role, handler, tmp_path, monkeypatch):
+    profile = config.config.PERFORMANCE_PROFILES[profile_name][role]
+    _, properties = function(synth(profile_name, tmp_path, monkeypatch), handler)
+
+    assert properties.get("MemorySize") == profile["memory_size"]
+    assert properties["Architectures"] == [profile["architecture"]]
+    assert properties.get("ReservedConcurrentExecutions") == (profile.get("reserved_concurrency") or None)
+    assert ("WARMUP" in properties.get("Environment", {}).get("Variables", {})) == profile["warmup"]
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+@pytest.mark.parametrize("role, handler", [
+    ("reader", "message_reader.handler"),
+    ("writer", "message_writer.handler")
+])
+def test_live_alias_has_the_provisioned_concurrency_of_the_profile(profile_name, role, handler, tmp_path, monkeypatch):
+    profile = config.config.PERFORMANCE_PROFILES[profile_name][role]
+    template = synth(profile_name, tmp_path, monkeypatch)
+    logical_id, _ = function(template, handler)
+
+    aliases = template.find_resources("AWS::Lambda::Alias", {
+        "Properties": {"FunctionName": {"Ref": logical_id}}
+    })
+    if not profile["provisioned_concurrency"]:
+        assert aliases == {}
+        return
+
+    assert len(aliases) == 1
+    properties = next(iter(aliases.values()))["Properties"]
+    assert properties["Name"] == "live"
+    assert properties["ProvisionedConcurrencyConfig"] == {
+        "ProvisionedConcurrentExecutions": profile["provisioned_concurrency"]
+    }
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_queue_invokes_at_most_the_reserved_writers(profile_name, tmp_path, monkeypatch):
+    reserved = config.config.PERFORMANCE_PROFILES[profile_name]["writer"]["reserved_concurrency"]
+    template = synth(profile_name, tmp_path, monkeypatch)
+
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 1)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": config.config.WRITER_BATCH_SIZE,
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        # the event source doesn't take a cap under 2
+        "ScalingConfig": {"MaximumConcurrency": reserved} if reserved and reserved >= 2 else Match.absent()
+    })
@@ -1,11 +1,6 @@
 import json
-import os
 from typing import Dict, Union
 
-import requests
-
-import config
-
 
 def build_response(body: Union[Dict, str]):
     """Builds response for Lambda"""
@@ -18,17 +13,10 @@ def build_response(body: Union[Dict, str]):
     }
 
 
-def get_secrets() -> Dict[str, str]:
+def get_secrets(force_refresh: bool = False) -> Dict[str, str]:
     """Fetches the API keys saved in Secrets Manager"""
 
-    headers = {
-        "X-Aws-Parameters-Secrets-Token": os.environ.get('AWS_SESSION_TOKEN')
-    }
-    secrets_extension_endpoint = "http://localhost:2773" + \
-    "/secretsmanager/get?secretId=" + \
-    config.config.API_KEYS_SECRET_NAME
-  
-    r = requests.get(secrets_extension_endpoint, headers=headers)
-    secrets = json.loads(json.loads(r.text)["SecretString"])
+    # deferred, the reader lambda doesn't need secrets or requests
+    import secrets_provider
 
-    return secrets
\ No newline at end of file
+    return secrets_provider.get_secrets(force_refresh=force_refresh)
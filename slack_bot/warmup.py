@@ -0,0 +1,57 @@
+"""Initialises the container before its first request.
+
+Runs in the init phase of the lambdas when the performance profile
+sets `warmup`, see `PERFORMANCE_PROFILES` in config.py. Environments
+kept provisioned run it before they receive traffic, so the reader
+acks Slack and the writer replies without first looking up the queue,
+fetching the api keys or building the clients. A failure is logged
+and left to the first request to retry.
+"""
+import logging
+import time
+from typing import Callable
+
+import config
+from history import get_table
+
+
+def warm_up_reader(get_queue_url: Callable[[], str]):
+    """Looks up the queue and builds the table clients of the reader
+
+    Args:
+        get_queue_url: looks up the queue url of the reader and keeps it
+    """
+
+    start = time.perf_counter()
+    try:
+        get_queue_url()
+        get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+        get_table(config.config.IDEMPOTENCY_TABLE_NAME)
+    except Exception as err:
+        logging.warning(f"warm up failed: {err}")
+        return
+    logging.info(f"warmed up in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+def warm_up_writer():
+    """Fetches the api keys and builds the clients of the writer"""
+
+    # deferred, the reader bundle doesn't have the chain
+    import chain
+    import memory
+    import utils
+
+    start = time.perf_counter()
+    try:
+        api_key = utils.get_secrets()["openai-api-key"]
+        get_table(config.config.DYNAMODB_MESSAGES_TABLE_NAME)
+        get_table(config.config.IDEMPOTENCY_TABLE_NAME)
+        chain.get_prompt_template()
+        for route in config.config.MODEL_ROUTES:
+            chain.get_routed_llm(api_key, route)
+        if config.config.MEMORY_MAX_TOKENS:
+            memory.get_encoding(config.config.MODEL_NAME)
+    except Exception as err:
+        logging.warning(f"warm up failed: {err}")
+        return
+    logging.info(f"warmed up in {(time.perf_counter() - start) * 1000:.0f}ms")